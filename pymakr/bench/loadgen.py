@@ -0,0 +1,362 @@
+#!/usr/bin/env python3
+"""
+Load generator and end-to-end benchmark for the broker.
+
+Starts MQTTServer on localhost (or targets a running broker with --external),
+connects the configured publishers and subscribers and reports the delivery
+throughput and end-to-end latency percentiles. Every payload carries its send
+time, so latency is measured from the publisher write to the subscriber read.
+
+Example:
+    python bench/loadgen.py --publishers 4 --subscribers 16 --messages 5000 --qos 1 --json
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import struct
+import subprocess
+import sys
+import time
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+sys.path.insert(0, SRC_DIR)
+
+from FrameDecoder import FrameDecoder
+from Messages import (PACKET_TYPE_CONNACK, PACKET_TYPE_PUBLISH, PACKET_TYPE_PUBACK, PACKET_TYPE_PUBREC, PACKET_TYPE_PUBREL,
+                      PACKET_TYPE_PUBCOMP, PACKET_TYPE_SUBACK, encode_ack, encode_remaining_length, encode_string, encode_subscribe)
+
+# Send time in nanoseconds and sequence number at the start of every payload
+PAYLOAD_HEADER = struct.Struct('>QQ')
+TOPIC_PREFIX = 'bench'
+
+def encode_connect(client_id: str, keep_alive: int = 0) -> bytes:
+    body = encode_string('MQTT') + bytes((4, 0x02)) + struct.pack('>H', keep_alive) + encode_string(client_id)
+    return bytes((0x10,)) + encode_remaining_length(len(body)) + body
+
+def encode_publish(topic: bytes, payload: bytes, qos: int, packet_id: int) -> bytes:
+    body = topic + (struct.pack('>H', packet_id) if qos > 0 else b'') + payload
+    return bytes(((PACKET_TYPE_PUBLISH << 4) | (qos << 1),)) + encode_remaining_length(len(body)) + body
+
+def topic_for(index: int) -> str:
+    return f'{TOPIC_PREFIX}/{index}/data'
+
+def percentile(ordered: list, fraction: float) -> float:
+    if not ordered:
+        return 0.0
+
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+class BenchConnection:
+    """
+    A minimal MQTT 3.1.1 client speaking just enough of the protocol for the benchmark.
+    """
+    def __init__(self, client_id: str):
+        self.client_id = client_id
+        self.decoder = FrameDecoder()
+        self.reader: asyncio.StreamReader = None
+        self.writer: asyncio.StreamWriter = None
+
+    async def connect(self, host: str, port: int):
+        self.reader, self.writer = await asyncio.open_connection(host, port)
+        self.writer.write(encode_connect(self.client_id))
+        frame = await self.read_frame()
+
+        if frame[0] >> 4 != PACKET_TYPE_CONNACK or frame[3] != 0:
+            raise ConnectionError(f'{self.client_id}: connection refused')
+
+    async def frames(self):
+        while True:
+            data = await self.reader.read(65536)
+            if not data:
+                return
+
+            for frame in self.decoder.feed(data):
+                yield frame
+
+    async def read_frame(self):
+        async for frame in self.frames():
+            return bytes(frame)
+
+        raise ConnectionError(f'{self.client_id}: connection closed')
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+class Subscriber(BenchConnection):
+    def __init__(self, client_id: str, topic_filter: str, qos: int):
+        super().__init__(client_id)
+        self.topic_filter = topic_filter
+        self.qos = qos
+        self.latencies = []
+        self.received = 0
+        self.last_received_at = 0
+
+    async def subscribe(self):
+        self.writer.write(encode_subscribe(1, self.topic_filter, self.qos))
+        frame = await self.read_frame()
+
+        if frame[0] >> 4 != PACKET_TYPE_SUBACK:
+            raise ConnectionError(f'{self.client_id}: subscribe failed')
+
+    async def run(self, done: asyncio.Event, counter: list):
+        async for frame in self.frames():
+            packet_type = frame[0] >> 4
+
+            if packet_type == PACKET_TYPE_PUBLISH:
+                now = time.perf_counter_ns()
+                qos = (frame[0] >> 1) & 0x03
+
+                offset = 1
+                while frame[offset] & 0x80:
+                    offset += 1
+                offset += 1
+
+                topic_length = (frame[offset] << 8) | frame[offset + 1]
+                offset += 2 + topic_length
+
+                if qos > 0:
+                    packet_id = (frame[offset] << 8) | frame[offset + 1]
+                    offset += 2
+                    self.writer.write(encode_ack(PACKET_TYPE_PUBACK if qos == 1 else PACKET_TYPE_PUBREC, packet_id))
+
+                sent_at, _ = PAYLOAD_HEADER.unpack_from(frame, offset)
+                self.latencies.append(now - sent_at)
+                self.received += 1
+                self.last_received_at = now
+
+                counter[0] -= 1
+                if counter[0] <= 0:
+                    done.set()
+            elif packet_type == PACKET_TYPE_PUBREL:
+                self.writer.write(encode_ack(PACKET_TYPE_PUBCOMP, (frame[2] << 8) | frame[3]))
+
+class Publisher(BenchConnection):
+    def __init__(self, client_id: str, topic: str, qos: int, payload_size: int, messages: int, rate: float, max_inflight: int):
+        super().__init__(client_id)
+        self.topic = encode_string(topic)
+        self.qos = qos
+        self.padding = b'x' * max(0, payload_size - PAYLOAD_HEADER.size)
+        self.messages = messages
+        self.rate = rate
+        self.inflight = asyncio.Semaphore(max_inflight)
+        self.first_sent_at = 0
+
+    async def acknowledgements(self):
+        async for frame in self.frames():
+            packet_type = frame[0] >> 4
+
+            if packet_type == PACKET_TYPE_PUBREC:
+                self.writer.write(encode_ack(PACKET_TYPE_PUBREL, (frame[2] << 8) | frame[3]))
+            elif packet_type in (PACKET_TYPE_PUBACK, PACKET_TYPE_PUBCOMP):
+                self.inflight.release()
+
+    async def run(self):
+        acknowledgements = asyncio.ensure_future(self.acknowledgements()) if self.qos > 0 else None
+        interval = 1 / self.rate if self.rate > 0 else 0
+        started = time.perf_counter()
+        self.first_sent_at = time.perf_counter_ns()
+
+        for sequence in range(self.messages):
+            if self.qos > 0:
+                await self.inflight.acquire()
+
+            payload = PAYLOAD_HEADER.pack(time.perf_counter_ns(), sequence) + self.padding
+            self.writer.write(encode_publish(self.topic, payload, self.qos, sequence % 0xFFFF + 1))
+
+            if interval:
+                delay = started + (sequence + 1) * interval - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            elif sequence % 64 == 63:
+                await self.writer.drain()
+
+        await self.writer.drain()
+        return acknowledgements
+
+class LoadGenerator:
+    """
+    Runs one benchmark scenario and collects its results.
+    """
+    def __init__(self, args: argparse.Namespace):
+        self.args = args
+        self.server: subprocess.Popen = None
+
+    def start_server(self):
+        command = [sys.executable, os.path.join(SRC_DIR, 'MQTTServer.py'), '--host', self.args.host, '--port', str(self.args.port), '--log-level', 'error']
+        command.extend(self.args.server_arg)
+        self.server = subprocess.Popen(command, stdout=subprocess.DEVNULL)
+
+    def stop_server(self):
+        if self.server is not None:
+            self.server.terminate()
+            self.server.wait()
+
+    async def wait_for_server(self):
+        deadline = time.monotonic() + 10
+
+        while True:
+            try:
+                _, writer = await asyncio.open_connection(self.args.host, self.args.port)
+                writer.close()
+                return
+            except OSError:
+                if time.monotonic() > deadline:
+                    raise
+                await asyncio.sleep(0.1)
+
+    def build_subscribers(self) -> list:
+        args = self.args
+        subscribers = []
+        wildcards = round(args.subscribers * args.wildcard_ratio)
+
+        for index in range(args.subscribers):
+            if index < wildcards:
+                topic_filter = f'{TOPIC_PREFIX}/+/data' if index % 2 == 0 else f'{TOPIC_PREFIX}/#'
+            else:
+                topic_filter = topic_for(index % args.topics)
+
+            subscribers.append(Subscriber(f'bench-sub-{index}', topic_filter, args.qos))
+
+        return subscribers
+
+    def expected_deliveries(self, subscribers: list) -> int:
+        args = self.args
+        expected = 0
+
+        for index in range(args.publishers):
+            topic = topic_for(index % args.topics)
+            matching = sum(1 for subscriber in subscribers if subscriber.topic_filter == topic or '+' in subscriber.topic_filter or '#' in subscriber.topic_filter)
+            expected += matching * args.messages
+
+        return expected
+
+    async def run(self) -> dict:
+        args = self.args
+
+        if not args.external:
+            self.start_server()
+
+        try:
+            await self.wait_for_server()
+            return await self.__run_scenario()
+        finally:
+            self.stop_server()
+
+    async def __run_scenario(self) -> dict:
+        args = self.args
+        subscribers = self.build_subscribers()
+        publishers = [Publisher(f'bench-pub-{index}', topic_for(index % args.topics), args.qos, args.payload_size, args.messages, args.rate, args.max_inflight)
+                      for index in range(args.publishers)]
+
+        for subscriber in subscribers:
+            await subscriber.connect(args.host, args.port)
+            await subscriber.subscribe()
+
+        for publisher in publishers:
+            await publisher.connect(args.host, args.port)
+
+        expected = self.expected_deliveries(subscribers)
+        counter = [expected]
+        done = asyncio.Event()
+        receivers = [asyncio.ensure_future(subscriber.run(done, counter)) for subscriber in subscribers]
+
+        started = time.perf_counter_ns()
+        acknowledgements = await asyncio.gather(*(publisher.run() for publisher in publishers))
+
+        # Stop waiting once deliveries stall, messages dropped by the broker never arrive
+        timed_out = False
+        while not done.is_set():
+            remaining = counter[0]
+            try:
+                await asyncio.wait_for(done.wait(), args.idle_timeout)
+            except asyncio.TimeoutError:
+                if counter[0] == remaining:
+                    timed_out = True
+                    break
+
+        for task in receivers + [task for task in acknowledgements if task is not None]:
+            task.cancel()
+
+        for connection in subscribers + publishers:
+            connection.close()
+
+        latencies = sorted(latency for subscriber in subscribers for latency in subscriber.latencies)
+        received = len(latencies)
+        finished = max((subscriber.last_received_at for subscriber in subscribers), default=started)
+        elapsed = max(finished - started, 1) / 1e9
+
+        return {
+            'published': args.publishers * args.messages,
+            'expected': expected,
+            'received': received,
+            'lost': expected - received,
+            'timed_out': timed_out,
+            'elapsed_s': round(elapsed, 6),
+            'throughput_msg_s': round(received / elapsed, 1),
+            'throughput_mb_s': round(received * args.payload_size / elapsed / 1e6, 3),
+            'latency_ms': {
+                'p50': round(percentile(latencies, 0.50) / 1e6, 3),
+                'p99': round(percentile(latencies, 0.99) / 1e6, 3),
+                'p999': round(percentile(latencies, 0.999) / 1e6, 3),
+                'max': round(latencies[-1] / 1e6, 3) if latencies else 0.0,
+            },
+        }
+
+def git_version() -> str:
+    try:
+        return subprocess.check_output(['git', 'describe', '--always', '--dirty'], cwd=SRC_DIR, stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+def main():
+    parser = argparse.ArgumentParser(description='MQTT broker load generator')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=18830)
+    parser.add_argument('--external', action='store_true', help='benchmark an already running broker instead of starting one')
+    parser.add_argument('--server-arg', action='append', default=[], help='extra MQTTServer argument, repeatable (e.g. --server-arg=--workers=4)')
+    parser.add_argument('--publishers', type=int, default=1)
+    parser.add_argument('--subscribers', type=int, default=1)
+    parser.add_argument('--messages', type=int, default=10000, help='messages per publisher')
+    parser.add_argument('--rate', type=float, default=0, help='messages per second per publisher, 0 for as fast as possible')
+    parser.add_argument('--qos', type=int, choices=[0, 1, 2], default=0)
+    parser.add_argument('--payload-size', type=int, default=64, help=f'payload bytes, at least {PAYLOAD_HEADER.size}')
+    parser.add_argument('--topics', type=int, default=1, help='distinct topics the publishers spread over')
+    parser.add_argument('--wildcard-ratio', type=float, default=0.0, help='fraction of subscribers using a wildcard filter')
+    parser.add_argument('--max-inflight', type=int, default=100, help='unacknowledged QoS 1 and 2 messages per publisher')
+    parser.add_argument('--idle-timeout', type=float, default=3, help='seconds without a delivery after which the run ends')
+    parser.add_argument('--json', action='store_true', help='print the result as JSON')
+    parser.add_argument('--output', help='append the JSON result as one line to this file')
+    args = parser.parse_args()
+
+    args.payload_size = max(args.payload_size, PAYLOAD_HEADER.size)
+
+    results = asyncio.run(LoadGenerator(args).run())
+
+    report = {
+        'version': git_version(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'python': platform.python_version(),
+        'config': {name: value for name, value in vars(args).items() if name not in ('json', 'output')},
+        'results': results,
+    }
+
+    if args.output:
+        with open(args.output, 'a') as file:
+            file.write(json.dumps(report) + '\n')
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        latency = results['latency_ms']
+        print(f"{results['received']}/{results['expected']} deliveries in {results['elapsed_s']:.3f}s"
+              f"{' (timed out)' if results['timed_out'] else ''}")
+        print(f"throughput: {results['throughput_msg_s']:.0f} msg/s, {results['throughput_mb_s']:.2f} MB/s")
+        print(f"latency: p50 {latency['p50']:.3f} ms, p99 {latency['p99']:.3f} ms, p999 {latency['p999']:.3f} ms, max {latency['max']:.3f} ms")
+
+    return 1 if results['timed_out'] else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,281 @@
+#!/usr/bin/env python3
+"""
+Microbenchmarks for the packet hot path: Messages encode/decode and topic matching.
+
+Each benchmark is timed with timeit, the best of several repeats is reported in
+nanoseconds per operation. Results can be saved as a JSON baseline and later runs
+compared against it, flagging benchmarks that got slower than the threshold.
+
+Examples:
+    python bench/microbench.py --output baseline.json
+    python bench/microbench.py --compare baseline.json --threshold 0.1
+    python bench/microbench.py --filter create
+"""
+import argparse
+import json
+import os
+import platform
+import re
+import struct
+import subprocess
+import sys
+import time
+import timeit
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+sys.path.insert(0, SRC_DIR)
+
+from FrameDecoder import FrameDecoder
+from Messages import (MQTTMessage, PublishMessage, ConnAckMessage, SubAckMessage, UnSubAckMessage, PingRespMessage, PubAckMessage,
+                      SubscribeMessage, UnsubscribeMessage, PACKET_TYPE_PUBACK, PACKET_TYPE_PUBREC, PACKET_TYPE_PUBREL, PACKET_TYPE_PUBCOMP,
+                      encode_ack, encode_remaining_length, encode_string)
+from SubscriberManager import Subscription, SubscriberManager
+
+DEFAULT_REPEAT = 5
+DEFAULT_MIN_TIME = 0.2
+DEFAULT_THRESHOLD = 0.10
+
+# name -> function building the zero-argument callable to time
+BENCHMARKS = {}
+
+def benchmark(name: str):
+    def register(setup):
+        BENCHMARKS[name] = setup
+        return setup
+
+    return register
+
+def packet(control_field: int, body: bytes) -> bytes:
+    return bytes((control_field,)) + encode_remaining_length(len(body)) + body
+
+def connect_packet() -> bytes:
+    body = encode_string('MQTT') + bytes((4, 0xC2)) + struct.pack('>H', 60) + encode_string('sensor-0042') + encode_string('admin') + encode_string('password')
+    return packet(0x10, body)
+
+def publish_packet(qos: int, payload_size: int) -> bytes:
+    body = encode_string('home/livingroom/temperature') + (struct.pack('>H', 42) if qos else b'') + b'x' * payload_size
+    return packet(0x30 | (qos << 1), body)
+
+# Sample packet of every type the broker parses
+PACKETS = {
+    'connect': connect_packet(),
+    'publish_qos0_16b': publish_packet(0, 16),
+    'publish_qos1_16b': publish_packet(1, 16),
+    'publish_qos1_4k': publish_packet(1, 4096),
+    'puback': encode_ack(PACKET_TYPE_PUBACK, 42),
+    'pubrec': encode_ack(PACKET_TYPE_PUBREC, 42),
+    'pubrel': encode_ack(PACKET_TYPE_PUBREL, 42),
+    'pubcomp': encode_ack(PACKET_TYPE_PUBCOMP, 42),
+    'subscribe': packet(0x82, struct.pack('>H', 7) + encode_string('home/+/temperature') + bytes((1,))),
+    'unsubscribe': packet(0xA2, struct.pack('>H', 8) + encode_string('home/+/temperature')),
+    'pingreq': bytes((0xC0, 0x00)),
+    'disconnect': bytes((0xE0, 0x00)),
+}
+
+for packet_name, packet_bytes in PACKETS.items():
+    @benchmark(f'create/{packet_name}')
+    def bench_create(packet_bytes=packet_bytes):
+        create = MQTTMessage.create
+        return lambda: create(packet_bytes)
+
+@benchmark('write/connack')
+def bench_write_connack():
+    message = ConnAckMessage(0, 0)
+    return message.write
+
+@benchmark('write/puback')
+def bench_write_puback():
+    message = PubAckMessage(MQTTMessage.create(PACKETS['publish_qos1_16b']))
+    return message.write
+
+@benchmark('write/suback')
+def bench_write_suback():
+    message = SubAckMessage(MQTTMessage.create(PACKETS['subscribe']))
+    return message.write
+
+@benchmark('write/unsuback')
+def bench_write_unsuback():
+    message = UnSubAckMessage(MQTTMessage.create(PACKETS['unsubscribe']))
+    return message.write
+
+@benchmark('write/pingresp')
+def bench_write_pingresp():
+    message = PingRespMessage(None)
+    return message.write
+
+@benchmark('encode/ack')
+def bench_encode_ack():
+    return lambda: encode_ack(PACKET_TYPE_PUBACK, 42)
+
+@benchmark('encode/publish_write_for_qos1')
+def bench_write_for():
+    message = MQTTMessage.create(PACKETS['publish_qos1_16b'])
+    return lambda: message.write_for(1, 42)
+
+for varint_length, remaining_length in ((1, 100), (2, 10000), (3, 1000000), (4, 100000000)):
+    @benchmark(f'varint/encode_{varint_length}b')
+    def bench_varint_encode(remaining_length=remaining_length):
+        return lambda: encode_remaining_length(remaining_length)
+
+    @benchmark(f'varint/decode_{varint_length}b')
+    def bench_varint_decode(remaining_length=remaining_length):
+        # Only the fixed header is complete, the decoder stops after reading the length
+        header = bytes((0x30,)) + encode_remaining_length(remaining_length)
+
+        def decode():
+            decoder = FrameDecoder()
+            for _ in decoder.feed(header):
+                pass
+
+        return decode
+
+def realistic_filters() -> list:
+    """
+    A mix of exact and wildcard filters as seen on a home automation broker.
+    """
+    rooms = ['livingroom', 'kitchen', 'bedroom', 'bathroom', 'garage', 'office', 'hall', 'attic']
+    sensors = ['temperature', 'humidity', 'pressure', 'motion', 'light']
+    filters = [f'home/{room}/{sensor}' for room in rooms for sensor in sensors]
+    filters += [f'home/+/{sensor}' for sensor in sensors]
+    filters += [f'home/{room}/#' for room in rooms]
+    filters += [f'devices/{device}/cmd' for device in range(100)]
+    filters += ['devices/+/status', '+/+/alarm', 'home/#', '#']
+    return filters
+
+TOPIC = 'home/kitchen/temperature'
+
+@benchmark('match/is_for_topic_all_filters')
+def bench_is_for_topic():
+    subscriptions = [Subscription(topic_filter, None) for topic_filter in realistic_filters()]
+    return lambda: [subscription for subscription in subscriptions if subscription.is_for_topic(TOPIC)]
+
+@benchmark('match/is_for_topic_exact')
+def bench_is_for_topic_exact():
+    subscription = Subscription(TOPIC, None)
+    return lambda: subscription.is_for_topic(TOPIC)
+
+@benchmark('match/is_for_topic_wildcard')
+def bench_is_for_topic_wildcard():
+    subscription = Subscription('home/+/temperature', None)
+    return lambda: subscription.is_for_topic(TOPIC)
+
+def subscriber_manager(cache_size: int) -> SubscriberManager:
+    manager = SubscriberManager(cache_size=cache_size)
+
+    for index, topic_filter in enumerate(realistic_filters()):
+        manager.subscribe(topic_filter, f'client-{index}')
+
+    return manager
+
+@benchmark('match/trie_uncached')
+def bench_trie_uncached():
+    manager = subscriber_manager(0)
+    return lambda: manager.match(TOPIC)
+
+@benchmark('match/trie_cached')
+def bench_trie_cached():
+    manager = subscriber_manager(1024)
+    manager.match(TOPIC)
+    return lambda: manager.match(TOPIC)
+
+def measure(function, repeat: int, min_time: float) -> dict:
+    timer = timeit.Timer(function)
+    number, elapsed = timer.autorange()
+
+    # Scale up so every repeat runs for at least min_time seconds
+    if elapsed < min_time:
+        number = max(1, int(number * min_time / max(elapsed, 1e-9)))
+
+    timings = [elapsed / number * 1e9 for elapsed in timer.repeat(repeat, number)]
+    timings.sort()
+
+    return {
+        'ns_per_op': round(timings[0], 2),
+        'median_ns': round(timings[len(timings) // 2], 2),
+        'loops': number,
+    }
+
+def run(pattern: str, repeat: int, min_time: float) -> dict:
+    results = {}
+    expression = re.compile(pattern) if pattern else None
+
+    for name, setup in BENCHMARKS.items():
+        if expression is not None and not expression.search(name):
+            continue
+
+        results[name] = measure(setup(), repeat, min_time)
+        print(f'{name:40} {results[name]["ns_per_op"]:12.1f} ns', file=sys.stderr)
+
+    return results
+
+def compare(results: dict, baseline: dict, threshold: float) -> list:
+    """
+    Print the change of every benchmark against the baseline.
+
+    Returns:
+    - list: The names of the benchmarks slower than the baseline by more than the threshold.
+    """
+    regressions = []
+
+    print(f'{"benchmark":40} {"baseline":>12} {"current":>12} {"change":>8}')
+    for name, result in results.items():
+        previous = baseline.get(name)
+        if previous is None:
+            print(f'{name:40} {"-":>12} {result["ns_per_op"]:12.1f} {"new":>8}')
+            continue
+
+        change = result['ns_per_op'] / previous['ns_per_op'] - 1
+        flag = ''
+        if change > threshold:
+            regressions.append(name)
+            flag = '  REGRESSION'
+
+        print(f'{name:40} {previous["ns_per_op"]:12.1f} {result["ns_per_op"]:12.1f} {change:+8.1%}{flag}')
+
+    return regressions
+
+def git_version() -> str:
+    try:
+        return subprocess.check_output(['git', 'describe', '--always', '--dirty'], cwd=SRC_DIR, stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+def main():
+    parser = argparse.ArgumentParser(description='Microbenchmarks for Messages and topic matching')
+    parser.add_argument('--filter', help='only run benchmarks whose name matches this regular expression')
+    parser.add_argument('--repeat', type=int, default=DEFAULT_REPEAT)
+    parser.add_argument('--min-time', type=float, default=DEFAULT_MIN_TIME, help='minimum seconds per repeat')
+    parser.add_argument('--output', help='write the results as a JSON baseline')
+    parser.add_argument('--compare', metavar='BASELINE', help='compare against a JSON baseline and exit 1 on regressions')
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD, help='relative slowdown counted as a regression')
+    parser.add_argument('--list', action='store_true', help='list the benchmarks and exit')
+    args = parser.parse_args()
+
+    if args.list:
+        print('\n'.join(BENCHMARKS))
+        return 0
+
+    results = run(args.filter, args.repeat, args.min_time)
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump({
+                'version': git_version(),
+                'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+                'python': platform.python_version(),
+                'results': results,
+            }, file, indent=2)
+
+    if args.compare:
+        with open(args.compare) as file:
+            baseline = json.load(file)['results']
+
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print(f'{len(regressions)} benchmarks regressed by more than {args.threshold:.0%}: {", ".join(regressions)}')
+            return 1
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
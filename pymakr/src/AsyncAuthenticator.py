@@ -0,0 +1,207 @@
+import asyncio
+import hashlib
+import hmac
+import os
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from Authenticator import Authenticator
+from CredentialStore import CredentialBackend, DEFAULT_SCHEME, hash_password, verify_password
+from Logger import Logger
+
+EXECUTOR_THREAD = 'thread'
+EXECUTOR_PROCESS = 'process'
+
+DEFAULT_AUTH_WORKERS = 4
+DEFAULT_CACHE_SIZE = 10000
+DEFAULT_CACHE_TTL = 300
+DEFAULT_MAX_PENDING = 1000
+
+class CredentialCache:
+    """
+    Bounded LRU cache of recently verified credentials.
+
+    Only a keyed HMAC of the username and password is kept, never the password,
+    and the key is random per process. Entries expire after `ttl` seconds so a
+    changed or removed password stops being accepted without a restart.
+    """
+    entries: OrderedDict
+    max_size: int
+    ttl: float
+    hits: int = 0
+    misses: int = 0
+
+    def __init__(self, max_size: int = DEFAULT_CACHE_SIZE, ttl: float = DEFAULT_CACHE_TTL):
+        self.entries = OrderedDict()
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.__key = os.urandom(32)
+
+    def digest(self, username: str, password: str) -> bytes:
+        return hmac.new(self.__key, f'{username}\0{password}'.encode(), hashlib.sha256).digest()
+
+    def contains(self, username: str, digest: bytes) -> bool:
+        entry = self.entries.get(username)
+
+        if entry is None or entry[1] < time.monotonic() or not hmac.compare_digest(entry[0], digest):
+            self.misses += 1
+            return False
+
+        self.entries.move_to_end(username)
+        self.hits += 1
+        return True
+
+    def put(self, username: str, digest: bytes):
+        if self.max_size <= 0:
+            return
+
+        self.entries.pop(username, None)
+
+        while len(self.entries) >= self.max_size:
+            self.entries.popitem(last=False)
+
+        self.entries[username] = (digest, time.monotonic() + self.ttl)
+
+    def invalidate(self, username: str = None):
+        if username is None:
+            self.entries.clear()
+        else:
+            self.entries.pop(username, None)
+
+class AsyncAuthenticator(Authenticator):
+    """
+    Verifies salted password hashes from a credential backend without blocking the event loop.
+
+    The backend lookup and the hash verification run in a thread pool, or the hash
+    verification in a process pool. Concurrent attempts with the same credentials
+    share one verification, and credentials verified recently are answered from a
+    cache, so a reconnect storm hashes every distinct password once.
+
+    Parameters:
+    - backend (CredentialBackend): Where the password hashes are looked up.
+    - executor (str): EXECUTOR_THREAD or EXECUTOR_PROCESS for the hash verification.
+    - workers (int): Size of the pools.
+    - cache_size (int): Verified credentials kept, 0 disables the cache.
+    - cache_ttl (float): Seconds a verified credential is trusted without hashing it again.
+    - max_pending (int): Verifications in progress before new attempts are refused.
+    - allow_anonymous (bool): Accept clients that send no credentials, refused by default.
+    """
+    backend: CredentialBackend
+    cache: CredentialCache
+    pending: dict
+    refused: int = 0
+
+    def __init__(self, backend: CredentialBackend, logger: Logger = None, executor: str = EXECUTOR_THREAD, workers: int = DEFAULT_AUTH_WORKERS,
+                 cache_size: int = DEFAULT_CACHE_SIZE, cache_ttl: float = DEFAULT_CACHE_TTL, max_pending: int = DEFAULT_MAX_PENDING,
+                 allow_anonymous: bool = False):
+        super().__init__(None, logger)
+        self.allow_anonymous = allow_anonymous
+        self.backend = backend
+        self.executor = executor
+        self.workers = workers
+        self.cache = CredentialCache(cache_size, cache_ttl)
+        self.max_pending = max_pending
+        # (username, digest) -> callbacks waiting for the verification
+        self.pending = {}
+        self.refused = 0
+        # Created on first use, so the authenticator can be built before the worker processes fork
+        self.__lookup_executor = None
+        self.__hash_executor = None
+        self.__dummy_hash = None
+
+    def authenticate(self, username, password):
+        """
+        Verify the credentials on the calling thread, blocking until the hash is computed.
+        """
+        digest = self.cache.digest(username, password)
+        if self.cache.contains(username, digest):
+            return True
+
+        authenticated = verify_password(password, self.backend.lookup(username))
+        if authenticated:
+            self.cache.put(username, digest)
+
+        return authenticated
+
+    def verify(self, username, password, callback):
+        digest = self.cache.digest(username, password)
+
+        if self.cache.contains(username, digest):
+            callback(True)
+            return
+
+        key = (username, digest)
+        waiting = self.pending.get(key)
+
+        if waiting is not None:
+            waiting.append(callback)
+            return
+
+        if len(self.pending) >= self.max_pending:
+            self.refused += 1
+            self.logger.warning('Too many authentications in progress, refusing %s', username)
+            callback(False)
+            return
+
+        self.logger.debug('Authenticating user: %s', username)
+        self.pending[key] = [callback]
+
+        task = asyncio.get_running_loop().create_task(self.__verify(username, password))
+        task.add_done_callback(lambda task: self.__verified(key, task))
+
+    def close(self):
+        for executor in (self.__lookup_executor, self.__hash_executor):
+            if executor is not None:
+                executor.shutdown(wait=False, cancel_futures=True)
+
+        self.__lookup_executor = self.__hash_executor = None
+        self.backend.close()
+
+    async def __verify(self, username, password) -> bool:
+        loop = asyncio.get_running_loop()
+        lookup_executor, hash_executor = self.__executors()
+
+        encoded = await loop.run_in_executor(lookup_executor, self.backend.lookup, username)
+
+        if encoded is None:
+            # Spend the same time on unknown users, so they cannot be told apart from wrong passwords
+            if self.__dummy_hash is None:
+                self.__dummy_hash = await loop.run_in_executor(hash_executor, hash_password, '', DEFAULT_SCHEME)
+
+            await loop.run_in_executor(hash_executor, verify_password, password, self.__dummy_hash)
+            return False
+
+        return await loop.run_in_executor(hash_executor, verify_password, password, encoded)
+
+    def __verified(self, key: tuple, task: asyncio.Task):
+        callbacks = self.pending.pop(key, ())
+        username, digest = key
+
+        try:
+            authenticated = task.result()
+        except Exception as e:
+            self.logger.error('Error verifying the credentials of %s: %s', username, e)
+            authenticated = False
+
+        if authenticated:
+            self.cache.put(username, digest)
+
+        for callback in callbacks:
+            try:
+                callback(authenticated)
+            except Exception as e:
+                self.logger.error('Error in authentication callback: %s', e)
+
+    def __executors(self) -> tuple:
+        if self.__lookup_executor is None:
+            self.__lookup_executor = ThreadPoolExecutor(self.workers, thread_name_prefix='auth')
+
+            if self.executor == EXECUTOR_PROCESS:
+                self.__hash_executor = ProcessPoolExecutor(self.workers)
+            else:
+                self.__hash_executor = self.__lookup_executor
+
+        return self.__lookup_executor, self.__hash_executor
@@ -2,11 +2,22 @@ from Logger import Logger
 
 class Authenticator:
     logger: Logger
+    # Accept a CONNECT without user name and password
+    allow_anonymous: bool = True
 
     def __init__(self, user_db, logger: Logger = None):
         self.user_db = user_db
         self.logger = logger or Logger()
 
     def authenticate(self, username, password):
-        self.logger.info(f'Authenticating user: {username}')
+        self.logger.debug('Authenticating user: %s', username)
         return self.user_db.get(username) == password
+
+    def verify(self, username, password, callback):
+        """
+        Verify the credentials and call `callback(authenticated)` with the result.
+
+        The in-memory user database answers right away. Authenticators with slow
+        password hashes override this to verify off the event loop and call back later.
+        """
+        callback(self.authenticate(username, password))
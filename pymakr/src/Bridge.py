@@ -0,0 +1,163 @@
+import asyncio
+import os
+import socket
+import struct
+from collections import OrderedDict
+
+from Broker import Broker
+from Client import Client
+from Logger import Logger
+from Messages import MQTTMessage, PublishMessage, encode_string, encode_remaining_length
+from PeerLink import PeerLinkProtocol, PeerManager
+from ProtocolHandler import ProtocolHandler
+from RetainedStore import RetainedStore
+from SubscriberManager import SubscriberManager
+
+PACKET_TYPE_BRIDGE = 15
+
+DEFAULT_MAX_HOPS = 8
+DEFAULT_SEEN_CACHE_SIZE = 65536
+DEFAULT_RETRY_INTERVAL = 5
+
+class BridgeEnvelopeMessage(MQTTMessage):
+    """
+    A PUBLISH forwarded between bridged brokers.
+
+    The envelope uses the packet type reserved by MQTT 3.1.1 and carries the node the
+    message entered the cluster on, a per-node sequence number and the number of hops
+    taken so far. The payload is the forwarded PUBLISH frame.
+    """
+    __slots__ = ('origin_node', 'sequence', 'hops')
+
+    def __init__(self, msg: bytes = None):
+        super().__init__(PACKET_TYPE_BRIDGE, msg)
+
+    def read_variable_header(self):
+        self.origin_node = self.read_string()
+        self.sequence = (self.read_short() << 16) | self.read_short()
+        self.hops = self.read_byte()
+
+    def handle_message(self, handler: ProtocolHandler, client: Client):
+        handler.handle_bridge_envelope(client, self)
+
+class BridgeManager(PeerManager):
+    """
+    Peer manager for brokers bridged over TCP in an arbitrary topology.
+
+    Filters are propagated transitively with split horizon. Loops are prevented by
+    never sending a message back on the link it arrived on, by dropping messages whose
+    (origin node, sequence) was already seen, and by a hop limit.
+    """
+    node_id: str
+    max_hops: int
+    seen: OrderedDict
+
+    def __init__(self, topic_manager: SubscriberManager, node_id: str = None, logger: Logger = None,
+                 max_hops: int = DEFAULT_MAX_HOPS, seen_cache_size: int = DEFAULT_SEEN_CACHE_SIZE, retained_store: RetainedStore = None):
+        super().__init__(topic_manager, logger, transitive=True, retained_store=retained_store)
+        self.node_id = node_id or f'{socket.gethostname()}:{os.getpid()}'
+        self.max_hops = max_hops
+        self.seen = OrderedDict()
+        self.seen_cache_size = seen_cache_size
+        self.__node_segment = encode_string(self.node_id)
+        self.__sequence = 0
+
+    def forward(self, link: Client, publish_message: PublishMessage):
+        if publish_message.origin is link:
+            return
+
+        route = publish_message.route
+        if route is None:
+            self.__sequence = (self.__sequence + 1) & 0xFFFFFFFF
+            route = publish_message.route = (self.node_id, self.__sequence, 0)
+
+        origin_node, sequence, hops = route
+        if hops >= self.max_hops:
+            return
+
+        qos = publish_message.qos
+        packet_id = link.next_packet_id() if qos > 0 else None
+        parts = publish_message.write_for(qos, packet_id, publish_message.retain)
+
+        node_segment = self.__node_segment if origin_node == self.node_id else encode_string(origin_node)
+        envelope = node_segment + struct.pack('>IB', sequence, hops + 1)
+
+        length = len(envelope)
+        for part in parts:
+            length += len(part)
+
+        link.send_parts([bytes((PACKET_TYPE_BRIDGE << 4,)) + encode_remaining_length(length) + envelope] + parts, qos)
+
+    def handle(self, client: Client, msg: bytes):
+        if msg[0] >> 4 != PACKET_TYPE_BRIDGE:
+            super().handle(client, msg)
+            return
+
+        try:
+            BridgeEnvelopeMessage(msg).handle_message(self, client)
+        except Exception as e:
+            self.logger.error('Error in bridge link %s: %s', client.client_name, e)
+
+    def handle_bridge_envelope(self, client: Client, envelope: BridgeEnvelopeMessage):
+        key = (envelope.origin_node, envelope.sequence)
+
+        if envelope.origin_node == self.node_id or key in self.seen or envelope.hops > self.max_hops:
+            return
+
+        self.seen[key] = True
+        if len(self.seen) > self.seen_cache_size:
+            del self.seen[next(iter(self.seen))]
+
+        publish_message = PublishMessage(envelope.payload)
+        publish_message.origin = client
+        publish_message.route = (envelope.origin_node, envelope.sequence, envelope.hops)
+
+        if publish_message.retain and self.retained_store is not None:
+            self.retained_store.store(publish_message)
+
+        self.topic_manager.publish(publish_message.topic_name, publish_message)
+
+class Bridge:
+    """
+    Connects a broker to other broker nodes over persistent TCP links.
+    """
+    manager: BridgeManager
+    logger: Logger
+
+    def __init__(self, broker: Broker, node_id: str = None, logger: Logger = None, max_hops: int = DEFAULT_MAX_HOPS,
+                 retry_interval: float = DEFAULT_RETRY_INTERVAL):
+        self.logger = logger or broker.logger
+        self.manager = BridgeManager(broker.topic_manager, node_id, self.logger, max_hops, retained_store=broker.retained_store)
+        self.retry_interval = retry_interval
+        self.tasks = []
+
+    async def listen(self, host: str, port: int):
+        loop = asyncio.get_running_loop()
+        server = await loop.create_server(lambda: PeerLinkProtocol(self.manager, None, self.logger), host=host, port=port)
+        self.logger.info('Bridge %s listening on %s:%s', self.manager.node_id, host, port)
+        return server
+
+    def connect(self, host: str, port: int) -> asyncio.Task:
+        task = asyncio.ensure_future(self.__keep_connected(host, port))
+        self.tasks.append(task)
+        return task
+
+    async def __keep_connected(self, host: str, port: int):
+        loop = asyncio.get_running_loop()
+        link_name = f'bridge-{host}:{port}'
+
+        while True:
+            try:
+                _, protocol = await loop.create_connection(lambda: PeerLinkProtocol(self.manager, link_name, self.logger), host, port)
+                await protocol.closed
+            except OSError as e:
+                self.logger.warning('Bridge link to %s:%s failed: %s', host, port, e)
+
+            await asyncio.sleep(self.retry_interval)
+
+    def close(self):
+        for task in self.tasks:
+            task.cancel()
+
+        for link in list(self.manager.links):
+            link.close()
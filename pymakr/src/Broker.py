@@ -3,23 +3,49 @@ from Client import Client
 from Logger import Logger
 from Authenticator import Authenticator
 from ClientManager import ClientManager
-from ProtocolHandlerV311 import ProtocolHandlerV311
+from ProtocolHandlerV5 import ProtocolHandlerV5, DEFAULT_TOPIC_ALIAS_MAXIMUM
 from SubscriberManager import SubscriberManager
+from FlowController import FlowController
+from RetainedStore import RetainedStore, DEFAULT_MAX_BYTES as DEFAULT_RETAINED_MAX_BYTES
+from SessionStore import SessionStore
+from Metrics import Metrics
+from StageTimings import StageTimings
+from TopicAcl import TopicAcl
+from InflightWindow import DEFAULT_RECEIVE_MAXIMUM, DEFAULT_RETRY_INTERVAL
 
 class Broker:
     logger: Logger
     client_manager: ClientManager
     topic_manager: SubscriberManager
-    protocol_handler: ProtocolHandlerV311
+    protocol_handler: ProtocolHandlerV5
     authenticator: Authenticator
+    flow_controller: FlowController
+    retained_store: RetainedStore
+    session_store: SessionStore
+    metrics: Metrics
+    timings: StageTimings
+    acl: TopicAcl
+    # Largest packet accepted from clients, 0 for no limit
+    max_packet_size: int = 0
 
-    def __init__(self, authenticator: Authenticator = None, logger: Logger = None):
+    def __init__(self, authenticator: Authenticator = None, logger: Logger = None, backpressure: bool = False, retained_max_bytes: int = DEFAULT_RETAINED_MAX_BYTES, session_store: SessionStore = None, receive_maximum: int = DEFAULT_RECEIVE_MAXIMUM, retry_interval: float = DEFAULT_RETRY_INTERVAL, acl: TopicAcl = None, max_packet_size: int = 0, topic_alias_maximum: int = DEFAULT_TOPIC_ALIAS_MAXIMUM):
         self.logger = logger or Logger(True)
         self.client_manager = ClientManager(self.logger)
         self.topic_manager = SubscriberManager(self.logger)
         self.authenticator = authenticator or Authenticator({"admin": "password"}, self.logger)
-        self.protocol_handler = ProtocolHandlerV311(self.authenticator, self.topic_manager, self.client_manager, self.logger)
+        self.flow_controller = FlowController(self.logger) if backpressure else None
+        self.retained_store = RetainedStore(retained_max_bytes, self.logger)
+        self.session_store = session_store
+        self.acl = acl
+        self.max_packet_size = max_packet_size
+
+        if self.session_store is not None:
+            self.session_store.restore(self.topic_manager)
+
+        self.timings = StageTimings()
+        self.metrics = Metrics(self.client_manager, self.topic_manager, self.retained_store, self.session_store, logger=self.logger)
+        self.protocol_handler = ProtocolHandlerV5(self.authenticator, self.topic_manager, self.client_manager, self.logger, self.flow_controller, self.retained_store, self.session_store, receive_maximum, retry_interval, self.metrics, self.timings, self.acl, max_packet_size, topic_alias_maximum)
 
     async def handle(self, client: Client, message: MQTTMessage):
-        self.logger.info(f'Message from {client}')
+        self.logger.debug('Message from %s', client)
         await message.handle_message(self.protocol_handler, client)
@@ -18,6 +18,24 @@ class Client:
     client_name: str = ''
     client_settings: ClientSettings = None
     logger: Logger = None
+    on_drained = None
+    is_peer: bool = False
+    session = None
+    inflight = None
+    awaiting_release = None
+    will = None
+    # Packets received while the CONNECT is being authenticated, handled once it is accepted
+    pending_packets: list = None
+    # ClientAcl with the topics this client may use, None when there is no ACL
+    acl = None
+    # Metrics counting the PUBLISH packets written to this connection, None when they are not counted
+    metrics = None
+    # ConnectionV5 with the properties and topic aliases of an MQTT 5 connection, None for MQTT 3.1.1
+    v5 = None
+    # Keep-alive timeout and the tick of the last packet received, in timer wheel ticks
+    keep_alive_ticks: int = 0
+    last_activity: int = 0
+    __packet_id: int = 0
 
     def __init__(self, client_name: str, client_settings: ClientSettings, logger: Logger = None):
         self.client_name = client_name
@@ -30,5 +48,30 @@ class Client:
     def send(self, msg: bytes):
         raise NotImplementedError
 
+    def send_parts(self, parts: list, qos: int = 0):
+        self.send(b''.join(parts))
+
+    def deliver(self, publish_message, qos: int = 0):
+        publish_message.send_to_subscriber(self, qos)
+
+    def queue_stats(self) -> dict:
+        return {}
+
+    def is_congested(self) -> bool:
+        return self.inflight is not None and self.inflight.is_congested()
+
+    def pause_reading(self):
+        pass
+
+    def resume_reading(self):
+        pass
+
+    def next_packet_id(self) -> int:
+        self.__packet_id = self.__packet_id % 0xFFFF + 1
+        return self.__packet_id
+
+    def abort(self):
+        self.close()
+
     def close(self):
         raise NotImplementedError
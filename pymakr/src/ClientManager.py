@@ -26,13 +26,16 @@ class ClientManager:
             del self.clients[client.client_name]
             client.close()
 
+    def queue_stats(self) -> dict:
+        return {client_name: client.queue_stats() for client_name, client in self.clients.items()}
+
     def cleanup_clients(self):
         try:
             for client_name in list(self.clients.keys()):
                 client = self.clients[client_name]
                 if not client.is_ready():
-                    self.logger.warning(f'Removing closed client: {client}')
+                    self.logger.warning('Removing closed client: %s', client)
                     self.remove_client(client)
                     client.close()
         except Exception as e:
-            self.logger.error(f'Error cleaning up clients: {e}')
+            self.logger.error('Error cleaning up clients: %s', e)
@@ -0,0 +1,280 @@
+#!/usr/bin/env python3
+import argparse
+import base64
+import getpass
+import hashlib
+import hmac
+import os
+import sqlite3
+import sys
+import threading
+
+SCHEME_SCRYPT = 'scrypt'
+SCHEME_PBKDF2 = 'pbkdf2-sha256'
+# hashlib.scrypt needs OpenSSL 1.1 or newer
+DEFAULT_SCHEME = SCHEME_SCRYPT if hasattr(hashlib, 'scrypt') else SCHEME_PBKDF2
+
+# About 75 ms and 16 MiB per scrypt hash, about 350 ms per PBKDF2 hash
+SCRYPT_LOG_N = 14
+SCRYPT_R = 8
+SCRYPT_P = 1
+PBKDF2_ITERATIONS = 600000
+SALT_BYTES = 16
+HASH_BYTES = 32
+
+def b64encode(data: bytes) -> str:
+    return base64.b64encode(data).decode().rstrip('=')
+
+def b64decode(text: str) -> bytes:
+    return base64.b64decode(text + '=' * (-len(text) % 4))
+
+def scrypt_memory(log_n: int, r: int) -> int:
+    # scrypt needs 128 * r * n bytes, leave room for OpenSSL's own overhead
+    return 256 * r << log_n
+
+def hash_password(password: str, scheme: str = DEFAULT_SCHEME) -> str:
+    """
+    Hash a password with a random salt.
+
+    Parameters:
+    - password (str): The plaintext password.
+    - scheme (str): SCHEME_SCRYPT or SCHEME_PBKDF2.
+
+    Returns:
+    - str: The encoded hash, e.g. '$scrypt$ln=14,r=8,p=1$<salt>$<hash>', holding
+      everything needed to verify the password later.
+    """
+    salt = os.urandom(SALT_BYTES)
+
+    if scheme == SCHEME_SCRYPT:
+        digest = hashlib.scrypt(password.encode(), salt=salt, n=1 << SCRYPT_LOG_N, r=SCRYPT_R, p=SCRYPT_P, maxmem=scrypt_memory(SCRYPT_LOG_N, SCRYPT_R), dklen=HASH_BYTES)
+        return f'${SCHEME_SCRYPT}$ln={SCRYPT_LOG_N},r={SCRYPT_R},p={SCRYPT_P}${b64encode(salt)}${b64encode(digest)}'
+    elif scheme == SCHEME_PBKDF2:
+        digest = hashlib.pbkdf2_hmac('sha256', password.encode(), salt, PBKDF2_ITERATIONS, HASH_BYTES)
+        return f'${SCHEME_PBKDF2}${PBKDF2_ITERATIONS}${b64encode(salt)}${b64encode(digest)}'
+
+    raise ValueError(f'Unknown password hash scheme: {scheme}')
+
+def verify_password(password: str, encoded: str) -> bool:
+    """
+    Check a password against a hash produced by hash_password, in constant time.
+
+    Slow by design, call it off the event loop.
+    """
+    if password is None or not encoded:
+        return False
+
+    try:
+        _, scheme, parameters, salt, expected = encoded.split('$')
+        salt = b64decode(salt)
+        expected = b64decode(expected)
+
+        if scheme == SCHEME_SCRYPT:
+            options = dict(option.split('=') for option in parameters.split(','))
+            log_n, r, p = int(options['ln']), int(options['r']), int(options['p'])
+            digest = hashlib.scrypt(password.encode(), salt=salt, n=1 << log_n, r=r, p=p, maxmem=scrypt_memory(log_n, r), dklen=len(expected))
+        elif scheme == SCHEME_PBKDF2:
+            digest = hashlib.pbkdf2_hmac('sha256', password.encode(), salt, int(parameters), len(expected))
+        else:
+            return False
+    except (ValueError, KeyError):
+        return False
+
+    return hmac.compare_digest(digest, expected)
+
+class CredentialBackend:
+    """
+    Where the password hashes are looked up.
+
+    Lookups may block on disk or a database, the async authenticator runs them in
+    its executor rather than on the event loop.
+    """
+    def lookup(self, username: str) -> str:
+        """
+        Returns:
+        - str: The encoded password hash of the user, None for an unknown user.
+        """
+        raise NotImplementedError
+
+    def set_password(self, username: str, encoded: str):
+        raise NotImplementedError
+
+    def remove(self, username: str) -> bool:
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+class DictBackend(CredentialBackend):
+    """
+    Password hashes held in memory, username -> encoded hash.
+    """
+    def __init__(self, users: dict = None):
+        self.users = dict(users or {})
+
+    def lookup(self, username: str) -> str:
+        return self.users.get(username)
+
+    def set_password(self, username: str, encoded: str):
+        self.users[username] = encoded
+
+    def remove(self, username: str) -> bool:
+        return self.users.pop(username, None) is not None
+
+class FileBackend(CredentialBackend):
+    """
+    A password file with one 'username:encoded hash' line per user, '#' starts a comment.
+
+    The file is read again when its modification time changes, so users can be added
+    or removed while the broker is running.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self.users = {}
+        self.__mtime = None
+        self.__lock = threading.Lock()
+
+    def lookup(self, username: str) -> str:
+        self.__reload()
+        return self.users.get(username)
+
+    def set_password(self, username: str, encoded: str):
+        with self.__lock:
+            self.__load()
+            self.users[username] = encoded
+            self.__save()
+
+    def remove(self, username: str) -> bool:
+        with self.__lock:
+            self.__load()
+            removed = self.users.pop(username, None) is not None
+            self.__save()
+
+        return removed
+
+    def __reload(self):
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            mtime = None
+
+        if mtime != self.__mtime:
+            with self.__lock:
+                self.__load()
+
+    def __load(self):
+        users = {}
+
+        try:
+            self.__mtime = os.stat(self.path).st_mtime_ns
+
+            with open(self.path) as file:
+                for line in file:
+                    line = line.strip()
+                    if not line or line.startswith('#'):
+                        continue
+
+                    username, _, encoded = line.partition(':')
+                    users[username] = encoded
+        except FileNotFoundError:
+            self.__mtime = None
+
+        self.users = users
+
+    def __save(self):
+        # Replace the file in one step so a running broker never reads half of it
+        temporary_path = self.path + '.tmp'
+
+        with open(temporary_path, 'w') as file:
+            os.fchmod(file.fileno(), 0o600)
+            for username, encoded in sorted(self.users.items()):
+                file.write(f'{username}:{encoded}\n')
+
+        os.replace(temporary_path, self.path)
+
+class SQLiteBackend(CredentialBackend):
+    """
+    Password hashes in an SQLite database, in a 'users' table created on first use.
+
+    Every thread gets its own connection, as the lookups run in an executor.
+    """
+    def __init__(self, path: str, table: str = 'users'):
+        if not table.isidentifier():
+            raise ValueError(f'Invalid table name: {table}')
+
+        self.path = path
+        self.table = table
+        self.__local = threading.local()
+        self.__connections = []
+        self.__lock = threading.Lock()
+
+        self.__connection().execute(f'CREATE TABLE IF NOT EXISTS {table} (username TEXT PRIMARY KEY, password_hash TEXT NOT NULL)')
+        self.__connection().commit()
+
+    def lookup(self, username: str) -> str:
+        row = self.__connection().execute(f'SELECT password_hash FROM {self.table} WHERE username = ?', (username,)).fetchone()
+        return row[0] if row is not None else None
+
+    def set_password(self, username: str, encoded: str):
+        connection = self.__connection()
+        connection.execute(f'INSERT OR REPLACE INTO {self.table} (username, password_hash) VALUES (?, ?)', (username, encoded))
+        connection.commit()
+
+    def remove(self, username: str) -> bool:
+        connection = self.__connection()
+        removed = connection.execute(f'DELETE FROM {self.table} WHERE username = ?', (username,)).rowcount > 0
+        connection.commit()
+        return removed
+
+    def close(self):
+        with self.__lock:
+            for connection in self.__connections:
+                connection.close()
+
+            self.__connections = []
+
+    def __connection(self) -> sqlite3.Connection:
+        connection = getattr(self.__local, 'connection', None)
+
+        if connection is None:
+            # The connection is only used by this thread, close() may run on another one
+            connection = self.__local.connection = sqlite3.connect(self.path, check_same_thread=False)
+
+            with self.__lock:
+                self.__connections.append(connection)
+
+        return connection
+
+def main():
+    parser = argparse.ArgumentParser(description='Manage the users of a password file or SQLite credential database')
+    parser.add_argument('path', help='password file, or SQLite database with --sqlite')
+    parser.add_argument('username')
+    parser.add_argument('--sqlite', action='store_true', help='the path is an SQLite database')
+    parser.add_argument('--delete', action='store_true', help='remove the user')
+    parser.add_argument('--scheme', choices=[SCHEME_SCRYPT, SCHEME_PBKDF2], default=DEFAULT_SCHEME)
+    parser.add_argument('--password', help='the password, prompted for when not given')
+    args = parser.parse_args()
+
+    backend = SQLiteBackend(args.path) if args.sqlite else FileBackend(args.path)
+
+    try:
+        if args.delete:
+            if not backend.remove(args.username):
+                print(f'No user {args.username}', file=sys.stderr)
+                return 1
+            return 0
+
+        password = args.password
+        if password is None:
+            password = getpass.getpass()
+            if password != getpass.getpass('Repeat password: '):
+                print('Passwords do not match', file=sys.stderr)
+                return 1
+
+        backend.set_password(args.username, hash_password(password, args.scheme))
+        return 0
+    finally:
+        backend.close()
+
+if __name__ == "__main__":
+    sys.exit(main())
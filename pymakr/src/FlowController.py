@@ -0,0 +1,79 @@
+from Client import Client
+from Logger import Logger
+
+class FlowController:
+    """
+    Propagates subscriber backpressure to the publishing connections.
+
+    A publisher whose message was queued behind a congested subscriber stops being
+    read from until every subscriber it is waiting on has drained its queue.
+
+    A paused client cannot have its PUBACK and PUBCOMP packets read, so its own
+    in-flight window cannot drain while it is paused. A publisher that is itself
+    congested is therefore never paused, and a subscriber that is paused does not
+    pause others: its congestion may only last because it is paused, and waiting on
+    it could close a cycle of clients that never resume.
+    """
+    blocking: dict
+    blocked_by: dict
+    logger: Logger
+
+    def __init__(self, logger: Logger = None):
+        # publisher -> subscribers it waits on
+        self.blocking = {}
+        # subscriber -> publishers waiting on it
+        self.blocked_by = {}
+        self.logger = logger or Logger()
+
+    def check(self, publisher: Client, subscriptions):
+        if publisher.is_congested():
+            return
+
+        for subscription in subscriptions:
+            subscriber = subscription.client
+
+            if subscriber is publisher or subscriber in self.blocking or not subscriber.is_congested():
+                continue
+
+            subscribers = self.blocking.get(publisher)
+            if subscribers is None:
+                subscribers = self.blocking[publisher] = set()
+                self.logger.warning('Pausing publisher %s, subscribers are congested', publisher.client_name)
+                publisher.pause_reading()
+
+            subscribers.add(subscriber)
+
+            publishers = self.blocked_by.get(subscriber)
+            if publishers is None:
+                publishers = self.blocked_by[subscriber] = set()
+                subscriber.on_drained = self.on_drained
+
+            publishers.add(publisher)
+
+    def on_drained(self, subscriber: Client):
+        subscriber.on_drained = None
+
+        for publisher in self.blocked_by.pop(subscriber, ()):
+            subscribers = self.blocking.get(publisher)
+            if subscribers is None:
+                continue
+
+            subscribers.discard(subscriber)
+            if not subscribers:
+                del self.blocking[publisher]
+                self.logger.info('Resuming publisher %s', publisher.client_name)
+                publisher.resume_reading()
+
+    def remove_client(self, client: Client):
+        self.on_drained(client)
+
+        for subscriber in self.blocking.pop(client, ()):
+            publishers = self.blocked_by.get(subscriber)
+            if publishers is not None:
+                publishers.discard(client)
+                if not publishers:
+                    del self.blocked_by[subscriber]
+                    subscriber.on_drained = None
+
+    def paused_count(self) -> int:
+        return len(self.blocking)
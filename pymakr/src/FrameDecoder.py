@@ -0,0 +1,106 @@
+MAX_REMAINING_LENGTH = 268435455
+MAX_REMAINING_LENGTH_BYTES = 4
+
+class PacketTooLargeError(ValueError):
+    pass
+
+class FrameDecoder:
+    """
+    Incremental MQTT frame decoder for a single connection.
+
+    Raw TCP chunks are fed in as they arrive. Every complete packet found in the
+    chunk is yielded as its own frame and an incomplete trailing packet is carried
+    over to the next call. The remaining length of a partial packet is decoded only
+    once, so a large payload arriving in many small segments is not re-parsed.
+
+    Frames lying entirely within a received chunk are yielded as memoryview slices
+    of that chunk without copying. Frames assembled from several chunks are copied
+    out of the receive buffer once, as the buffer is reused for the next chunk.
+    """
+    buffer: bytearray
+    max_packet_size: int
+
+    def __init__(self, max_packet_size: int = 0):
+        self.buffer = bytearray()
+        self.max_packet_size = max_packet_size
+        self.__frame_length = 0
+
+    def feed(self, data: bytes):
+        """
+        Feed a received chunk and yield every complete frame it finishes.
+
+        Parameters:
+        - data (bytes): The raw bytes received from the transport.
+
+        Yields:
+        - bytes | memoryview: One complete MQTT packet (fixed header included) per frame.
+        """
+        if self.buffer:
+            self.buffer += data
+            buf = self.buffer
+            in_place = False
+        else:
+            # Nothing carried over, parse the chunk in place
+            buf = data
+            in_place = isinstance(data, bytes)
+
+        view = memoryview(buf)
+        end = len(buf)
+        offset = 0
+
+        while offset < end:
+            frame_length = self.__frame_length
+
+            if not frame_length:
+                frame_length = self.__read_frame_length(view, offset, end)
+
+                if not frame_length:
+                    break
+
+            if offset + frame_length > end:
+                # Remember the length so the header is not decoded again
+                self.__frame_length = frame_length
+                break
+
+            self.__frame_length = 0
+            frame = view[offset:offset + frame_length]
+            yield frame if in_place else bytes(frame)
+            offset += frame_length
+
+        if offset == end:
+            self.buffer = bytearray()
+        elif offset or buf is not self.buffer:
+            # Only the incomplete tail is kept
+            self.buffer = bytearray(view[offset:])
+
+    def reset(self):
+        self.buffer = bytearray()
+        self.__frame_length = 0
+
+    def __read_frame_length(self, view: memoryview, offset: int, end: int) -> int:
+        remaining_length = 0
+        multiplier = 1
+        position = offset + 1
+
+        while True:
+            if position >= end:
+                return 0
+
+            encoded_byte = view[position]
+            remaining_length += (encoded_byte & 127) * multiplier
+            position += 1
+
+            if (encoded_byte & 128) == 0:
+                break
+
+            if position - offset - 1 >= MAX_REMAINING_LENGTH_BYTES:
+                raise ValueError('Malformed remaining length')
+
+            multiplier *= 128
+
+        frame_length = position - offset + remaining_length
+
+        if self.max_packet_size and frame_length > self.max_packet_size:
+            raise PacketTooLargeError(f'Packet size {frame_length} exceeds maximum {self.max_packet_size}')
+
+        return frame_length
@@ -0,0 +1,244 @@
+from collections import deque
+
+from Client import Client
+from Logger import Logger
+from Messages import encode_ack, PACKET_TYPE_PUBREL
+
+try:
+    from time import monotonic as clock
+except ImportError:
+    from time import time as clock
+
+DEFAULT_RECEIVE_MAXIMUM = 32
+DEFAULT_RETRY_INTERVAL = 10
+DEFAULT_MAX_PENDING = 1000
+DEFAULT_HARD_LIMIT_PENDING = 10000
+DEFAULT_MAX_AWAITING_RELEASE = 1000
+DEFAULT_RELEASE_TIMEOUT = 300
+
+class InflightMessage:
+    __slots__ = ('publish_message', 'qos', 'retain', 'sent_at', 'released')
+
+    def __init__(self, publish_message, qos: int, retain: bool, sent_at: float):
+        self.publish_message = publish_message
+        self.qos = qos
+        self.retain = retain
+        self.sent_at = sent_at
+        # QoS 2 only: PUBREC was received and PUBREL sent, waiting for PUBCOMP
+        self.released = False
+
+class InflightWindow:
+    """
+    Tracks the QoS 1 and 2 messages delivered to a client that are not yet acknowledged.
+
+    At most `receive_maximum` messages are in flight, further messages wait in a
+    pending queue until an acknowledgement frees a slot. Pending messages are never
+    dropped: past `max_pending` the client reports itself congested so publishers
+    can be paused, and past `hard_limit_pending` sending fails and the client is to
+    be disconnected, its session keeping what was held. The in-flight messages are
+    kept in a dict in the order they were last sent, so an acknowledgement is a
+    single lookup and a retransmission pass stops at the first message that is not
+    yet due.
+
+    With `retry_on_timeout` off (MQTT 5, which only allows resending when a session
+    is resumed) retransmit() does nothing; unacknowledged messages are drained into
+    the session when the connection is lost and delivered again on reconnect.
+
+    A client is added to the `retry_clients` set shared by the windows of a protocol
+    handler when its first message goes in flight, so the periodic retransmission
+    pass only visits clients that have something to resend.
+    """
+    __slots__ = ('messages', 'pending', 'receive_maximum', 'max_pending', 'hard_limit_pending', 'retry_on_timeout', 'retry_clients', 'retransmitted', 'dropped', 'logger')
+
+    def __init__(self, receive_maximum: int = DEFAULT_RECEIVE_MAXIMUM, max_pending: int = DEFAULT_MAX_PENDING,
+                 hard_limit_pending: int = DEFAULT_HARD_LIMIT_PENDING, retry_on_timeout: bool = True, retry_clients: set = None, logger: Logger = None):
+        # packet id -> InflightMessage, oldest transmission first
+        self.messages = {}
+        # (publish message, qos, retain) waiting for a free slot
+        self.pending = deque()
+        self.receive_maximum = receive_maximum
+        self.max_pending = max_pending
+        self.hard_limit_pending = max(hard_limit_pending, max_pending)
+        self.retry_on_timeout = retry_on_timeout
+        self.retry_clients = retry_clients
+        self.retransmitted = 0
+        self.dropped = 0
+        self.logger = logger or Logger()
+
+    def send(self, client: Client, publish_message, qos: int, retain: bool = False) -> bool:
+        """
+        Transmit the message when a slot is free, otherwise hold it until one is.
+
+        Returns:
+        - bool: False when the pending queue reached its hard limit and the message was not accepted.
+        """
+        if len(self.messages) < self.receive_maximum:
+            self.__transmit(client, publish_message, qos, retain)
+            return True
+
+        if len(self.pending) >= self.hard_limit_pending:
+            self.dropped += 1
+            return False
+
+        self.pending.append((publish_message, qos, retain))
+        return True
+
+    def is_congested(self) -> bool:
+        return len(self.pending) >= self.max_pending
+
+    def acknowledge(self, client: Client, packet_id: int):
+        """
+        Complete the delivery with the given packet id on PUBACK or PUBCOMP and send pending messages into the freed slot.
+
+        Returns:
+        - PublishMessage: The delivered message, None when no message with this packet id was in flight.
+        """
+        inflight = self.messages.pop(packet_id, None)
+        if inflight is None:
+            return None
+
+        pending = self.pending
+        if pending:
+            while pending and len(self.messages) < self.receive_maximum:
+                self.__transmit(client, *pending.popleft())
+
+            # Publishers paused on this client wait until it is no longer congested
+            if client.on_drained is not None and not client.is_congested():
+                client.on_drained(client)
+
+        return inflight.publish_message
+
+    def release(self, client: Client, packet_id: int) -> bool:
+        """
+        Answer a PUBREC with PUBREL, the message then waits for PUBCOMP in the same slot.
+
+        Returns:
+        - bool: False when no QoS 2 message with this packet id was in flight.
+        """
+        inflight = self.messages.get(packet_id)
+        if inflight is None or inflight.qos != 2:
+            return False
+
+        del self.messages[packet_id]
+        inflight.released = True
+        inflight.sent_at = clock()
+        self.messages[packet_id] = inflight
+
+        client.send(encode_ack(PACKET_TYPE_PUBREL, packet_id))
+        return True
+
+    def retransmit(self, client: Client, retry_interval: float, now: float = None):
+        """
+        Send the messages unacknowledged for longer than `retry_interval` again with DUP
+        set, or the PUBREL of QoS 2 messages waiting for PUBCOMP.
+        """
+        if not self.retry_on_timeout or not self.messages or client.is_congested():
+            return
+
+        now = clock() if now is None else now
+        deadline = now - retry_interval
+
+        due = []
+        for packet_id, inflight in self.messages.items():
+            if inflight.sent_at > deadline:
+                break
+            due.append(packet_id)
+
+        for packet_id in due:
+            # Move the message to the end to keep the dict ordered by transmission time
+            inflight = self.messages.pop(packet_id)
+            inflight.sent_at = now
+            self.messages[packet_id] = inflight
+            self.retransmitted += 1
+
+            if inflight.released:
+                client.send(encode_ack(PACKET_TYPE_PUBREL, packet_id))
+            else:
+                inflight.publish_message.transmit(client, inflight.qos, packet_id, inflight.retain, True)
+
+    def drain(self) -> list:
+        """
+        Remove and return every unacknowledged and pending message as (publish message, qos).
+
+        Released QoS 2 messages already reached the client and are left out.
+        """
+        messages = [(inflight.publish_message, inflight.qos) for inflight in self.messages.values() if not inflight.released]
+        messages.extend((publish_message, qos) for publish_message, qos, _ in self.pending)
+        self.clear()
+        return messages
+
+    def clear(self):
+        self.messages.clear()
+        self.pending.clear()
+
+    def stats(self) -> dict:
+        return {
+            'inflight': len(self.messages),
+            'pending': len(self.pending),
+            'retransmitted': self.retransmitted,
+            'dropped': self.dropped,
+        }
+
+    def __transmit(self, client: Client, publish_message, qos: int, retain: bool):
+        if not self.messages and self.retry_on_timeout and self.retry_clients is not None:
+            self.retry_clients.add(client)
+
+        packet_id = client.next_packet_id()
+        while packet_id in self.messages:
+            packet_id = client.next_packet_id()
+
+        self.messages[packet_id] = InflightMessage(publish_message, qos, retain, clock())
+        publish_message.transmit(client, qos, packet_id, retain)
+
+class AwaitingRelease:
+    """
+    The packet ids of QoS 2 messages received from a client that wait for its PUBREL.
+
+    A message is published once when it first arrives; a retransmission of a packet id
+    still in this set is only acknowledged again. The set is bounded, and ids whose
+    PUBREL never arrives are expired oldest first.
+    """
+    __slots__ = ('packet_ids', 'max_size', 'logger')
+
+    def __init__(self, max_size: int = DEFAULT_MAX_AWAITING_RELEASE, logger: Logger = None):
+        # packet id -> time received, oldest first
+        self.packet_ids = {}
+        self.max_size = max_size
+        self.logger = logger or Logger()
+
+    def add(self, packet_id: int) -> bool:
+        """
+        Returns:
+        - bool: False when the packet id is already waiting for PUBREL, i.e. the message is a duplicate.
+        """
+        if packet_id in self.packet_ids:
+            return False
+
+        if len(self.packet_ids) >= self.max_size:
+            oldest = next(iter(self.packet_ids))
+            self.logger.warning('Too many QoS 2 messages waiting for PUBREL, forgetting packet id %d', oldest)
+            del self.packet_ids[oldest]
+
+        self.packet_ids[packet_id] = clock()
+        return True
+
+    def release(self, packet_id: int) -> bool:
+        return self.packet_ids.pop(packet_id, None) is not None
+
+    def expire(self, timeout: float, now: float = None) -> int:
+        now = clock() if now is None else now
+        deadline = now - timeout
+        expired = []
+
+        for packet_id, received_at in self.packet_ids.items():
+            if received_at > deadline:
+                break
+            expired.append(packet_id)
+
+        for packet_id in expired:
+            del self.packet_ids[packet_id]
+
+        return len(expired)
+
+    def __len__(self) -> int:
+        return len(self.packet_ids)
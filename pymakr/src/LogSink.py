@@ -0,0 +1,102 @@
+import atexit
+import json
+import queue
+import sys
+import threading
+import time
+
+from Logger import Logger, LEVEL_NAMES, format_record
+
+LEVEL_LABELS = {level: name.upper() for name, level in LEVEL_NAMES.items()}
+
+FORMAT_TEXT = 'text'
+FORMAT_JSON = 'json'
+
+DEFAULT_MAX_RECORDS = 10000
+
+class ThreadedSink:
+    """
+    Log sink that formats and writes records on a background thread.
+
+    The logging call only timestamps the record and puts it on a queue, the
+    message arguments are formatted by the writer thread. When the queue is full
+    records are dropped and counted instead of blocking the event loop.
+
+    Parameters:
+    - path (str): The file to append to, stdout when None.
+    - format (str): 'text' for colored lines, 'json' for one JSON object per line.
+    - max_records (int): The maximum number of records waiting to be written.
+    """
+    def __init__(self, path: str = None, format: str = FORMAT_TEXT, max_records: int = DEFAULT_MAX_RECORDS):
+        self.path = path
+        self.format = format
+        self.records = queue.Queue(max_records)
+        self.dropped = 0
+        # Producers on any thread count drops, the writer thread reports and resets them
+        self.dropped_lock = threading.Lock()
+        self.stream = open(path, 'a', buffering=1) if path else sys.stdout
+        self.thread = threading.Thread(target=self.__run, name='log-sink', daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def __call__(self, level: int, flags: str, message: str, args: tuple):
+        try:
+            self.records.put_nowait((time.time(), level, flags, message, args))
+        except queue.Full:
+            with self.dropped_lock:
+                self.dropped += 1
+
+    def close(self):
+        if self.thread.is_alive():
+            self.records.put(None)
+            self.thread.join()
+
+        if self.path:
+            self.stream.close()
+
+    def __format(self, created: float, level: int, flags: str, message: str, args: tuple) -> str:
+        if self.format == FORMAT_JSON:
+            return json.dumps({
+                'time': round(created, 6),
+                'level': LEVEL_LABELS.get(level, str(level)),
+                'message': message % args if args else message,
+            }, default=str)
+
+        timestamp = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(created))
+
+        if self.path:
+            # No color codes in files
+            return f'{timestamp} {LEVEL_LABELS.get(level, level)} {message % args if args else message}'
+
+        return f'{timestamp} {format_record(flags, message, args)}'
+
+    def __run(self):
+        while True:
+            record = self.records.get()
+            if record is None:
+                break
+
+            lines = []
+            # Write everything that queued up while waiting in one go
+            while record:
+                try:
+                    lines.append(self.__format(*record))
+                except Exception as e:
+                    lines.append(f'{Logger.ERROR}Error formatting log record {record[3]!r}: {e}{Logger.CLEAR}')
+
+                try:
+                    record = self.records.get_nowait()
+                except queue.Empty:
+                    record = ()
+
+            with self.dropped_lock:
+                dropped, self.dropped = self.dropped, 0
+
+            if dropped:
+                lines.append(f'{dropped} log records dropped')
+
+            self.stream.write('\n'.join(lines) + '\n')
+            self.stream.flush()
+
+            if record is None:
+                break
@@ -2,8 +2,39 @@
 
 import sys
 
+LEVEL_DEBUG = 10
+LEVEL_INFO = 20
+LEVEL_WARNING = 30
+LEVEL_ERROR = 40
+LEVEL_OFF = 100
+
+LEVEL_NAMES = {
+    'debug': LEVEL_DEBUG,
+    'info': LEVEL_INFO,
+    'warning': LEVEL_WARNING,
+    'error': LEVEL_ERROR,
+    'off': LEVEL_OFF,
+}
+
+def format_record(flags: str, message: str, args: tuple) -> str:
+    if args:
+        message = message % args
+
+    return f'{flags}{message}{Logger.CLEAR}'
+
+def print_record(level: int, flags: str, message: str, args: tuple):
+    print(format_record(flags, message, args))
 
 class Logger:
+    """
+    Leveled logger with lazy formatting.
+
+    Messages take %-style arguments that are only formatted when the level is
+    enabled, so a disabled debug call costs one comparison. Records are handed to
+    a sink, `print` by default, as (level, flags, message, args); a sink running on
+    another thread (see LogSink) moves the formatting and the output off the event
+    loop entirely.
+    """
     HEADER = '\033[95m'
     SEND = '\033[94m'
     RECEIVE = '\033[96m'
@@ -14,32 +45,51 @@ class Logger:
     BOLD = '\033[1m'
     UNDERLINE = '\033[4m'
 
-    __debug: bool = True
+    level: int = LEVEL_DEBUG
+
+    def __init__(self, debug: bool = True, level: int = None, sink = None):
+        if level is None:
+            level = LEVEL_DEBUG if debug else LEVEL_OFF
+
+        self.level = level
+        self.sink = sink or print_record
+
+    def is_enabled(self, level: int) -> bool:
+        return level >= self.level
 
-    def __init__(self, debug: bool = True):
-        self.__debug = debug
+    def log(self, level: int, flags: str, message: str, *args):
+        if level >= self.level:
+            self.sink(level, flags, message, args)
 
-    def log(self, flags, message):
-        if self.__debug:
-            print(f'{flags}{message}{Logger.CLEAR}')
+    def debug(self, message: str, *args):
+        if LEVEL_DEBUG >= self.level:
+            self.sink(LEVEL_DEBUG, Logger.HEADER, message, args)
 
-    def debug(self, message):
-        self.log(Logger.HEADER, message)
+    def info(self, message: str, *args):
+        if LEVEL_INFO >= self.level:
+            self.sink(LEVEL_INFO, Logger.INFO, message, args)
 
-    def info(self, message):
-        self.log(Logger.INFO, message)
+    def warning(self, message: str, *args):
+        if LEVEL_WARNING >= self.level:
+            self.sink(LEVEL_WARNING, Logger.WARNING, message, args)
 
-    def warning(self, message):
-        self.log(Logger.WARNING, message)
+    def error(self, message: str, *args, exception=None):
+        if LEVEL_ERROR >= self.level:
+            self.sink(LEVEL_ERROR, Logger.ERROR, message, args)
 
-    def error(self, message, exception=None):
-        self.log(Logger.ERROR, message)
+            if exception is not None:
+                print_exception = getattr(sys, 'print_exception', None)
 
-        if exception is not None:
-            sys.print_exception(exception)
+                if print_exception is not None:
+                    print_exception(exception)
+                else:
+                    import traceback
+                    traceback.print_exception(exception)
 
-    def send(self, message):
-        self.log(Logger.SEND, message)
+    def send(self, message: str, *args):
+        if LEVEL_DEBUG >= self.level:
+            self.sink(LEVEL_DEBUG, Logger.SEND, message, args)
 
-    def receive(self, message):
-        self.log(Logger.RECEIVE, message)
+    def receive(self, message: str, *args):
+        if LEVEL_DEBUG >= self.level:
+            self.sink(LEVEL_DEBUG, Logger.RECEIVE, message, args)
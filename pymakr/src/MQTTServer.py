@@ -1,17 +1,104 @@
 #!/usr/bin/env python3
+import argparse
 import asyncio
-import sys
+import signal
+import socket
+from AsyncAuthenticator import AsyncAuthenticator, EXECUTOR_PROCESS, EXECUTOR_THREAD, DEFAULT_AUTH_WORKERS, DEFAULT_CACHE_SIZE, DEFAULT_CACHE_TTL
 from Authenticator import Authenticator
 from Broker import Broker
 from Client import Client, ClientSettings
-from Logger import Logger
+from CredentialStore import FileBackend, SQLiteBackend
+from FrameDecoder import FrameDecoder, PacketTooLargeError
+from InflightWindow import DEFAULT_RECEIVE_MAXIMUM, DEFAULT_RETRY_INTERVAL
+from Logger import Logger, LEVEL_NAMES
+from Messages import PACKET_TYPE_PUBLISH
+from MessagesV5 import REASON_PACKET_TOO_LARGE
+from LogSink import ThreadedSink, FORMAT_TEXT, FORMAT_JSON
+from OutboundQueue import OutboundQueue, OutboundQueueLimits
+from Profiler import Profiler, MODE_CPROFILE, MODE_SAMPLER, DEFAULT_PROFILE_SECONDS
+from ProtocolHandlerV5 import DEFAULT_TOPIC_ALIAS_MAXIMUM
+from SessionStore import SessionStore
+from TopicAcl import TopicAcl
+from StageTimings import StageTimings, clock_ns, STAGE_WRITE
 
 DEFAULT_PORT = 1883
+DEFAULT_WRITE_BUFFER_HIGH = 64 * 1024
+DEFAULT_BACKLOG = 1024
+TICK_INTERVAL = 1
+
+LOOP_AUTO = 'auto'
+LOOP_ASYNCIO = 'asyncio'
+LOOP_UVLOOP = 'uvloop'
+
+def install_event_loop(name: str = LOOP_AUTO, logger: Logger = None) -> str:
+    """
+    Select the event loop implementation used by asyncio.run.
+
+    uvloop is an optional dependency, `auto` uses it when it is installed and
+    falls back to the default asyncio loop otherwise.
+
+    Parameters:
+    - name (str): One of LOOP_AUTO, LOOP_ASYNCIO or LOOP_UVLOOP.
+
+    Returns:
+    - str: The loop that was installed, LOOP_ASYNCIO or LOOP_UVLOOP.
+    """
+    if name == LOOP_ASYNCIO:
+        return LOOP_ASYNCIO
+
+    try:
+        import uvloop
+    except ImportError:
+        if name == LOOP_UVLOOP:
+            raise
+
+        if logger is not None:
+            logger.debug('uvloop is not installed, using the asyncio event loop')
+        return LOOP_ASYNCIO
+
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    return LOOP_UVLOOP
+
+class SocketOptions:
+    """
+    Tuning of the listening socket and the accepted connections.
+
+    The buffer sizes are set on the listening socket, accepted connections
+    inherit them. None keeps the kernel default.
+    """
+    nodelay: bool
+    backlog: int
+    sndbuf: int
+    rcvbuf: int
+
+    def __init__(self, nodelay: bool = True, backlog: int = DEFAULT_BACKLOG, sndbuf: int = None, rcvbuf: int = None):
+        self.nodelay = nodelay
+        self.backlog = backlog
+        self.sndbuf = sndbuf
+        self.rcvbuf = rcvbuf
+
+    def apply_listening(self, sock: socket.socket):
+        if self.sndbuf:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.sndbuf)
+
+        if self.rcvbuf:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.rcvbuf)
+
+    def apply_connection(self, sock: socket.socket):
+        # Acks and small publishes must not wait for Nagle's algorithm
+        if self.nodelay and sock is not None and sock.family in (socket.AF_INET, socket.AF_INET6):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
 
 class MQTTClient(Client):
-    def __init__(self, client_name: str, client_settings: ClientSettings, transport: asyncio.BaseTransport, logger: Logger = None):
+    queue: OutboundQueue
+    writing_paused: bool = False
+    timings: StageTimings = None
+
+    def __init__(self, client_name: str, client_settings: ClientSettings, transport: asyncio.BaseTransport, logger: Logger = None, queue_limits: OutboundQueueLimits = None):
         super().__init__(client_name, client_settings, logger)
         self.transport = transport
+        self.queue = OutboundQueue(queue_limits)
+        self.writing_paused = False
 
     def is_ready(self):
         try:
@@ -21,10 +108,73 @@ class MQTTClient(Client):
             return False
 
     def send(self, msg: bytes):
+        # Control packets are never dropped, queue them like QoS 1 messages
+        self.send_parts([msg], 1)
+
+    def send_parts(self, parts: list, qos: int = 0):
+        if self.writing_paused or len(self.queue):
+            if not self.queue.push(parts, qos):
+                self.logger.warning('Outbound queue limit exceeded, disconnecting %s', self.client_name)
+                self.abort()
+            return
+
+        try:
+            if self.timings is not None and self.timings.enabled:
+                started = clock_ns()
+                self.transport.writelines(parts)
+                self.timings.record(parts[0][0] >> 4, STAGE_WRITE, clock_ns() - started)
+            else:
+                self.transport.writelines(parts)
+        except OSError as e:
+            self.logger.error('Error sending message to client: %s', e)
+            return
+
+        if self.metrics is not None and parts[0][0] >> 4 == PACKET_TYPE_PUBLISH:
+            self.metrics.publish_written(parts)
+
+    def pause_writing(self):
+        self.writing_paused = True
+
+    def resume_writing(self):
+        self.writing_paused = False
+
         try:
-            self.transport.write(msg)
+            # Writing may pause the transport again before the queue is empty
+            while len(self.queue) and not self.writing_paused:
+                parts = self.queue.pop()
+                self.transport.writelines(parts)
+
+                if self.metrics is not None and parts[0][0] >> 4 == PACKET_TYPE_PUBLISH:
+                    self.metrics.publish_written(parts)
         except OSError as e:
-            self.logger.error(f'Error sending message to client: {e}')
+            # The rest of the queue can never be written, the client must not stay connected waiting for it
+            self.logger.error('Error sending message to %s, disconnecting: %s', self.client_name, e)
+            self.abort()
+            return
+
+        if not len(self.queue) and self.on_drained is not None and not self.is_congested():
+            self.on_drained(self)
+
+    def is_congested(self) -> bool:
+        return (self.writing_paused and len(self.queue) > 0) or super().is_congested()
+
+    def pause_reading(self):
+        if not self.transport.is_closing():
+            self.transport.pause_reading()
+
+    def resume_reading(self):
+        if not self.transport.is_closing():
+            self.transport.resume_reading()
+
+    def queue_stats(self) -> dict:
+        stats = self.queue.stats()
+        stats['transport_bytes'] = self.transport.get_write_buffer_size()
+        stats['paused'] = self.writing_paused
+        return stats
+
+    def abort(self):
+        self.queue.clear()
+        self.transport.abort()
 
     def close(self):
         self.logger.info('Closing client connection')
@@ -32,14 +182,19 @@ class MQTTClient(Client):
         try:
             self.transport.close()
         except OSError as e:
-            self.logger.error(f'Error closing client connection: {e}')
+            self.logger.error('Error closing client connection: %s', e)
 
 class MQTTBrokerProtocol(asyncio.Protocol):
     client: MQTTClient = None
 
-    def __init__(self, broker: Broker, logger: Logger):
+    def __init__(self, broker: Broker, logger: Logger, queue_limits: OutboundQueueLimits = None, write_buffer_high: int = DEFAULT_WRITE_BUFFER_HIGH, socket_options: SocketOptions = None):
         self.broker = broker
         self.logger = logger
+        self.queue_limits = queue_limits
+        self.write_buffer_high = write_buffer_high
+        self.socket_options = socket_options
+        # Oversized packets are refused from their fixed header, before their body is buffered
+        self.decoder = FrameDecoder(broker.max_packet_size)
 
     def connection_made(self, transport):
         peer_name = transport.get_extra_info('peername')
@@ -47,10 +202,20 @@ class MQTTBrokerProtocol(asyncio.Protocol):
         client = self.broker.client_manager.get_client(peer_name)
 
         if client is None:
-            client = MQTTClient(peer_name, None, transport, self.logger)
+            client = MQTTClient(peer_name, None, transport, self.logger, self.queue_limits)
+            client.timings = self.broker.timings
+            client.metrics = self.broker.metrics
             self.broker.client_manager.add_client(client)
 
-        self.logger.info(f'Connection from {peer_name}')
+        transport.set_write_buffer_limits(high=self.write_buffer_high)
+
+        if self.socket_options is not None:
+            try:
+                self.socket_options.apply_connection(transport.get_extra_info('socket'))
+            except OSError as e:
+                self.logger.warning('Error setting socket options for %s: %s', peer_name, e)
+
+        self.logger.info('Connection from %s', peer_name)
 
         self.client = client
 
@@ -58,21 +223,43 @@ class MQTTBrokerProtocol(asyncio.Protocol):
         if not self.client:
             raise ValueError('Client not initialized')
 
-        self.logger.info(f'Data received: {data!r}')
+        self.logger.debug('Received %d bytes from %s', len(data), self.client.client_name)
+        self.broker.metrics.bytes_received += len(data)
 
-        self.broker.protocol_handler.handle(self.client, data)
+        try:
+            for frame in self.decoder.feed(data):
+                self.broker.protocol_handler.handle(self.client, frame)
+        except PacketTooLargeError as e:
+            self.logger.warning('Refusing packet from %s: %s', self.client.client_name, e)
+            self.broker.protocol_handler.disconnect(self.client, REASON_PACKET_TOO_LARGE)
+        except ValueError as e:
+            self.logger.error('Error decoding data from %s: %s', self.client.client_name, e)
+            self.client.close()
+
+    def pause_writing(self):
+        self.client.pause_writing()
+
+    def resume_writing(self):
+        self.client.resume_writing()
 
     def connection_lost(self, exc):
-        self.logger.info(
-            f'The client {self.client.client_name} closed the connection {exc}')
-        self.broker.client_manager.remove_client(self.client)
+        self.logger.info('The client %s closed the connection %s', self.client.client_name, exc)
+        self.broker.protocol_handler.handle_connection_lost(self.client)
 
 class MQTTServer:
-    def __init__(self, host: str = '0.0.0.0', port: int = DEFAULT_PORT, broker: Broker = None, logger: Logger = None):
+    def __init__(self, host: str = '0.0.0.0', port: int = DEFAULT_PORT, broker: Broker = None, logger: Logger = None, queue_limits: OutboundQueueLimits = None, metrics_port: int = None, profiler: Profiler = None, profile_seconds: float = DEFAULT_PROFILE_SECONDS, profile_mode: str = MODE_CPROFILE, socket_options: SocketOptions = None, worker: int = None):
         self.broker = broker
         self.host = host
         self.port = port
+        self.metrics_port = metrics_port
         self.logger = logger or Logger(True)
+        self.queue_limits = queue_limits or OutboundQueueLimits()
+        self.profiler = profiler or Profiler(logger=self.logger)
+        self.profile_seconds = profile_seconds
+        self.profile_mode = profile_mode
+        self.socket_options = socket_options or SocketOptions()
+        # Index of the worker process, None when the broker runs in a single process
+        self.worker = worker
 
     async def start_server(self):
         # Get a reference to the event loop as we plan to use
@@ -80,35 +267,216 @@ class MQTTServer:
         loop = asyncio.get_running_loop()
 
         server = await loop.create_server(
-            lambda: MQTTBrokerProtocol(self.broker, self.logger),
+            lambda: MQTTBrokerProtocol(self.broker, self.logger, self.queue_limits, socket_options=self.socket_options),
             host=self.host,
             port=self.port,
-            reuse_port=True)
+            reuse_port=True,
+            backlog=self.socket_options.backlog,
+            start_serving=False)
+
+        for sock in server.sockets:
+            self.socket_options.apply_listening(sock)
 
-        async with server:
-            self.logger.info(f'Starting MQTT Broker on {self.host}:{self.port}')
-            await server.serve_forever()
+        session_store = self.broker.session_store
+        if session_store is not None:
+            # The session records of one loop iteration are written together
+            session_store.schedule_flush = loop.call_soon
+
+        tick_task = loop.create_task(self.tick())
+        metrics_server = None
+
+        # SIGUSR1 profiles the running broker, SIGUSR2 toggles the stage timings
+        if hasattr(signal, 'SIGUSR1'):
+            loop.add_signal_handler(signal.SIGUSR1, self.start_profile)
+            loop.add_signal_handler(signal.SIGUSR2, self.toggle_stage_timings)
+
+        if self.metrics_port is not None:
+            # Every worker has its own counters, so each serves them on its own port instead of sharing one
+            metrics_port = self.metrics_port + (self.worker or 0)
+            metrics_server = await asyncio.start_server(self.serve_metrics, self.host, metrics_port)
+            self.logger.info('Serving Prometheus metrics on %s:%s', self.host, metrics_port)
+
+        try:
+            async with server:
+                self.logger.info('Starting MQTT Broker on %s:%s (%s event loop)', self.host, self.port, type(loop).__module__.split('.')[0])
+                await server.serve_forever()
+        finally:
+            tick_task.cancel()
+
+            if metrics_server is not None:
+                metrics_server.close()
+
+            if session_store is not None:
+                session_store.close()
+
+    async def tick(self):
+        loop = asyncio.get_running_loop()
+
+        while True:
+            started = loop.time()
+            await asyncio.sleep(TICK_INTERVAL)
+            self.broker.metrics.loop_lag = max(0.0, loop.time() - started - TICK_INTERVAL)
+            self.broker.protocol_handler.tick()
+
+            session_store = self.broker.session_store
+            if session_store is not None and session_store.needs_compaction():
+                loop.create_task(self.compact_sessions(session_store))
+
+    async def compact_sessions(self, session_store: SessionStore):
+        """
+        Rewrite the session file on a worker thread, the snapshot is taken on the event loop.
+        """
+        records = session_store.begin_compaction()
+        replaced = False
+
+        try:
+            replaced = await asyncio.get_running_loop().run_in_executor(None, session_store.write_compaction, records)
+        finally:
+            session_store.end_compaction(replaced)
+
+    def start_profile(self):
+        self.profiler.start(self.profile_seconds, self.profile_mode)
+
+    def toggle_stage_timings(self):
+        """
+        Start recording the stage timings, or log them and stop when they are being recorded.
+        """
+        timings = self.broker.timings
+
+        if timings.enabled:
+            timings.disable()
+            self.logger.info('Stage timings:\n%s', timings.format())
+        else:
+            timings.reset()
+            timings.enable()
+            self.logger.info('Recording stage timings')
+
+    async def serve_metrics(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """
+        Answer any HTTP request with the metrics in the Prometheus text format.
+        """
+        try:
+            # Skip the request line and the headers
+            while (await reader.readline()).strip():
+                pass
+
+            labels = {'worker': self.worker} if self.worker is not None else None
+            body = self.broker.metrics.prometheus(labels).encode()
+            writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\nContent-Length: %d\r\nConnection: close\r\n\r\n' % len(body) + body)
+            await writer.drain()
+        except (OSError, asyncio.IncompleteReadError) as e:
+            self.logger.warning('Error serving metrics: %s', e)
+        finally:
+            writer.close()
 
 
 def main():
-    host = '0.0.0.0'
-    port = 1883
+    parser = argparse.ArgumentParser(description='MQTT broker')
+    parser.add_argument('mode', nargs='?', choices=['auth'], help='enable authentication')
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--workers', type=int, default=1, help='number of broker processes sharing the port')
+    parser.add_argument('--node-id', help='bridge node id, defaults to hostname:pid')
+    parser.add_argument('--bridge-listen', metavar='HOST:PORT', help='accept bridge links from other brokers')
+    parser.add_argument('--bridge-peer', metavar='HOST:PORT', action='append', default=[], help='keep a bridge link to another broker')
+    parser.add_argument('--receive-maximum', type=int, default=DEFAULT_RECEIVE_MAXIMUM, help='unacknowledged QoS 1 and 2 deliveries allowed per client')
+    parser.add_argument('--max-packet-size', type=int, default=0, help='largest packet accepted from clients in bytes, 0 for no limit')
+    parser.add_argument('--topic-alias-maximum', type=int, default=DEFAULT_TOPIC_ALIAS_MAXIMUM, help='MQTT 5 topic aliases per client and direction, 0 disables them')
+    parser.add_argument('--backpressure', action='store_true', help='stop reading from publishers while their subscribers are congested')
+    parser.add_argument('--retry-interval', type=float, default=DEFAULT_RETRY_INTERVAL, help='seconds before an unacknowledged delivery is sent again')
+    parser.add_argument('--metrics-port', type=int, help='serve Prometheus metrics over HTTP on this port, with --workers worker N serves them on this port + N')
+    parser.add_argument('--log-level', choices=list(LEVEL_NAMES), default='info')
+    parser.add_argument('--log-file', help='append the log to this file instead of stdout')
+    parser.add_argument('--log-format', choices=[FORMAT_TEXT, FORMAT_JSON], default=FORMAT_TEXT)
+    parser.add_argument('--session-file', help='keep clean_session=0 sessions in this file across restarts')
+    parser.add_argument('--password-file', help='authenticate against the hashed passwords in this file, see CredentialStore.py')
+    parser.add_argument('--auth-db', help='authenticate against the hashed passwords in this SQLite database')
+    parser.add_argument('--auth-executor', choices=[EXECUTOR_THREAD, EXECUTOR_PROCESS], default=EXECUTOR_THREAD, help='where password hashes are verified')
+    parser.add_argument('--auth-workers', type=int, default=DEFAULT_AUTH_WORKERS)
+    parser.add_argument('--auth-cache-size', type=int, default=DEFAULT_CACHE_SIZE, help='verified credentials kept to answer reconnects without hashing')
+    parser.add_argument('--auth-cache-ttl', type=float, default=DEFAULT_CACHE_TTL, help='seconds a verified credential is kept')
+    parser.add_argument('--allow-anonymous', action='store_true', help='with --password-file or --auth-db, accept clients that send no credentials')
+    parser.add_argument('--acl-file', help='topic access rules, see TopicAcl.py for the format')
+    parser.add_argument('--loop', choices=[LOOP_AUTO, LOOP_ASYNCIO, LOOP_UVLOOP], default=LOOP_AUTO, help='event loop, auto uses uvloop when it is installed')
+    parser.add_argument('--backlog', type=int, default=DEFAULT_BACKLOG, help='listen backlog')
+    parser.add_argument('--sndbuf', type=int, help='SO_SNDBUF of client connections in bytes')
+    parser.add_argument('--rcvbuf', type=int, help='SO_RCVBUF of client connections in bytes')
+    parser.add_argument('--no-nodelay', dest='nodelay', action='store_false', help='leave Nagle\'s algorithm enabled on client connections')
+    parser.add_argument('--stage-timings', action='store_true', help='record per-stage latency histograms from the start, SIGUSR2 toggles them at runtime')
+    parser.add_argument('--profile-mode', choices=[MODE_CPROFILE, MODE_SAMPLER], default=MODE_CPROFILE, help='profiler started by SIGUSR1')
+    parser.add_argument('--profile-seconds', type=float, default=DEFAULT_PROFILE_SECONDS)
+    parser.add_argument('--profile-dir', default='.', help='directory the profiles are written to')
+    args = parser.parse_args()
+
+    if args.workers > 1 and (args.bridge_listen or args.bridge_peer):
+        parser.error('bridging is not supported together with --workers')
+
+    if args.password_file and args.auth_db:
+        parser.error('--password-file and --auth-db are mutually exclusive')
+
+    if args.workers > 1 and args.session_file:
+        parser.error('--session-file is not supported together with --workers')
+
+    try:
+        install_event_loop(args.loop)
+    except ImportError:
+        parser.error('--loop uvloop requires the uvloop package')
+
+    socket_options = SocketOptions(args.nodelay, args.backlog, args.sndbuf, args.rcvbuf)
+
+    def create_server(worker: int = None) -> MQTTServer:
+        # Created per process, the sink thread does not survive a fork
+        logger = Logger(level=LEVEL_NAMES[args.log_level], sink=ThreadedSink(args.log_file, args.log_format))
+
+        authenticator: Authenticator = None
+        if args.mode == 'auth':
+            # Define the user database for authentication
+            user_db = {
+                "admin": "password",  # Replace with your desired username and password
+                "user": "userpass"
+            }
+
+            authenticator = Authenticator(user_db, logger)
+
+        if args.password_file or args.auth_db:
+            backend = FileBackend(args.password_file) if args.password_file else SQLiteBackend(args.auth_db)
+            authenticator = AsyncAuthenticator(backend, logger, args.auth_executor, args.auth_workers, args.auth_cache_size, args.auth_cache_ttl, allow_anonymous=args.allow_anonymous)
+
+        # Initialize the broker
+        acl = TopicAcl.load(args.acl_file, logger) if args.acl_file else None
+        session_store = SessionStore(args.session_file, logger)
+        broker = Broker(authenticator=authenticator, logger=logger, backpressure=args.backpressure, session_store=session_store, receive_maximum=args.receive_maximum, retry_interval=args.retry_interval, acl=acl, max_packet_size=args.max_packet_size, topic_alias_maximum=args.topic_alias_maximum)
+
+        if args.stage_timings:
+            broker.timings.enable()
+
+        profiler = Profiler(args.profile_dir, logger)
+
+        return MQTTServer(args.host, args.port, broker, logger, metrics_port=args.metrics_port, profiler=profiler, profile_seconds=args.profile_seconds, profile_mode=args.profile_mode, socket_options=socket_options, worker=worker)
+
+    async def run_bridged(server: MQTTServer):
+        from Bridge import Bridge
+
+        bridge = Bridge(server.broker, args.node_id, server.logger)
+
+        if args.bridge_listen:
+            bridge_host, bridge_port = args.bridge_listen.rsplit(':', 1)
+            await bridge.listen(bridge_host, int(bridge_port))
 
-    authenticator: Authenticator = None
-    if sys.argv and len(sys.argv) > 1 and sys.argv[1] == 'auth':
-        # Define the user database for authentication
-        user_db = {
-            "admin": "password",  # Replace with your desired username and password
-            "user": "userpass"
-        }
+        for peer in args.bridge_peer:
+            peer_host, peer_port = peer.rsplit(':', 1)
+            bridge.connect(peer_host, int(peer_port))
 
-        authenticator = Authenticator(user_db)
+        await server.start_server()
 
-    # Initialize the broker
-    broker = Broker(authenticator=authenticator)
+    if args.workers > 1:
+        from WorkerPool import WorkerPool
 
-    server = MQTTServer(broker, host, port)
-    asyncio.run(server.start_server())
+        WorkerPool(args.workers, create_server).run()
+    elif args.bridge_listen or args.bridge_peer:
+        asyncio.run(run_bridged(create_server()))
+    else:
+        asyncio.run(create_server().start_server())
 
 if __name__ == "__main__":
     main()
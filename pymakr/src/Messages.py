@@ -19,52 +19,106 @@ PACKET_TYPE_PINGREQ = 12
 PACKET_TYPE_PINGRESP = 13
 PACKET_TYPE_DISCONNECT = 14
 
+PROTOCOL_VERSION_V311 = 4
+PROTOCOL_VERSION_V5 = 5
+
 ENCODING_UTF8 = 'utf-8'
 
+SUBACK_FAILURE = 0x80
+
+# memoryview.tobytes is the fastest copy on CPython, MicroPython falls back to bytes()
+view_to_bytes = getattr(memoryview, 'tobytes', bytes)
+
+def encode_remaining_length(remaining_length: int) -> bytes:
+    remaining_length_buf = b''
+    length = remaining_length
+    while True:
+        encoded_byte = length % 128
+        length //= 128
+        if length > 0:
+            encoded_byte |= 128
+
+        remaining_length_buf += struct.pack('>B', encoded_byte)
+
+        if length == 0:
+            break
+
+    return remaining_length_buf
+
+# Pre-encoded constant packets and templates for the acknowledgements
+PINGRESP_PACKET = bytes((PACKET_TYPE_PINGRESP << 4, 0x00))
+
+ACK_CONTROL_FIELDS = {
+    PACKET_TYPE_PUBACK: PACKET_TYPE_PUBACK << 4,
+    PACKET_TYPE_PUBREC: PACKET_TYPE_PUBREC << 4,
+    PACKET_TYPE_PUBREL: (PACKET_TYPE_PUBREL << 4) | 0x02,
+    PACKET_TYPE_PUBCOMP: PACKET_TYPE_PUBCOMP << 4,
+    PACKET_TYPE_UNSUBACK: PACKET_TYPE_UNSUBACK << 4,
+}
+
+CONNACK_PACKETS = {}
+
+def encode_connack(conn_ack_flags: int, return_code: int) -> bytes:
+    key = (conn_ack_flags << 8) | return_code
+    packet = CONNACK_PACKETS.get(key)
+
+    if packet is None:
+        packet = CONNACK_PACKETS[key] = bytes((PACKET_TYPE_CONNACK << 4, 0x02, conn_ack_flags, return_code))
+
+    return packet
+
+def encode_ack(packet_type: int, packet_id: int) -> bytes:
+    """
+    Encode a packet consisting of only a packet identifier (PUBACK, PUBREC, PUBREL, PUBCOMP, UNSUBACK).
+    """
+    return bytes((ACK_CONTROL_FIELDS[packet_type], 0x02, packet_id >> 8, packet_id & 0xFF))
+
+def encode_suback(packet_id: int, return_codes: bytes) -> bytes:
+    """
+    Encode a SUBACK with one return code per topic filter of the SUBSCRIBE, in the same order.
+    """
+    return bytes((PACKET_TYPE_SUBACK << 4,)) + encode_remaining_length(2 + len(return_codes)) + bytes((packet_id >> 8, packet_id & 0xFF)) + bytes(return_codes)
+
+def encode_string(string: str, encoding: str = ENCODING_UTF8) -> bytes:
+    str_buf = string.encode(encoding)
+    return struct.pack('>H', len(str_buf)) + str_buf
+
+def encode_subscribe(packet_id: int, topic: str, qos: int = 0) -> bytes:
+    body = struct.pack('>H', packet_id) + encode_string(topic) + bytes((qos,))
+    return bytes(((PACKET_TYPE_SUBSCRIBE << 4) | 0x02,)) + encode_remaining_length(len(body)) + body
+
+def encode_unsubscribe(packet_id: int, topic: str) -> bytes:
+    body = struct.pack('>H', packet_id) + encode_string(topic)
+    return bytes(((PACKET_TYPE_UNSUBSCRIBE << 4) | 0x02,)) + encode_remaining_length(len(body)) + body
+
 class MQTTMessage:
+    __slots__ = ('packet_type', 'flags', 'control_field', 'dup', 'qos', 'retain', 'msg', 'view', 'offset',
+                 'remaining_length', 'variable_header_length', 'payload_length', 'payload_offset', '__payload')
+
     msg: bytes
 
     @staticmethod
     def create(msg) -> 'MQTTMessage':
-        packet_type, _, _ = MQTTMessage.__read_fixed_header(msg)
-        if packet_type == PACKET_TYPE_CONNECT:
-            return ConnectMessage(msg)
-        elif packet_type == PACKET_TYPE_CONNACK:
-            raise ValueError("ConnAck message is a response and should not be created directly")
-        elif packet_type == PACKET_TYPE_PUBLISH:
-            return PublishMessage(msg)
-        elif packet_type == PACKET_TYPE_PUBACK:
-            return PubAckMessage(msg)
-        elif packet_type == PACKET_TYPE_PUBREC:
-            raise NotImplementedError('PubRec message not implemented')
-        elif packet_type == PACKET_TYPE_PUBREL:
-            raise NotImplementedError('PubRel message not implemented')
-        elif packet_type == PACKET_TYPE_PUBCOMP:
-            raise NotImplementedError('PubComp message not implemented')
-        elif packet_type == PACKET_TYPE_SUBSCRIBE:
-            return SubscribeMessage(msg)
-        elif packet_type == PACKET_TYPE_SUBACK:
-            raise ValueError("SubAck message is a response and should not be created directly")
-        elif packet_type == PACKET_TYPE_UNSUBSCRIBE:
-            return UnsubscribeMessage(msg)
-        elif packet_type == PACKET_TYPE_UNSUBACK:
-            raise ValueError("UnSubAck message is a response and should not be created directly")
-        elif packet_type == PACKET_TYPE_PINGREQ:
-            return PingReqMessage(msg)
-        elif packet_type == PACKET_TYPE_PINGRESP:
-            raise ValueError("PingResp message is a response and should not be created directly")
-        elif packet_type == PACKET_TYPE_DISCONNECT:
-            return DisconnectMessage(msg)
-        else:
-            raise ValueError(f'Unsupported message type: {packet_type}')
+        packet_type = msg[0] >> 4
+        message_type = MESSAGE_TYPES.get(packet_type)
+
+        if message_type is None:
+            error_type, error = REFUSED_MESSAGE_TYPES.get(packet_type, (ValueError, f'Unsupported message type: {packet_type}'))
+            raise error_type(error)
+
+        return message_type(msg)
 
     def __init__(self, packet_type: int, msg: bytes = None):
         self.packet_type = packet_type
         self.flags = 0
         self.msg = msg or b''
+        self.view = None
         self.offset = 0
 
+        self.__payload = None
+
         if msg:
+            self.view = msg if isinstance(msg, memoryview) else memoryview(msg)
             self.__read_packet()
 
     @staticmethod
@@ -74,25 +128,32 @@ class MQTTMessage:
         flags = control_field & 0x0F
         return packet_type, flags, control_field
 
-    def read(self, length, move = True) -> bytes:
-        if (self.offset + length > len(self.msg)):
-            raise ValueError(f'Message length exceeded: {self.offset}:{self.offset + length} >= {len(self.msg)}')
+    def read(self, length, move = True) -> memoryview:
+        end = self.offset + length
+        if (end > len(self.view)):
+            raise ValueError(f'Message length exceeded: {self.offset}:{end} >= {len(self.view)}')
 
-        buf = self.msg[self.offset:self.offset + length]
+        buf = self.view[self.offset:end]
 
         if move:
-            self.offset += length
+            self.offset = end
 
         return buf
 
     def write(self, buf: bytes):
         self.msg += buf
 
+    def read_properties(self) -> bytes:
+        """
+        Read an MQTT 5 property block, returning the encoded properties without their length.
+        """
+        return view_to_bytes(self.read(self.read_variable_length()))
+
     def read_byte(self) -> int:
-        if (self.offset >= len(self.msg)):
-            raise ValueError(f'Message length exceeded: {self.offset} >= {len(self.msg)}')
+        if (self.offset >= len(self.view)):
+            raise ValueError(f'Message length exceeded: {self.offset} >= {len(self.view)}')
 
-        byte = self.msg[self.offset]
+        byte = self.view[self.offset]
         self.offset += 1
         return byte
 
@@ -100,25 +161,29 @@ class MQTTMessage:
         self.msg += struct.pack('>B', byte & 0xFF)
 
     def read_short(self) -> int:
-        return struct.unpack('>H', self.read(2))[0]
+        offset = self.offset
+        if (offset + 2 > len(self.view)):
+            raise ValueError(f'Message length exceeded: {offset}:{offset + 2} >= {len(self.view)}')
+
+        self.offset = offset + 2
+        return (self.view[offset] << 8) | self.view[offset + 1]
 
     def write_short(self, short: int):
         self.msg += struct.pack('>H', short)
 
     def read_string(self, encoding: str = ENCODING_UTF8) -> str:
         str_len = self.read_short()
-        str_buf = self.read(str_len)
-        return str_buf.decode(encoding)
+        return view_to_bytes(self.read(str_len)).decode(encoding)
 
     def write_string(self, str: str, encoding: str = ENCODING_UTF8):
         str_buf = str.encode(encoding)
         self.write_short(len(str_buf))
         self.msg += str_buf
 
-    def __read_rest(self) -> bytes:
-        return self.read(len(self.msg) - self.offset, False)
-
-    def __read_remaining_length(self) -> int:
+    def read_variable_length(self) -> int:
+        """
+        Read a variable byte integer, as used for the remaining length and the MQTT 5 property lengths.
+        """
         length = 0
         multiplier = 1
         while True:
@@ -131,26 +196,39 @@ class MQTTMessage:
         return length
 
     def __read_packet(self):
-        self.packet_type, self.flags, self.control_field = MQTTMessage.__read_fixed_header(self.msg)
+        self.packet_type, self.flags, self.control_field = MQTTMessage.__read_fixed_header(self.view)
 
         self.dup = (self.flags & 0x08) == 0x08
         self.qos = (self.flags & 0x06) >> 1
         self.retain = (self.flags & 0x01) == 0x01
 
         self.offset = 1
-        self.remaining_length = self.__read_remaining_length()
+        self.remaining_length = self.read_variable_length()
 
         variable_header_start = self.offset
         self.read_variable_header()
-        self.variable_header = self.msg[variable_header_start:self.offset]
-        self.variable_header_length = len(self.variable_header)
+        self.variable_header_length = self.offset - variable_header_start
         self.payload_length = self.remaining_length - self.variable_header_length
 
-        # print(f'Packet type: {self.packet_type}, flags: {self.flags}, control field: {self.control_field}, remaining length: {self.remaining_length}, variable header length: {self.variable_header_length}, payload length: {self.payload_length}')
-
-        self.payload = self.__read_rest()
+        self.payload_offset = self.offset
         self.read_payload()
 
+    @property
+    def payload(self):
+        # The payload stays a view into the received frame until it is needed
+        if self.__payload is None and self.view is not None:
+            self.__payload = self.view[self.payload_offset:]
+
+        return self.__payload
+
+    @payload.setter
+    def payload(self, payload):
+        self.__payload = payload
+
+    def get_payload_bytes(self) -> bytes:
+        payload = self.payload
+        return payload if isinstance(payload, bytes) else view_to_bytes(payload)
+
     def read_variable_header(self):
         pass
 
@@ -160,28 +238,12 @@ class MQTTMessage:
     def write_message(self):
         pass
 
-    def __get_remaining_length(self, remaining_length: int) -> bytes:
-        remaining_length_buf = b''
-        length = remaining_length
-        while True:
-            encoded_byte = length % 128
-            length //= 128
-            if length > 0:
-                encoded_byte |= 128
-
-            remaining_length_buf += struct.pack('>B', encoded_byte)
-
-            if length == 0:
-                break
-
-        return remaining_length_buf
-
     def write(self):
         self.offset = 0
         self.msg = b''
         self.write_message()
         remaining_length = len(self.msg)
-        self.msg = struct.pack('>B', (self.packet_type << 4) | (self.flags & 0x0F)) + self.__get_remaining_length(remaining_length) + self.msg
+        self.msg = struct.pack('>B', (self.packet_type << 4) | (self.flags & 0x0F)) + encode_remaining_length(remaining_length) + self.msg
 
     def handle_message(self, handler: ProtocolHandler, client: Client):
         pass
@@ -190,10 +252,13 @@ class MQTTMessage:
         if not send_as_is:
             self.write()
 
-        print(f'Sending message: {self.msg!r}')
         client.send(self.msg)
 
 class ConnectMessage(MQTTMessage):
+    __slots__ = ('protocol_name', 'protocol_version', 'connect_flags', 'keep_alive', 'flag_username', 'flag_password',
+                 'flag_will_retain', 'flag_will_qos', 'flag_will_flag', 'flag_clean_session', 'needs_authentication',
+                 'client_id', 'will_topic', 'will_message', 'properties', 'will_properties', '__is_authenticated', '__username', '__password')
+
     def __init__(self, msg: bytes = None):
         super().__init__(PACKET_TYPE_CONNECT, msg)
 
@@ -203,6 +268,9 @@ class ConnectMessage(MQTTMessage):
         self.connect_flags = self.read_byte()
         self.keep_alive = self.read_short()
 
+        # MQTT 5 properties are kept encoded, the MQTT 5 protocol handler decodes them
+        self.properties = self.read_properties() if self.protocol_version == PROTOCOL_VERSION_V5 else b''
+
         self.flag_username = (self.connect_flags & 0x80) == 0x80
         self.flag_password = (self.connect_flags & 0x40) == 0x40
         self.flag_will_retain = (self.connect_flags & 0x20) == 0x20
@@ -216,9 +284,19 @@ class ConnectMessage(MQTTMessage):
     def read_payload(self):
         self.client_id = self.read_string()
 
+        self.will_topic = None
+        self.will_message = None
+        self.will_properties = b''
         self.__username = None
         self.__password = None
 
+        if self.flag_will_flag:
+            if self.protocol_version == PROTOCOL_VERSION_V5:
+                self.will_properties = self.read_properties()
+
+            self.will_topic = self.read_string()
+            self.will_message = view_to_bytes(self.read(self.read_short()))
+
         if self.needs_authentication:
             self.__read_authentication()
 
@@ -235,6 +313,10 @@ class ConnectMessage(MQTTMessage):
             if not self.__password:
                 raise ValueError('Password flag is set but no password provided')
 
+    @property
+    def username(self) -> str:
+        return self.__username
+
     def authenticate(self, authenticator: Authenticator):
         if not self.needs_authentication or self.__is_authenticated:
             return True
@@ -242,37 +324,158 @@ class ConnectMessage(MQTTMessage):
         self.__is_authenticated = authenticator.authenticate(self.__username, self.__password)
         return self.__is_authenticated
 
+    def verify(self, authenticator: Authenticator, callback):
+        """
+        Like authenticate, but the result is passed to `callback(authenticated)`, possibly later.
+        """
+        def verified(authenticated):
+            self.__is_authenticated = authenticated
+            callback(authenticated)
+
+        authenticator.verify(self.__username, self.__password, verified)
+
     def handle_message(self, handler: ProtocolHandler, client: Client):
         handler.handle_connect(client, self)
 
 class ConnAckMessage(MQTTMessage):
-    conn_ack_flags: int = 0
-    return_code: int = 0
+    __slots__ = ('conn_ack_flags', 'return_code')
+
+    conn_ack_flags: int
+    return_code: int
 
     def __init__(self, conn_ack_flags: int = 0, return_code: int = 0):
         super().__init__(PACKET_TYPE_CONNACK)
         self.conn_ack_flags = conn_ack_flags
         self.return_code = return_code
 
-    def write_message(self):
-        self.write_byte(self.conn_ack_flags)
-        self.write_byte(self.return_code)
+    def write(self):
+        self.msg = encode_connack(self.conn_ack_flags, self.return_code)
 
 class PublishMessage(MQTTMessage):
+    __slots__ = ('topic_name', 'packet_id', 'origin', 'route', 'properties', '__topic_start', '__topic_end', '__topic_segment', '__headers')
+
     def __init__(self, msg: bytes = None):
+        # The peer link a forwarded message arrived on, None for messages from clients
+        self.origin = None
+        # Origin node, sequence number and hop count of a message routed between bridged brokers
+        self.route = None
+        # Encoded MQTT 5 properties forwarded to MQTT 5 subscribers
+        self.properties = b''
+        self.__topic_segment = None
+        self.__headers = None
         super().__init__(PACKET_TYPE_PUBLISH, msg)
 
+    @staticmethod
+    def build(topic_name: str, payload: bytes, qos: int = 0, retain: bool = False) -> 'PublishMessage':
+        """
+        Create a message owned by the broker, not backed by a received frame.
+        """
+        message = PublishMessage()
+        message.topic_name = topic_name
+        message.packet_id = None
+        message.payload = payload
+        message.qos = qos
+        message.retain = retain
+        message.dup = False
+        return message
+
     def read_variable_header(self):
+        self.__topic_start = self.offset
         self.topic_name = self.read_string()
+        self.__topic_end = self.offset
+
         if self.qos > 0:
             self.packet_id = self.read_short()
         else:
             self.packet_id = None
 
+    def get_topic_segment(self) -> bytes:
+        """
+        The topic name as encoded on the wire, with its length prefix.
+        """
+        if self.__topic_segment is None:
+            if self.view is not None:
+                self.__topic_segment = self.view[self.__topic_start:self.__topic_end]
+            else:
+                self.__topic_segment = encode_string(self.topic_name)
+
+        return self.__topic_segment
+
+    def write_for(self, qos: int, packet_id: int = None, retain: bool = False, dup: bool = False) -> list:
+        """
+        Encode this message for one subscriber without copying the topic or payload.
+
+        The topic and payload are shared between all subscribers, only the fixed
+        header and the packet identifier are produced per call. The fixed headers
+        are cached per flag combination as the remaining length does not change.
+
+        Parameters:
+        - qos (int): The QoS the message is delivered with.
+        - packet_id (int): The packet identifier, required when qos > 0.
+        - retain (bool): The retain flag to send.
+        - dup (bool): The duplicate delivery flag to send.
+
+        Returns:
+        - list: The buffers making up the packet, suitable for `writelines`.
+        """
+        flags = (0x08 if dup else 0) | (qos << 1) | (0x01 if retain else 0)
+        topic_segment = self.get_topic_segment()
+
+        if self.__headers is None:
+            self.__headers = {}
+
+        header = self.__headers.get(flags)
+        if header is None:
+            remaining_length = len(topic_segment) + len(self.payload) + (2 if qos > 0 else 0)
+            header = bytes(((PACKET_TYPE_PUBLISH << 4) | flags,)) + encode_remaining_length(remaining_length)
+            self.__headers[flags] = header
+
+        if qos > 0:
+            return [header, topic_segment, struct.pack('>H', packet_id), self.payload]
+
+        return [header, topic_segment, self.payload]
+
+    def set_topic_name(self, topic_name: str):
+        """
+        Replace the topic, e.g. the empty topic of an MQTT 5 PUBLISH that only carries a topic alias.
+        """
+        self.topic_name = topic_name
+        self.__topic_segment = encode_string(topic_name)
+        self.__headers = None
+
+    def transmit(self, client: Client, qos: int, packet_id: int = None, retain: bool = False, dup: bool = False):
+        """
+        Send this message to one client, encoded for the protocol version of its connection.
+        """
+        if client.v5 is None:
+            client.send_parts(self.write_for(qos, packet_id, retain, dup), qos)
+        else:
+            client.v5.send_publish(client, self, qos, packet_id, retain, dup)
+
+    def send_to_subscriber(self, client: Client, qos: int = 0, retain: bool = False):
+        qos = min(self.qos, qos)
+
+        if client.v5 is not None and not client.v5.fits(self, qos):
+            # Larger than the client's Maximum Packet Size, MQTT 5 discards it as if it was delivered
+            client.v5.discard(client, self)
+            return
+
+        if qos > 0 and client.inflight is not None:
+            if not client.inflight.send(client, self, qos, retain):
+                # Past the hard limit the subscriber is disconnected, its session keeps the held messages
+                client.logger.warning('In-flight window of %s is full, disconnecting', client.client_name)
+                client.abort()
+            return
+
+        packet_id = client.next_packet_id() if qos > 0 else None
+        self.transmit(client, qos, packet_id, retain)
+
     def handle_message(self, handler: ProtocolHandler, client: Client):
         handler.handle_publish(client, self)
 
 class PubAckMessage(MQTTMessage):
+    __slots__ = ('packet_id', 'publish_message')
+
     def __init__(self, publish_message: PublishMessage = None, msg: bytes = None):
         super().__init__(PACKET_TYPE_PUBACK, msg)
         self.publish_message = publish_message
@@ -280,41 +483,96 @@ class PubAckMessage(MQTTMessage):
     def read_variable_header(self):
         self.packet_id = self.read_short()
 
-    def write_message(self):
-        self.write_short(self.publish_message.packet_id)
+    def write(self):
+        self.msg = encode_ack(PACKET_TYPE_PUBACK, self.publish_message.packet_id)
+
+    def handle_message(self, handler: ProtocolHandler, client: Client):
+        handler.handle_puback(client, self)
+
+class PubRecMessage(MQTTMessage):
+    __slots__ = ('packet_id',)
+
+    def __init__(self, msg: bytes):
+        super().__init__(PACKET_TYPE_PUBREC, msg)
+
+    def read_variable_header(self):
+        self.packet_id = self.read_short()
+
+    def handle_message(self, handler: ProtocolHandler, client: Client):
+        handler.handle_pubrec(client, self)
+
+class PubRelMessage(MQTTMessage):
+    __slots__ = ('packet_id',)
+
+    def __init__(self, msg: bytes):
+        super().__init__(PACKET_TYPE_PUBREL, msg)
+
+    def read_variable_header(self):
+        self.packet_id = self.read_short()
+
+    def handle_message(self, handler: ProtocolHandler, client: Client):
+        handler.handle_pubrel(client, self)
+
+class PubCompMessage(MQTTMessage):
+    __slots__ = ('packet_id',)
+
+    def __init__(self, msg: bytes):
+        super().__init__(PACKET_TYPE_PUBCOMP, msg)
+
+    def read_variable_header(self):
+        self.packet_id = self.read_short()
+
+    def handle_message(self, handler: ProtocolHandler, client: Client):
+        handler.handle_pubcomp(client, self)
 
 class SubscribeMessage(MQTTMessage):
-    packet_id: int = 0
-    topic: str = ''
-    qos: int = 0
+    __slots__ = ('packet_id', 'topics')
+
+    packet_id: int
+    # (topic filter, requested QoS) in packet order
+    topics: list
 
     def __init__(self, msg: bytes):
+        self.packet_id = 0
+        self.topics = []
         super().__init__(PACKET_TYPE_SUBSCRIBE, msg)
 
     def read_variable_header(self):
         self.packet_id = self.read_short()
 
     def read_payload(self):
-        self.topic = self.read_string()
-        self.qos = self.read_byte()
+        self.topics = []
+
+        while self.offset < len(self.view):
+            topic = self.read_string()
+            self.topics.append((topic, self.read_byte()))
+
+        if not self.topics:
+            raise ValueError('SUBSCRIBE without topic filters')
 
     def handle_message(self, handler: ProtocolHandler, client: Client):
         handler.handle_subscribe(client, self)
 
 class SubAckMessage(MQTTMessage):
-    def __init__(self, subscribe_message: SubscribeMessage):
+    __slots__ = ('subscribe_message', 'return_codes')
+
+    def __init__(self, subscribe_message: SubscribeMessage, return_codes: bytes = None):
         super().__init__(PACKET_TYPE_SUBACK)
         self.subscribe_message = subscribe_message
+        # Grant the requested QoS of every filter unless told otherwise
+        self.return_codes = return_codes if return_codes is not None else bytes(qos for _, qos in subscribe_message.topics)
 
-    def write_message(self):
-        self.write_short(self.subscribe_message.packet_id)
-        self.write_byte(self.subscribe_message.qos)
+    def write(self):
+        self.msg = encode_suback(self.subscribe_message.packet_id, self.return_codes)
 
 class UnsubscribeMessage(MQTTMessage):
-    packet_id: int = 0
-    topic: any
+    __slots__ = ('packet_id', 'topics')
+
+    packet_id: int
+    topics: list
 
     def __init__(self, msg: bytes):
+        self.packet_id = 0
         super().__init__(PACKET_TYPE_UNSUBSCRIBE, msg)
 
     def read_variable_header(self):
@@ -323,7 +581,7 @@ class UnsubscribeMessage(MQTTMessage):
     def read_payload(self):
         self.topics = []
 
-        while self.offset < len(self.msg):
+        while self.offset < len(self.view):
             topic = self.read_string()
             self.topics.append(topic)
 
@@ -331,14 +589,18 @@ class UnsubscribeMessage(MQTTMessage):
         handler.handle_unsubscribe(client, self)
 
 class UnSubAckMessage(MQTTMessage):
+    __slots__ = ('unsubscribe_message',)
+
     def __init__(self, unsubscribe_message: UnsubscribeMessage):
         super().__init__(PACKET_TYPE_UNSUBACK)
         self.unsubscribe_message = unsubscribe_message
 
-    def write_message(self):
-        self.write_short(self.unsubscribe_message.packet_id)
+    def write(self):
+        self.msg = encode_ack(PACKET_TYPE_UNSUBACK, self.unsubscribe_message.packet_id)
 
 class PingReqMessage(MQTTMessage):
+    __slots__ = ()
+
     def __init__(self, msg: bytes):
         super().__init__(PACKET_TYPE_PINGREQ, msg)
 
@@ -346,13 +608,40 @@ class PingReqMessage(MQTTMessage):
         handler.handle_pingreq(client, self)
 
 class PingRespMessage(MQTTMessage):
+    __slots__ = ('pingreq_message',)
+
     def __init__(self, pingreq_message: PingReqMessage):
         super().__init__(PACKET_TYPE_PINGRESP)
         self.pingreq_message = pingreq_message
 
+    def write(self):
+        self.msg = PINGRESP_PACKET
+
 class DisconnectMessage(MQTTMessage):
+    __slots__ = ()
+
     def __init__(self, msg: bytes):
         super().__init__(PACKET_TYPE_DISCONNECT, msg)
 
     def handle_message(self, handler: ProtocolHandler, client: Client):
         handler.handle_disconnect(client, self)
+
+MESSAGE_TYPES = {
+    PACKET_TYPE_CONNECT: ConnectMessage,
+    PACKET_TYPE_PUBLISH: PublishMessage,
+    PACKET_TYPE_PUBACK: lambda msg: PubAckMessage(msg=msg),
+    PACKET_TYPE_PUBREC: PubRecMessage,
+    PACKET_TYPE_PUBREL: PubRelMessage,
+    PACKET_TYPE_PUBCOMP: PubCompMessage,
+    PACKET_TYPE_SUBSCRIBE: SubscribeMessage,
+    PACKET_TYPE_UNSUBSCRIBE: UnsubscribeMessage,
+    PACKET_TYPE_PINGREQ: PingReqMessage,
+    PACKET_TYPE_DISCONNECT: DisconnectMessage,
+}
+
+REFUSED_MESSAGE_TYPES = {
+    PACKET_TYPE_CONNACK: (ValueError, 'ConnAck message is a response and should not be created directly'),
+    PACKET_TYPE_SUBACK: (ValueError, 'SubAck message is a response and should not be created directly'),
+    PACKET_TYPE_UNSUBACK: (ValueError, 'UnSubAck message is a response and should not be created directly'),
+    PACKET_TYPE_PINGRESP: (ValueError, 'PingResp message is a response and should not be created directly'),
+}
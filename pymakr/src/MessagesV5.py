@@ -0,0 +1,493 @@
+import struct
+
+from Client import Client
+from Logger import Logger
+from Messages import (DisconnectMessage, MQTTMessage, PublishMessage, PubRecMessage, SubscribeMessage, UnsubscribeMessage,
+                      ACK_CONTROL_FIELDS, ENCODING_UTF8, MESSAGE_TYPES, REFUSED_MESSAGE_TYPES,
+                      PACKET_TYPE_CONNACK, PACKET_TYPE_DISCONNECT, PACKET_TYPE_PUBLISH, PACKET_TYPE_PUBREC, PACKET_TYPE_SUBACK,
+                      PACKET_TYPE_SUBSCRIBE, PACKET_TYPE_UNSUBACK, PACKET_TYPE_UNSUBSCRIBE,
+                      encode_ack, encode_remaining_length, encode_string, view_to_bytes)
+
+PACKET_TYPE_AUTH = 15
+
+# Property identifiers
+PROPERTY_PAYLOAD_FORMAT_INDICATOR = 0x01
+PROPERTY_MESSAGE_EXPIRY_INTERVAL = 0x02
+PROPERTY_CONTENT_TYPE = 0x03
+PROPERTY_RESPONSE_TOPIC = 0x08
+PROPERTY_CORRELATION_DATA = 0x09
+PROPERTY_SUBSCRIPTION_IDENTIFIER = 0x0B
+PROPERTY_SESSION_EXPIRY_INTERVAL = 0x11
+PROPERTY_ASSIGNED_CLIENT_IDENTIFIER = 0x12
+PROPERTY_SERVER_KEEP_ALIVE = 0x13
+PROPERTY_AUTHENTICATION_METHOD = 0x15
+PROPERTY_AUTHENTICATION_DATA = 0x16
+PROPERTY_REQUEST_PROBLEM_INFORMATION = 0x17
+PROPERTY_WILL_DELAY_INTERVAL = 0x18
+PROPERTY_REQUEST_RESPONSE_INFORMATION = 0x19
+PROPERTY_RESPONSE_INFORMATION = 0x1A
+PROPERTY_SERVER_REFERENCE = 0x1C
+PROPERTY_REASON_STRING = 0x1F
+PROPERTY_RECEIVE_MAXIMUM = 0x21
+PROPERTY_TOPIC_ALIAS_MAXIMUM = 0x22
+PROPERTY_TOPIC_ALIAS = 0x23
+PROPERTY_MAXIMUM_QOS = 0x24
+PROPERTY_RETAIN_AVAILABLE = 0x25
+PROPERTY_USER_PROPERTY = 0x26
+PROPERTY_MAXIMUM_PACKET_SIZE = 0x27
+PROPERTY_WILDCARD_SUBSCRIPTION_AVAILABLE = 0x28
+PROPERTY_SUBSCRIPTION_IDENTIFIER_AVAILABLE = 0x29
+PROPERTY_SHARED_SUBSCRIPTION_AVAILABLE = 0x2A
+
+# Property value encodings
+TYPE_BYTE = 0
+TYPE_TWO_BYTE = 1
+TYPE_FOUR_BYTE = 2
+TYPE_VARIABLE = 3
+TYPE_STRING = 4
+TYPE_BINARY = 5
+TYPE_STRING_PAIR = 6
+
+PROPERTY_TYPES = {
+    PROPERTY_PAYLOAD_FORMAT_INDICATOR: TYPE_BYTE,
+    PROPERTY_MESSAGE_EXPIRY_INTERVAL: TYPE_FOUR_BYTE,
+    PROPERTY_CONTENT_TYPE: TYPE_STRING,
+    PROPERTY_RESPONSE_TOPIC: TYPE_STRING,
+    PROPERTY_CORRELATION_DATA: TYPE_BINARY,
+    PROPERTY_SUBSCRIPTION_IDENTIFIER: TYPE_VARIABLE,
+    PROPERTY_SESSION_EXPIRY_INTERVAL: TYPE_FOUR_BYTE,
+    PROPERTY_ASSIGNED_CLIENT_IDENTIFIER: TYPE_STRING,
+    PROPERTY_SERVER_KEEP_ALIVE: TYPE_TWO_BYTE,
+    PROPERTY_AUTHENTICATION_METHOD: TYPE_STRING,
+    PROPERTY_AUTHENTICATION_DATA: TYPE_BINARY,
+    PROPERTY_REQUEST_PROBLEM_INFORMATION: TYPE_BYTE,
+    PROPERTY_WILL_DELAY_INTERVAL: TYPE_FOUR_BYTE,
+    PROPERTY_REQUEST_RESPONSE_INFORMATION: TYPE_BYTE,
+    PROPERTY_RESPONSE_INFORMATION: TYPE_STRING,
+    PROPERTY_SERVER_REFERENCE: TYPE_STRING,
+    PROPERTY_REASON_STRING: TYPE_STRING,
+    PROPERTY_RECEIVE_MAXIMUM: TYPE_TWO_BYTE,
+    PROPERTY_TOPIC_ALIAS_MAXIMUM: TYPE_TWO_BYTE,
+    PROPERTY_TOPIC_ALIAS: TYPE_TWO_BYTE,
+    PROPERTY_MAXIMUM_QOS: TYPE_BYTE,
+    PROPERTY_RETAIN_AVAILABLE: TYPE_BYTE,
+    PROPERTY_USER_PROPERTY: TYPE_STRING_PAIR,
+    PROPERTY_MAXIMUM_PACKET_SIZE: TYPE_FOUR_BYTE,
+    PROPERTY_WILDCARD_SUBSCRIPTION_AVAILABLE: TYPE_BYTE,
+    PROPERTY_SUBSCRIPTION_IDENTIFIER_AVAILABLE: TYPE_BYTE,
+    PROPERTY_SHARED_SUBSCRIPTION_AVAILABLE: TYPE_BYTE,
+}
+
+# Reason codes
+REASON_SUCCESS = 0x00
+REASON_DISCONNECT_WITH_WILL = 0x04
+REASON_NO_MATCHING_SUBSCRIBERS = 0x10
+REASON_NO_SUBSCRIPTION_EXISTED = 0x11
+REASON_UNSPECIFIED_ERROR = 0x80
+REASON_MALFORMED_PACKET = 0x81
+REASON_PROTOCOL_ERROR = 0x82
+REASON_UNSUPPORTED_PROTOCOL_VERSION = 0x84
+REASON_CLIENT_IDENTIFIER_NOT_VALID = 0x85
+REASON_BAD_USER_NAME_OR_PASSWORD = 0x86
+REASON_NOT_AUTHORIZED = 0x87
+REASON_SERVER_UNAVAILABLE = 0x88
+REASON_BAD_AUTHENTICATION_METHOD = 0x8C
+REASON_TOPIC_FILTER_INVALID = 0x8F
+REASON_TOPIC_NAME_INVALID = 0x90
+REASON_RECEIVE_MAXIMUM_EXCEEDED = 0x93
+REASON_TOPIC_ALIAS_INVALID = 0x94
+REASON_PACKET_TOO_LARGE = 0x95
+REASON_SHARED_SUBSCRIPTIONS_NOT_SUPPORTED = 0x9E
+REASON_SUBSCRIPTION_IDENTIFIERS_NOT_SUPPORTED = 0xA1
+
+# MQTT 3.1.1 CONNACK return codes and their MQTT 5 reason codes
+CONNACK_REASON_CODES = {
+    1: REASON_UNSUPPORTED_PROTOCOL_VERSION,
+    2: REASON_CLIENT_IDENTIFIER_NOT_VALID,
+    3: REASON_SERVER_UNAVAILABLE,
+    4: REASON_BAD_USER_NAME_OR_PASSWORD,
+    5: REASON_NOT_AUTHORIZED,
+}
+
+# Subscription options
+RETAIN_HANDLING_SEND = 0
+RETAIN_HANDLING_SEND_IF_NEW = 1
+RETAIN_HANDLING_DONT_SEND = 2
+
+# The value a client gets when it leaves the Receive Maximum out of its CONNECT
+DEFAULT_RECEIVE_MAXIMUM = 65535
+
+# The zero length topic of a PUBLISH carrying only a topic alias
+EMPTY_TOPIC = b'\x00\x00'
+
+def decode_variable_length(buf, offset: int) -> tuple:
+    """
+    Returns:
+    - tuple: (value, offset after the encoded value)
+    """
+    value = 0
+    multiplier = 1
+
+    while True:
+        encoded_byte = buf[offset]
+        offset += 1
+        value += (encoded_byte & 127) * multiplier
+
+        if (encoded_byte & 128) == 0:
+            return value, offset
+
+        multiplier *= 128
+        if multiplier > 128 ** 3:
+            raise ValueError('Malformed variable byte integer')
+
+def scan_properties(buf):
+    """
+    Walk an encoded property block without its length prefix.
+
+    Yields:
+    - tuple: (identifier, value, start, end) per property, start and end delimit its encoding in `buf`.
+    """
+    offset = 0
+    end = len(buf)
+
+    try:
+        while offset < end:
+            start = offset
+            identifier, offset = decode_variable_length(buf, offset)
+            value_type = PROPERTY_TYPES.get(identifier)
+
+            if value_type == TYPE_BYTE:
+                value = buf[offset]
+                offset += 1
+            elif value_type == TYPE_TWO_BYTE:
+                value = (buf[offset] << 8) | buf[offset + 1]
+                offset += 2
+            elif value_type == TYPE_FOUR_BYTE:
+                value = struct.unpack_from('>I', buf, offset)[0]
+                offset += 4
+            elif value_type == TYPE_VARIABLE:
+                value, offset = decode_variable_length(buf, offset)
+            elif value_type == TYPE_STRING_PAIR:
+                name, offset = decode_string(buf, offset)
+                value, offset = decode_string(buf, offset)
+                value = (name, value)
+            elif value_type is not None:
+                length = (buf[offset] << 8) | buf[offset + 1]
+                value = view_to_bytes(memoryview(buf)[offset + 2:offset + 2 + length])
+                offset += 2 + length
+
+                if value_type == TYPE_STRING:
+                    value = value.decode(ENCODING_UTF8)
+            else:
+                raise ValueError(f'Unknown property: {identifier:#04x}')
+
+            if offset > end:
+                raise ValueError('Property exceeds the property length')
+
+            yield identifier, value, start, offset
+    except (IndexError, struct.error):
+        raise ValueError('Malformed properties')
+
+def decode_string(buf, offset: int) -> tuple:
+    length = (buf[offset] << 8) | buf[offset + 1]
+    end = offset + 2 + length
+
+    if end > len(buf):
+        raise ValueError('Malformed properties')
+
+    return view_to_bytes(memoryview(buf)[offset + 2:end]).decode(ENCODING_UTF8), end
+
+def decode_properties(buf) -> dict:
+    """
+    Decode a property block, identifier -> value. User properties are collected
+    in a list of (name, value), any other property may appear once.
+    """
+    properties = {}
+
+    for identifier, value, _, _ in scan_properties(buf):
+        if identifier == PROPERTY_USER_PROPERTY:
+            properties.setdefault(identifier, []).append(value)
+        elif identifier in properties:
+            raise ValueError(f'Duplicate property: {identifier:#04x}')
+        else:
+            properties[identifier] = value
+
+    return properties
+
+def encode_property(identifier: int, value) -> bytes:
+    value_type = PROPERTY_TYPES[identifier]
+
+    if value_type == TYPE_BYTE:
+        encoded = bytes((value,))
+    elif value_type == TYPE_TWO_BYTE:
+        encoded = struct.pack('>H', value)
+    elif value_type == TYPE_FOUR_BYTE:
+        encoded = struct.pack('>I', value)
+    elif value_type == TYPE_VARIABLE:
+        encoded = encode_remaining_length(value)
+    elif value_type == TYPE_STRING:
+        encoded = encode_string(value)
+    elif value_type == TYPE_BINARY:
+        encoded = struct.pack('>H', len(value)) + value
+    else:
+        encoded = encode_string(value[0]) + encode_string(value[1])
+
+    return bytes((identifier,)) + encoded
+
+def encode_properties(properties: list) -> bytes:
+    """
+    Encode (identifier, value) pairs as a property block, with its length prefix.
+    """
+    encoded = b''.join(encode_property(identifier, value) for identifier, value in properties)
+    return encode_remaining_length(len(encoded)) + encoded
+
+def encode_connack_v5(session_present: bool, reason_code: int, properties: bytes = b'\x00') -> bytes:
+    body = bytes((1 if session_present else 0, reason_code)) + properties
+    return bytes((PACKET_TYPE_CONNACK << 4,)) + encode_remaining_length(len(body)) + body
+
+def encode_ack_v5(packet_type: int, packet_id: int, reason_code: int = REASON_SUCCESS) -> bytes:
+    """
+    Encode a PUBACK, PUBREC, PUBREL or PUBCOMP with a reason code, in the short
+    MQTT 3.1.1 form when the reason is success.
+    """
+    if reason_code == REASON_SUCCESS:
+        return encode_ack(packet_type, packet_id)
+
+    return bytes((ACK_CONTROL_FIELDS[packet_type], 0x03, packet_id >> 8, packet_id & 0xFF, reason_code))
+
+def encode_suback_v5(packet_id: int, reason_codes: bytes) -> bytes:
+    return bytes((PACKET_TYPE_SUBACK << 4,)) + encode_remaining_length(3 + len(reason_codes)) + bytes((packet_id >> 8, packet_id & 0xFF, 0x00)) + bytes(reason_codes)
+
+def encode_unsuback_v5(packet_id: int, reason_codes: bytes) -> bytes:
+    return bytes((PACKET_TYPE_UNSUBACK << 4,)) + encode_remaining_length(3 + len(reason_codes)) + bytes((packet_id >> 8, packet_id & 0xFF, 0x00)) + bytes(reason_codes)
+
+def encode_disconnect_v5(reason_code: int) -> bytes:
+    return bytes((PACKET_TYPE_DISCONNECT << 4, 0x01, reason_code))
+
+class PublishMessageV5(PublishMessage):
+    __slots__ = ('topic_alias',)
+
+    def __init__(self, msg: bytes = None):
+        # None when the PUBLISH has no Topic Alias property
+        self.topic_alias = None
+        super().__init__(msg)
+
+    def read_variable_header(self):
+        super().read_variable_header()
+
+        properties = self.read(self.read_variable_length())
+        if not properties:
+            return
+
+        # Everything but the topic alias, which is only valid on this connection, is forwarded
+        forwarded = []
+        for identifier, value, start, end in scan_properties(properties):
+            if identifier == PROPERTY_TOPIC_ALIAS:
+                self.topic_alias = value
+            elif identifier == PROPERTY_SUBSCRIPTION_IDENTIFIER:
+                raise ValueError('PUBLISH from a client must not have a subscription identifier')
+            else:
+                forwarded.append(properties[start:end])
+
+        self.properties = b''.join(forwarded)
+
+class PubRecMessageV5(PubRecMessage):
+    __slots__ = ('reason_code',)
+
+    def read_variable_header(self):
+        super().read_variable_header()
+        self.reason_code = self.read_byte() if self.remaining_length > 2 else REASON_SUCCESS
+
+class SubscribeMessageV5(SubscribeMessage):
+    __slots__ = ('options', 'subscription_identifier')
+
+    # Subscription options byte per topic filter, in packet order
+    options: list
+
+    def __init__(self, msg: bytes):
+        self.options = []
+        self.subscription_identifier = None
+        super().__init__(msg)
+
+    def read_variable_header(self):
+        super().read_variable_header()
+        properties = decode_properties(self.read(self.read_variable_length()))
+        self.subscription_identifier = properties.get(PROPERTY_SUBSCRIPTION_IDENTIFIER)
+
+    def read_payload(self):
+        self.topics = []
+        self.options = []
+
+        while self.offset < len(self.view):
+            topic = self.read_string()
+            options = self.read_byte()
+
+            if options & 0xC0 or options & 0x03 == 3 or (options >> 4) & 0x03 == 3:
+                raise ValueError(f'Malformed subscription options: {options:#04x}')
+
+            self.topics.append((topic, options & 0x03))
+            self.options.append(options)
+
+        if not self.topics:
+            raise ValueError('SUBSCRIBE without topic filters')
+
+class UnsubscribeMessageV5(UnsubscribeMessage):
+    __slots__ = ()
+
+    def read_variable_header(self):
+        super().read_variable_header()
+        decode_properties(self.read(self.read_variable_length()))
+
+class DisconnectMessageV5(DisconnectMessage):
+    __slots__ = ('reason_code', 'session_expiry_interval')
+
+    def __init__(self, msg: bytes):
+        self.session_expiry_interval = None
+        super().__init__(msg)
+
+    def read_variable_header(self):
+        self.reason_code = self.read_byte() if self.remaining_length > 0 else REASON_SUCCESS
+
+        if self.remaining_length > 1:
+            properties = decode_properties(self.read(self.read_variable_length()))
+            self.session_expiry_interval = properties.get(PROPERTY_SESSION_EXPIRY_INTERVAL)
+
+def create_message_v5(msg) -> MQTTMessage:
+    """
+    Like MQTTMessage.create, for the packets of a connection that was accepted as MQTT 5.
+    """
+    packet_type = msg[0] >> 4
+    message_type = MESSAGE_TYPES_V5.get(packet_type)
+
+    if message_type is None:
+        error_type, error = REFUSED_MESSAGE_TYPES_V5.get(packet_type, (ValueError, f'Unsupported message type: {packet_type}'))
+        raise error_type(error)
+
+    return message_type(msg)
+
+MESSAGE_TYPES_V5 = dict(MESSAGE_TYPES)
+MESSAGE_TYPES_V5.update({
+    PACKET_TYPE_PUBLISH: PublishMessageV5,
+    PACKET_TYPE_PUBREC: PubRecMessageV5,
+    PACKET_TYPE_SUBSCRIBE: SubscribeMessageV5,
+    PACKET_TYPE_UNSUBSCRIBE: UnsubscribeMessageV5,
+    PACKET_TYPE_DISCONNECT: DisconnectMessageV5,
+})
+
+REFUSED_MESSAGE_TYPES_V5 = dict(REFUSED_MESSAGE_TYPES)
+REFUSED_MESSAGE_TYPES_V5[PACKET_TYPE_AUTH] = (ValueError, 'Enhanced authentication is not supported')
+
+class ConnectionV5:
+    """
+    The MQTT 5 state of one connection: the limits the client announced in its
+    CONNECT and the topic aliases in both directions.
+
+    Aliases only live as long as the connection. Inbound aliases are set by the
+    client, up to the maximum the broker announced in its CONNACK. Outbound aliases
+    are assigned by the broker to the first topics it sends, up to the maximum the
+    client announced; later PUBLISH packets on those topics carry the two byte
+    alias instead of the topic name.
+    """
+    __slots__ = ('receive_maximum', 'maximum_packet_size', 'topic_alias_maximum', 'session_expiry_interval', 'assigned_client_id',
+                 'inbound_aliases', 'inbound_alias_maximum', 'outbound_aliases', 'discarded', 'logger')
+
+    def __init__(self, properties: dict, inbound_alias_maximum: int = 0, outbound_alias_maximum: int = 0, logger: Logger = None):
+        """
+        Parameters:
+        - properties (dict): The decoded properties of the CONNECT.
+        - inbound_alias_maximum (int): The Topic Alias Maximum announced to the client.
+        - outbound_alias_maximum (int): Upper bound of the aliases the broker assigns, whatever the client allows.
+        """
+        if properties.get(PROPERTY_RECEIVE_MAXIMUM) == 0 or properties.get(PROPERTY_MAXIMUM_PACKET_SIZE) == 0:
+            raise ValueError('Receive Maximum and Maximum Packet Size must not be 0')
+
+        self.receive_maximum = properties.get(PROPERTY_RECEIVE_MAXIMUM, DEFAULT_RECEIVE_MAXIMUM)
+        # 0 when the client has no limit beyond the protocol's
+        self.maximum_packet_size = properties.get(PROPERTY_MAXIMUM_PACKET_SIZE, 0)
+        self.topic_alias_maximum = min(properties.get(PROPERTY_TOPIC_ALIAS_MAXIMUM, 0), outbound_alias_maximum)
+        self.session_expiry_interval = properties.get(PROPERTY_SESSION_EXPIRY_INTERVAL, 0)
+        self.assigned_client_id = None
+        # alias -> topic name set by the client
+        self.inbound_aliases = {}
+        self.inbound_alias_maximum = inbound_alias_maximum
+        # topic name -> alias assigned by the broker
+        self.outbound_aliases = {}
+        self.discarded = 0
+        self.logger = logger or Logger()
+
+    def resolve_topic(self, publish_message: PublishMessageV5) -> int:
+        """
+        Apply the topic alias of a received PUBLISH: remember the topic it sets, or
+        fill in the topic of a PUBLISH that only carries the alias.
+
+        Returns:
+        - int: REASON_SUCCESS, or the reason code to disconnect the client with.
+        """
+        alias = publish_message.topic_alias
+
+        if alias is None:
+            return REASON_SUCCESS if publish_message.topic_name else REASON_PROTOCOL_ERROR
+
+        if alias == 0 or alias > self.inbound_alias_maximum:
+            return REASON_TOPIC_ALIAS_INVALID
+
+        if publish_message.topic_name:
+            self.inbound_aliases[alias] = publish_message.topic_name
+            return REASON_SUCCESS
+
+        topic_name = self.inbound_aliases.get(alias)
+        if topic_name is None:
+            return REASON_PROTOCOL_ERROR
+
+        publish_message.set_topic_name(topic_name)
+        return REASON_SUCCESS
+
+    def fits(self, publish_message: PublishMessage, qos: int) -> bool:
+        """
+        Check a message against the client's Maximum Packet Size. The size is an upper
+        bound, counting the full topic name and a topic alias property.
+        """
+        if not self.maximum_packet_size:
+            return True
+
+        properties_length = len(publish_message.properties) + 3
+        remaining_length = len(publish_message.get_topic_segment()) + (2 if qos > 0 else 0) + len(encode_remaining_length(properties_length)) + properties_length + len(publish_message.payload)
+        return 1 + len(encode_remaining_length(remaining_length)) + remaining_length <= self.maximum_packet_size
+
+    def discard(self, client: Client, publish_message: PublishMessage):
+        self.discarded += 1
+        self.logger.warning('Discarding message on %s, larger than the maximum packet size %d of %s', publish_message.topic_name, self.maximum_packet_size, client.client_name)
+
+    def send_publish(self, client: Client, publish_message: PublishMessage, qos: int, packet_id: int = None, retain: bool = False, dup: bool = False):
+        """
+        Encode and send a PUBLISH, replacing the topic by its alias when one was assigned.
+        """
+        topic_name = publish_message.topic_name
+        alias = self.outbound_aliases.get(topic_name)
+        # The outbound queue only drops QoS 0 packets, the packet setting an alias must not be dropped
+        queue_qos = qos
+
+        if alias is not None:
+            topic_segment = EMPTY_TOPIC
+            alias_property = bytes((PROPERTY_TOPIC_ALIAS, alias >> 8, alias & 0xFF))
+        elif len(self.outbound_aliases) < self.topic_alias_maximum:
+            alias = self.outbound_aliases[topic_name] = len(self.outbound_aliases) + 1
+            topic_segment = publish_message.get_topic_segment()
+            alias_property = bytes((PROPERTY_TOPIC_ALIAS, alias >> 8, alias & 0xFF))
+            queue_qos = qos or 1
+        else:
+            topic_segment = publish_message.get_topic_segment()
+            alias_property = b''
+
+        properties = encode_remaining_length(len(alias_property) + len(publish_message.properties)) + alias_property + publish_message.properties
+        payload = publish_message.payload
+        flags = (0x08 if dup else 0) | (qos << 1) | (0x01 if retain else 0)
+
+        if qos > 0:
+            remaining_length = len(topic_segment) + 2 + len(properties) + len(payload)
+            header = bytes(((PACKET_TYPE_PUBLISH << 4) | flags,)) + encode_remaining_length(remaining_length)
+            client.send_parts([header, topic_segment, bytes((packet_id >> 8, packet_id & 0xFF)) + properties, payload], queue_qos)
+        else:
+            remaining_length = len(topic_segment) + len(properties) + len(payload)
+            header = bytes(((PACKET_TYPE_PUBLISH << 4) | flags,)) + encode_remaining_length(remaining_length)
+            client.send_parts([header, topic_segment, properties, payload], queue_qos)
@@ -0,0 +1,164 @@
+from Logger import Logger
+from Messages import PublishMessage
+from ClientManager import ClientManager
+from SubscriberManager import SubscriberManager
+from RetainedStore import RetainedStore
+
+SYS_TOPIC_PREFIX = '$SYS/broker/'
+DEFAULT_SYS_INTERVAL = 10
+
+# name -> (Prometheus type, help text), in publishing order
+METRICS = {
+    'clients/connected': ('gauge', 'Connected clients'),
+    'clients/total': ('counter', 'Connections accepted since start'),
+    'messages/received': ('counter', 'Packets received'),
+    'messages/sent': ('counter', 'PUBLISH packets written to subscriber connections'),
+    'messages/dropped': ('counter', 'Messages dropped by full outbound queues and in-flight windows'),
+    'publish/received': ('counter', 'PUBLISH packets received'),
+    'bytes/received': ('counter', 'Bytes received'),
+    'bytes/sent': ('counter', 'Bytes of PUBLISH packets written to subscriber connections'),
+    'subscriptions/count': ('gauge', 'Subscriptions'),
+    'retained/count': ('gauge', 'Retained messages'),
+    'sessions/count': ('gauge', 'Persistent sessions'),
+    'queue/messages': ('gauge', 'Messages in outbound queues'),
+    'queue/bytes': ('gauge', 'Bytes in outbound queues'),
+    'inflight/messages': ('gauge', 'Unacknowledged QoS 1 and 2 deliveries'),
+    'inflight/pending': ('gauge', 'Deliveries waiting for a free in-flight slot'),
+    'load/loop_lag': ('gauge', 'Event loop lag of the last tick in seconds'),
+    'uptime': ('gauge', 'Seconds since start'),
+}
+
+class Metrics:
+    """
+    Broker counters and the snapshot built from them.
+
+    The counters are plain attributes bumped on the packet path. Gauges such as
+    queue depths are only computed when a snapshot is taken, by walking the
+    connected clients, which happens every `interval` seconds when the snapshot
+    is published on the $SYS/broker/ topics.
+    """
+    clients_total: int = 0
+    packets_received: int = 0
+    publish_received: int = 0
+    publish_sent: int = 0
+    bytes_received: int = 0
+    bytes_sent: int = 0
+    # Drops of clients that already disconnected
+    dropped_closed: int = 0
+    loop_lag: float = 0.0
+    uptime: int = 0
+
+    def __init__(self, client_manager: ClientManager, topic_manager: SubscriberManager, retained_store: RetainedStore = None, session_store = None, interval: int = DEFAULT_SYS_INTERVAL, logger: Logger = None):
+        self.client_manager = client_manager
+        self.topic_manager = topic_manager
+        self.retained_store = retained_store
+        self.session_store = session_store
+        self.interval = interval
+        self.logger = logger or Logger()
+
+    def publish_written(self, parts: list):
+        """
+        Count a PUBLISH packet written to a client connection.
+
+        Called by the connection when the packet is handed to the socket, so
+        deliveries dropped before that, by a full queue, a full in-flight window
+        or a size limit, are not counted as sent.
+
+        Parameters:
+        - parts (list): The buffers making up the packet.
+        """
+        self.publish_sent += 1
+
+        for part in parts:
+            self.bytes_sent += len(part)
+
+    def client_closed(self, client):
+        self.dropped_closed += Metrics.__client_dropped(client)
+
+    def snapshot(self) -> dict:
+        """
+        Returns:
+        - dict: The current value of every metric, keyed by the names in METRICS.
+        """
+        queue_messages = queue_bytes = inflight = pending = dropped = 0
+
+        for client in self.client_manager.clients.values():
+            stats = client.queue_stats()
+            queue_messages += stats.get('messages', 0)
+            queue_bytes += stats.get('bytes', 0)
+
+            if client.inflight is not None:
+                inflight += len(client.inflight.messages)
+                pending += len(client.inflight.pending)
+
+            dropped += Metrics.__client_dropped(client)
+
+        return {
+            'clients/connected': len(self.client_manager.clients),
+            'clients/total': self.clients_total,
+            'messages/received': self.packets_received,
+            'messages/sent': self.publish_sent,
+            'messages/dropped': self.dropped_closed + dropped,
+            'publish/received': self.publish_received,
+            'bytes/received': self.bytes_received,
+            'bytes/sent': self.bytes_sent,
+            'subscriptions/count': self.topic_manager.subscription_count,
+            'retained/count': len(self.retained_store.messages) if self.retained_store is not None else 0,
+            'sessions/count': len(self.session_store.sessions) if self.session_store is not None else 0,
+            'queue/messages': queue_messages,
+            'queue/bytes': queue_bytes,
+            'inflight/messages': inflight,
+            'inflight/pending': pending,
+            'load/loop_lag': round(self.loop_lag, 6),
+            'uptime': self.uptime,
+        }
+
+    def publish(self):
+        """
+        Publish the snapshot as retained messages on $SYS/broker/<name>.
+        """
+        try:
+            for name, value in self.snapshot().items():
+                message = PublishMessage.build(SYS_TOPIC_PREFIX + name, str(value).encode(), 0, True)
+
+                if self.retained_store is not None:
+                    self.retained_store.store(message)
+
+                self.topic_manager.publish(message.topic_name, message)
+        except Exception as e:
+            self.logger.error('Error publishing $SYS metrics: %s', e)
+
+    def prometheus(self, labels: dict = None) -> str:
+        """
+        Render the snapshot in the Prometheus text exposition format.
+
+        Parameters:
+        - labels (dict): Labels added to every sample, e.g. the worker the metrics come from.
+        """
+        lines = []
+        label_set = ''
+
+        if labels:
+            label_set = '{' + ','.join(f'{name}="{value}"' for name, value in labels.items()) + '}'
+
+        for name, value in self.snapshot().items():
+            metric_type, help_text = METRICS[name]
+            metric = 'mqtt_' + name.replace('/', '_')
+
+            if metric_type == 'counter' and not metric.endswith('_total'):
+                metric += '_total'
+
+            lines.append(f'# HELP {metric} {help_text}')
+            lines.append(f'# TYPE {metric} {metric_type}')
+            lines.append(f'{metric}{label_set} {value}')
+
+        return '\n'.join(lines) + '\n'
+
+    @staticmethod
+    def __client_dropped(client) -> int:
+        dropped = client.queue_stats().get('dropped', 0)
+
+        if client.inflight is not None:
+            dropped += client.inflight.dropped
+
+        return dropped
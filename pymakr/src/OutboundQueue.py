@@ -0,0 +1,147 @@
+from collections import deque
+
+POLICY_DROP_OLDEST = 'drop_oldest'
+POLICY_DROP_NEW = 'drop_new'
+POLICY_HOLD = 'hold'
+
+DEFAULT_MAX_MESSAGES = 1000
+DEFAULT_MAX_BYTES = 1024 * 1024
+DEFAULT_HARD_LIMIT_MESSAGES = 10000
+DEFAULT_HARD_LIMIT_BYTES = 8 * 1024 * 1024
+
+class OutboundQueueLimits:
+    """
+    Limits and overflow policies for a client's outbound queue.
+
+    The soft limits (`max_messages`, `max_bytes`) decide when the overflow policy
+    for the message's QoS is applied. Messages that are held may grow the queue up
+    to the hard limits, past which the client is disconnected.
+    """
+    max_messages: int
+    max_bytes: int
+    hard_limit_messages: int
+    hard_limit_bytes: int
+    qos0_policy: str
+    qos1_policy: str
+
+    def __init__(self, max_messages: int = DEFAULT_MAX_MESSAGES, max_bytes: int = DEFAULT_MAX_BYTES,
+                 hard_limit_messages: int = DEFAULT_HARD_LIMIT_MESSAGES, hard_limit_bytes: int = DEFAULT_HARD_LIMIT_BYTES,
+                 qos0_policy: str = POLICY_DROP_OLDEST, qos1_policy: str = POLICY_HOLD):
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.hard_limit_messages = hard_limit_messages
+        self.hard_limit_bytes = hard_limit_bytes
+        self.qos0_policy = qos0_policy
+        self.qos1_policy = qos1_policy
+
+class OutboundQueue:
+    """
+    Bounded queue of packets waiting for a client's transport to accept writes.
+
+    The QoS 0 entries are also kept in a queue of their own, so dropping the oldest
+    one does not scan past the held QoS 1 packets. A dropped entry is only marked
+    and skipped by pop(); the marked entries are swept out once they outnumber the
+    queued packets.
+    """
+    limits: OutboundQueueLimits
+    # [parts, size, qos] per packet, parts is None once the packet was dropped
+    entries: deque
+    qos0_entries: deque
+    count: int = 0
+    queued_bytes: int = 0
+    dropped: int = 0
+
+    def __init__(self, limits: OutboundQueueLimits = None):
+        self.limits = limits or OutboundQueueLimits()
+        self.entries = deque()
+        self.qos0_entries = deque()
+        self.count = 0
+        self.queued_bytes = 0
+        self.dropped = 0
+
+    def __len__(self):
+        return self.count
+
+    def push(self, parts: list, qos: int = 0) -> bool:
+        """
+        Queue a packet, applying the overflow policy when the soft limits are reached.
+
+        Parameters:
+        - parts (list): The buffers making up the packet.
+        - qos (int): The QoS of the packet, control packets are queued as QoS 1.
+
+        Returns:
+        - bool: False when the hard limit is exceeded and the client should be disconnected.
+        """
+        size = 0
+        for part in parts:
+            size += len(part)
+
+        if self.__is_full(size):
+            policy = self.limits.qos0_policy if qos == 0 else self.limits.qos1_policy
+
+            if policy == POLICY_DROP_NEW:
+                self.dropped += 1
+                return True
+            elif policy == POLICY_DROP_OLDEST:
+                self.__drop_oldest_qos0(size)
+
+                if self.__is_full(size):
+                    self.dropped += 1
+                    return True
+
+        if self.count + 1 > self.limits.hard_limit_messages or self.queued_bytes + size > self.limits.hard_limit_bytes:
+            return False
+
+        entry = [parts, size, qos]
+        self.entries.append(entry)
+        if qos == 0:
+            self.qos0_entries.append(entry)
+
+        self.count += 1
+        self.queued_bytes += size
+        return True
+
+    def pop(self) -> list:
+        entries = self.entries
+        parts, size, qos = entries.popleft()
+
+        while parts is None:
+            parts, size, qos = entries.popleft()
+
+        if qos == 0:
+            # The oldest queued QoS 0 packet
+            self.qos0_entries.popleft()
+
+        self.count -= 1
+        self.queued_bytes -= size
+        return parts
+
+    def clear(self):
+        self.entries.clear()
+        self.qos0_entries.clear()
+        self.count = 0
+        self.queued_bytes = 0
+
+    def stats(self) -> dict:
+        return {
+            'messages': self.count,
+            'bytes': self.queued_bytes,
+            'dropped': self.dropped,
+        }
+
+    def __is_full(self, size: int) -> bool:
+        return self.count >= self.limits.max_messages or self.queued_bytes + size > self.limits.max_bytes
+
+    def __drop_oldest_qos0(self, size: int):
+        qos0_entries = self.qos0_entries
+
+        while qos0_entries and self.__is_full(size):
+            entry = qos0_entries.popleft()
+            entry[0] = None
+            self.count -= 1
+            self.queued_bytes -= entry[1]
+            self.dropped += 1
+
+        if len(self.entries) > 2 * self.count:
+            self.entries = deque(entry for entry in self.entries if entry[0] is not None)
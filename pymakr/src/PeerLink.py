@@ -0,0 +1,244 @@
+import asyncio
+
+from Client import Client
+from FrameDecoder import FrameDecoder
+from Logger import Logger
+from Messages import MQTTMessage, PublishMessage, SubscribeMessage, UnsubscribeMessage, encode_subscribe, encode_unsubscribe
+from MQTTServer import MQTTClient
+from OutboundQueue import OutboundQueueLimits
+from ProtocolHandler import ProtocolHandler
+from RetainedStore import RetainedStore
+from SubscriberManager import SubscriberManager
+
+class PeerLinkClient(MQTTClient):
+    """
+    A link to another broker, subscribed on behalf of that broker's clients.
+
+    The link speaks plain MQTT framing: SUBSCRIBE and UNSUBSCRIBE announce the topic
+    filters the peer needs, and PUBLISH forwards messages. Packets written during one
+    event loop iteration are batched into a single write.
+    """
+    is_peer = True
+    pending: list
+
+    def __init__(self, client_name: str, transport: asyncio.BaseTransport, peer_manager: 'PeerManager', logger: Logger = None, queue_limits: OutboundQueueLimits = None):
+        super().__init__(client_name, None, transport, logger, queue_limits)
+        self.peer_manager = peer_manager
+        self.pending = []
+
+    def deliver(self, publish_message: PublishMessage, qos: int = 0):
+        self.peer_manager.forward(self, publish_message)
+
+    def send_parts(self, parts: list, qos: int = 0):
+        if not self.pending:
+            asyncio.get_running_loop().call_soon(self.flush)
+
+        self.pending.append((parts, qos))
+
+    def flush(self):
+        pending = self.pending
+        self.pending = []
+
+        if self.transport.is_closing():
+            return
+
+        if self.writing_paused or len(self.queue):
+            for parts, qos in pending:
+                MQTTClient.send_parts(self, parts, qos)
+            return
+
+        buffers = []
+        for parts, _ in pending:
+            buffers.extend(parts)
+
+        MQTTClient.send_parts(self, buffers)
+
+class PeerManager(ProtocolHandler):
+    """
+    Shares the subscription view of this broker with its peer links.
+
+    A filter is announced to a link once, when the first subscriber that link should
+    forward for appears, and withdrawn when the last one goes away. Peers therefore
+    only forward the messages this broker needs.
+
+    When `transitive` is False (a full mesh of workers) only filters of local clients
+    are announced and messages received from a peer are never forwarded again. Retained
+    messages are then sent to every link whatever its filters, so each worker keeps the
+    full retained store for clients that subscribe later. When `transitive` is True,
+    filters learned from one link are announced to the other links as well, never back
+    to the link they came from.
+    """
+    topic_manager: SubscriberManager
+    links: list
+    local_filters: dict
+    peer_filters: dict
+    advertised: dict
+    retained_store: RetainedStore = None
+    transitive: bool = False
+
+    def __init__(self, topic_manager: SubscriberManager, logger: Logger = None, transitive: bool = False, retained_store: RetainedStore = None):
+        self.topic_manager = topic_manager
+        self.retained_store = retained_store
+        self.transitive = transitive
+        self.links = []
+        # topic filter -> number of local subscriptions
+        self.local_filters = {}
+        # topic filter -> links subscribed to it
+        self.peer_filters = {}
+        # link -> topic filters announced to it
+        self.advertised = {}
+        self.logger = logger or Logger()
+        topic_manager.add_listener(self)
+
+        if retained_store is not None and not transitive:
+            retained_store.add_listener(self)
+
+    def add_link(self, link: Client):
+        self.links.append(link)
+        self.advertised[link] = set()
+
+        for topic in list(self.local_filters) + list(self.peer_filters):
+            self.__update_link(link, topic)
+
+    def remove_link(self, link: Client):
+        if link in self.links:
+            self.links.remove(link)
+
+        self.advertised.pop(link, None)
+        self.topic_manager.remove_client(link)
+
+    def forward(self, link: Client, publish_message: PublishMessage):
+        if publish_message.origin is not None:
+            # Every peer subscribed to the topic already received it from the origin
+            return
+
+        if publish_message.retain and self.replicates_retained():
+            # Already sent to every link by on_retain
+            return
+
+        PeerManager.send_publish(link, publish_message)
+
+    def replicates_retained(self) -> bool:
+        return self.retained_store is not None and not self.transitive
+
+    def on_retain(self, publish_message: PublishMessage):
+        if publish_message.origin is not None:
+            return
+
+        for link in self.links:
+            PeerManager.send_publish(link, publish_message)
+
+    @staticmethod
+    def send_publish(link: Client, publish_message: PublishMessage):
+        qos = publish_message.qos
+        packet_id = link.next_packet_id() if qos > 0 else None
+        link.send_parts(publish_message.write_for(qos, packet_id, publish_message.retain), qos)
+
+    def on_subscribe(self, topic, client: Client):
+        if not client.is_peer:
+            self.local_filters[topic] = self.local_filters.get(topic, 0) + 1
+        elif self.transitive:
+            self.peer_filters.setdefault(topic, set()).add(client)
+        else:
+            return
+
+        self.__update(topic)
+
+    def on_unsubscribe(self, topic, client: Client):
+        if not client.is_peer:
+            count = self.local_filters.get(topic, 0) - 1
+
+            if count > 0:
+                self.local_filters[topic] = count
+            else:
+                self.local_filters.pop(topic, None)
+        elif self.transitive:
+            links = self.peer_filters.get(topic)
+
+            if links is not None:
+                links.discard(client)
+                if not links:
+                    del self.peer_filters[topic]
+        else:
+            return
+
+        self.__update(topic)
+
+    def __update(self, topic):
+        for link in self.links:
+            self.__update_link(link, topic)
+
+    def __update_link(self, link: Client, topic):
+        links = self.peer_filters.get(topic, ())
+        wanted = topic in self.local_filters or len(links) > 1 or (len(links) == 1 and link not in links)
+        advertised = self.advertised[link]
+
+        if wanted and topic not in advertised:
+            advertised.add(topic)
+            link.send(encode_subscribe(link.next_packet_id(), topic))
+        elif not wanted and topic in advertised:
+            advertised.discard(topic)
+            link.send(encode_unsubscribe(link.next_packet_id(), topic))
+
+    def handle(self, client: Client, msg: bytes):
+        try:
+            message = MQTTMessage.create(msg)
+            message.handle_message(self, client)
+        except Exception as e:
+            self.logger.error('Error in peer link %s: %s', client.client_name, e)
+
+    def handle_publish(self, client: Client, publish_message: PublishMessage):
+        publish_message.origin = client
+
+        if publish_message.retain and self.retained_store is not None:
+            self.retained_store.store(publish_message)
+
+        self.topic_manager.publish(publish_message.topic_name, publish_message)
+
+    def handle_subscribe(self, client: Client, subscribe_message: SubscribeMessage):
+        self.topic_manager.subscribe_many(subscribe_message.topics, client)
+
+    def handle_unsubscribe(self, client: Client, unsubscribe_message: UnsubscribeMessage):
+        self.topic_manager.unsubscribe_many(unsubscribe_message.topics, client)
+
+class PeerLinkProtocol(asyncio.Protocol):
+    link: PeerLinkClient = None
+    closed: asyncio.Future = None
+
+    def __init__(self, peer_manager: PeerManager, link_name: str = None, logger: Logger = None, queue_limits: OutboundQueueLimits = None):
+        self.peer_manager = peer_manager
+        self.link_name = link_name
+        self.logger = logger or Logger()
+        self.queue_limits = queue_limits
+        self.decoder = FrameDecoder()
+
+    def connection_made(self, transport):
+        self.closed = asyncio.get_running_loop().create_future()
+
+        if self.link_name is None:
+            self.link_name = f'peer-{transport.get_extra_info("peername")}'
+
+        self.link = PeerLinkClient(self.link_name, transport, self.peer_manager, self.logger, self.queue_limits)
+        self.logger.info('Peer link %s established', self.link_name)
+        self.peer_manager.add_link(self.link)
+
+    def data_received(self, data):
+        try:
+            for frame in self.decoder.feed(data):
+                self.peer_manager.handle(self.link, frame)
+        except ValueError as e:
+            self.logger.error('Error decoding data from peer %s: %s', self.link_name, e)
+            self.link.close()
+
+    def pause_writing(self):
+        self.link.pause_writing()
+
+    def resume_writing(self):
+        self.link.resume_writing()
+
+    def connection_lost(self, exc):
+        self.logger.warning('Peer link %s lost %s', self.link_name, exc)
+        self.peer_manager.remove_link(self.link)
+
+        if not self.closed.done():
+            self.closed.set_result(exc)
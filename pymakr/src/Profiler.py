@@ -0,0 +1,150 @@
+import asyncio
+import io
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+from Logger import Logger
+
+MODE_CPROFILE = 'cprofile'
+MODE_SAMPLER = 'sampler'
+
+DEFAULT_PROFILE_SECONDS = 10
+DEFAULT_SAMPLE_INTERVAL = 0.005
+REPORT_LINES = 15
+
+class WallClockSampler:
+    """
+    Samples the stack of one thread at a fixed wall-clock interval from a background thread.
+
+    Unlike cProfile it adds no overhead to the sampled code and also sees time spent
+    blocked, at the cost of statistical results. Stacks are counted in the collapsed
+    format used by flame graph tools.
+    """
+    def __init__(self, thread_id: int, interval: float = DEFAULT_SAMPLE_INTERVAL):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self.samples = 0
+        self.__running = False
+        self.__thread = None
+
+    def start(self):
+        self.__running = True
+        self.__thread = threading.Thread(target=self.__run, name='profile-sampler', daemon=True)
+        self.__thread.start()
+
+    def stop(self):
+        self.__running = False
+        self.__thread.join()
+
+    def dump(self, path: str):
+        with open(path, 'w') as file:
+            for stack, count in self.stacks.most_common():
+                file.write(f'{stack} {count}\n')
+
+    def report(self) -> str:
+        leaves = Counter()
+        for stack, count in self.stacks.items():
+            leaves[stack.rsplit(';', 1)[-1]] += count
+
+        lines = [f'{self.samples} samples, top functions:']
+        for function, count in leaves.most_common(REPORT_LINES):
+            lines.append(f'{count / max(self.samples, 1):7.1%}  {function}')
+
+        return '\n'.join(lines)
+
+    def __run(self):
+        while self.__running:
+            frame = sys._current_frames().get(self.thread_id)
+
+            if frame is not None:
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f'{os.path.basename(code.co_filename)}:{code.co_name}')
+                    frame = frame.f_back
+
+                self.stacks[';'.join(reversed(stack))] += 1
+                self.samples += 1
+
+            time.sleep(self.interval)
+
+class Profiler:
+    """
+    Runs cProfile or the wall-clock sampler on the running broker for a number of
+    seconds and dumps the result, without restarting the process.
+
+    Parameters:
+    - output_dir (str): Where the profile files are written.
+    - logger (Logger): Receives the summary of every finished profile.
+    """
+    def __init__(self, output_dir: str = '.', logger: Logger = None):
+        self.output_dir = output_dir
+        self.logger = logger or Logger()
+        self.__active = None
+
+    def is_running(self) -> bool:
+        return self.__active is not None
+
+    def start(self, seconds: float = DEFAULT_PROFILE_SECONDS, mode: str = MODE_CPROFILE) -> bool:
+        """
+        Start profiling the event loop thread, must be called from that thread.
+
+        Returns:
+        - bool: False when a profile is already running.
+        """
+        if self.__active is not None:
+            self.logger.warning('A profile is already running')
+            return False
+
+        if mode == MODE_SAMPLER:
+            profile = WallClockSampler(threading.get_ident())
+            profile.start()
+        else:
+            import cProfile
+            profile = cProfile.Profile()
+            profile.enable()
+
+        self.__active = (mode, profile)
+        asyncio.get_running_loop().call_later(seconds, self.stop)
+        self.logger.info('Profiling with %s for %s seconds', mode, seconds)
+        return True
+
+    def stop(self) -> str:
+        """
+        Stop the running profile and write it to the output directory.
+
+        Returns:
+        - str: The path of the written profile, None when no profile was running.
+        """
+        if self.__active is None:
+            return None
+
+        mode, profile = self.__active
+        self.__active = None
+        name = os.path.join(self.output_dir, f'profile-{os.getpid()}-{time.strftime("%Y%m%d-%H%M%S")}')
+
+        try:
+            if mode == MODE_SAMPLER:
+                profile.stop()
+                path = name + '.folded'
+                profile.dump(path)
+                report = profile.report()
+            else:
+                import pstats
+                profile.disable()
+                path = name + '.pstats'
+                profile.dump_stats(path)
+
+                stream = io.StringIO()
+                pstats.Stats(profile, stream=stream).sort_stats('cumulative').print_stats(REPORT_LINES)
+                report = stream.getvalue()
+        except OSError as e:
+            self.logger.error('Error writing profile: %s', e)
+            return None
+
+        self.logger.info('Profile written to %s\n%s', path, report)
+        return path
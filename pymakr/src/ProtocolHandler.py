@@ -10,6 +10,18 @@ class ProtocolHandler:
     def handle_publish(self, client: Client, publish_message):
         pass
 
+    def handle_puback(self, client: Client, puback_message):
+        pass
+
+    def handle_pubrec(self, client: Client, pubrec_message):
+        pass
+
+    def handle_pubrel(self, client: Client, pubrel_message):
+        pass
+
+    def handle_pubcomp(self, client: Client, pubcomp_message):
+        pass
+
     def handle_subscribe(self, client: Client, subscribe_message):
         pass
 
@@ -21,3 +33,6 @@ class ProtocolHandler:
 
     def handle_disconnect(self, client: Client, disconnect_message):
         pass
+
+    def handle_connection_lost(self, client: Client):
+        pass
@@ -1,10 +1,18 @@
 from Logger import Logger
 from Client import Client, ClientSettings
 from ProtocolHandler import ProtocolHandler
-from Messages import ConnAckMessage, ConnectMessage, DisconnectMessage, MQTTMessage, PingReqMessage, PingRespMessage, PubAckMessage, PublishMessage, SubAckMessage, SubscribeMessage, UnSubAckMessage, UnsubscribeMessage
+from Messages import ConnectMessage, DisconnectMessage, MQTTMessage, PingReqMessage, PubAckMessage, PubCompMessage, PubRecMessage, PubRelMessage, PublishMessage, SubscribeMessage, UnsubscribeMessage, PINGRESP_PACKET, PROTOCOL_VERSION_V311, SUBACK_FAILURE, encode_ack, encode_connack, encode_suback
 from ClientManager import ClientManager
 from Authenticator import Authenticator
-from SubscriberManager import SubscriberManager
+from SubscriberManager import SubscriberManager, is_valid_filter
+from FlowController import FlowController
+from RetainedStore import RetainedStore
+from SessionStore import SessionStore
+from TimerWheel import TimerWheel
+from Metrics import Metrics
+from TopicAcl import TopicAcl
+from StageTimings import StageTimings, clock_ns, STAGE_AUTH, STAGE_DECODE, STAGE_FANOUT, STAGE_MATCH, STAGE_TOTAL
+from InflightWindow import AwaitingRelease, InflightWindow, DEFAULT_RECEIVE_MAXIMUM, DEFAULT_RETRY_INTERVAL, DEFAULT_RELEASE_TIMEOUT
 
 PACKET_TYPE_CONNECT = 1
 PACKET_TYPE_CONNACK = 2
@@ -21,25 +29,83 @@ PACKET_TYPE_PINGREQ = 12
 PACKET_TYPE_PINGRESP = 13
 PACKET_TYPE_DISCONNECT = 14
 
+# Clients are disconnected after 1.5 times their keep-alive without a packet
+KEEP_ALIVE_GRACE = 1.5
+# Packets a client may send while its credentials are being verified
+MAX_PENDING_PACKETS = 100
+
 class ProtocolHandlerV311(ProtocolHandler):
     SUPPORTED_PROTOCOLS = ['MQTT']
+    SUPPORTED_VERSIONS = [PROTOCOL_VERSION_V311]
 
-    def __init__(self, authenticator: Authenticator, topic_manager: SubscriberManager, client_manager: ClientManager, logger=None):
+    def __init__(self, authenticator: Authenticator, topic_manager: SubscriberManager, client_manager: ClientManager, logger=None, flow_controller: FlowController = None, retained_store: RetainedStore = None, session_store: SessionStore = None, receive_maximum: int = DEFAULT_RECEIVE_MAXIMUM, retry_interval: float = DEFAULT_RETRY_INTERVAL, metrics: Metrics = None, timings: StageTimings = None, acl: TopicAcl = None):
         self.authenticator = authenticator
         self.topic_manager = topic_manager
         self.client_manager = client_manager
         self.logger = logger or Logger()
+        self.flow_controller = flow_controller
+        self.retained_store = retained_store
+        self.session_store = session_store
+        self.receive_maximum = receive_maximum
+        self.retry_interval = retry_interval
+        self.metrics = metrics
+        self.timings = timings or StageTimings()
+        self.acl = acl
+        # Ticks once per second, driven by the server
+        self.keep_alive_timers = TimerWheel()
+        # Clients with unacknowledged deliveries or QoS 2 packet ids waiting for PUBREL,
+        # the only ones retransmit() visits
+        self.retry_clients = set()
 
     def handle(self, client: Client, msg: bytes):
+        # Any packet counts as activity, the keep-alive timer checks it when it fires
+        client.last_activity = self.keep_alive_timers.now
+
+        if client.pending_packets is not None:
+            if len(client.pending_packets) >= MAX_PENDING_PACKETS:
+                self.logger.warning('Too many packets from %s before its CONNECT was accepted', client.client_name)
+                client.close()
+                return
+
+            # The frame may be a view of a receive buffer
+            client.pending_packets.append(bytes(msg))
+            return
+
+        if self.metrics is not None:
+            self.metrics.packets_received += 1
+
+        if self.timings.enabled:
+            self.__handle_timed(client, msg)
+            return
+
+        try:
+            message = self.decode(client, msg)
+
+            if (not issubclass(type(message), MQTTMessage)):
+                raise ValueError('Unsupported message type')
+
+            message.handle_message(self, client)
+        except Exception as e:
+            self.logger.error('Error in handle: %s', e)
+
+    def __handle_timed(self, client: Client, msg: bytes):
         try:
-            message = MQTTMessage.create(msg)
+            started = clock_ns()
+            message = self.decode(client, msg)
+            decoded = clock_ns()
 
             if (not issubclass(type(message), MQTTMessage)):
                 raise ValueError('Unsupported message type')
 
             message.handle_message(self, client)
+
+            self.timings.record(message.packet_type, STAGE_DECODE, decoded - started)
+            self.timings.record(message.packet_type, STAGE_TOTAL, clock_ns() - started)
         except Exception as e:
-            self.logger.error(f'Error in handle: {e}')
+            self.logger.error('Error in handle: %s', e)
+
+    def decode(self, client: Client, msg: bytes) -> MQTTMessage:
+        return MQTTMessage.create(msg)
 
     def handle_connect(self, client: Client, connect_message: ConnectMessage):
         try:
@@ -50,81 +116,408 @@ class ProtocolHandlerV311(ProtocolHandler):
                 connect_message.connect_flags,
                 connect_message.keep_alive)
 
-            self.logger.debug(f'Protocol Name: {client.settings.protocol_name} {client.settings.protocol_version} from {client.settings.client_id} - {client.settings.connect_flags} - {client.settings.keep_alive}')
+            self.logger.debug('Protocol Name: %s %s from %s - %s - %s', client.settings.protocol_name, client.settings.protocol_version, client.settings.client_id, client.settings.connect_flags, client.settings.keep_alive)
 
-            if client.settings.protocol_name not in ProtocolHandlerV311.SUPPORTED_PROTOCOLS:
+            if client.settings.protocol_name not in self.SUPPORTED_PROTOCOLS:
                 raise ValueError('Unsupported protocol')
 
+            if client.settings.protocol_version not in self.SUPPORTED_VERSIONS:
+                raise ValueError(f'Unsupported protocol version {client.settings.protocol_version}')
+
             if not client.settings.client_id:
                 raise ValueError('Client ID must not be empty')
 
-            if not connect_message.authenticate(self.authenticator):
-                raise ValueError('Authentication failed')
+            if not connect_message.needs_authentication:
+                if not self.authenticator.allow_anonymous:
+                    self.logger.warning('Refusing %s, no credentials given', client.client_name)
+                    self.refuse(client, 5) # Connection Refused, not authorized
+                    return
+
+                self.__accept(client, connect_message)
+                return
 
-            ConnAckMessage(0, 0).send_to(client)
-            self.logger.debug(f'Client connected: {client.settings.client_id}')
+            # Packets arriving before the credentials are verified wait for the outcome
+            client.pending_packets = []
+            started = clock_ns() if self.timings.enabled else 0
+            connect_message.verify(self.authenticator, lambda authenticated: self.__authenticated(client, connect_message, authenticated, started))
 
         except ValueError as ve:
-            self.logger.error(f'Error in handle_connect: {ve}')
-            ConnAckMessage(0, 1).send_to(client) # Connection Refused, unacceptable protocol version
-            client.close()
+            self.logger.error('Error in handle_connect: %s', ve)
+            self.refuse(client, 1) # Connection Refused, unacceptable protocol version
         except Exception as e:
-            self.logger.error(f'Error in handle_connect: {e}')
-            ConnAckMessage(0, 2).send_to(client) # Connection Refused, identifier rejected
-            client.close()
+            self.logger.error('Error in handle_connect: %s', e)
+            self.refuse(client, 2) # Connection Refused, identifier rejected
+
+    def refuse(self, client: Client, return_code: int):
+        """
+        Answer the CONNECT with a CONNACK refusing the connection and close it.
+        """
+        client.send(encode_connack(0, return_code))
+        client.close()
+
+    def __authenticated(self, client: Client, connect_message: ConnectMessage, authenticated: bool, started: int):
+        if started:
+            self.timings.record(PACKET_TYPE_CONNECT, STAGE_AUTH, clock_ns() - started)
+
+        pending, client.pending_packets = client.pending_packets, None
+
+        if pending is None or self.client_manager.get_client(client.client_name) is not client:
+            # The connection was lost while the credentials were being verified
+            return
+
+        if not authenticated:
+            self.logger.warning('Authentication failed for %s', client.client_name)
+            self.refuse(client, 4) # Connection Refused, bad user name or password
+            return
+
+        self.__accept(client, connect_message)
+
+        for msg in pending:
+            self.handle(client, msg)
+
+    def __accept(self, client: Client, connect_message: ConnectMessage):
+        try:
+            if client.settings.keep_alive > 0:
+                client.keep_alive_ticks = int(client.settings.keep_alive * KEEP_ALIVE_GRACE + 0.5)
+                self.keep_alive_timers.schedule(client, client.keep_alive_ticks)
+
+            if self.acl is not None:
+                client.acl = self.acl.for_client(connect_message.username, client.settings.client_id)
+
+            if connect_message.flag_will_flag:
+                if client.acl is not None and not client.acl.can_publish(connect_message.will_topic):
+                    self.logger.warning('Dropping the will of %s, it may not publish to %s', client.settings.client_id, connect_message.will_topic)
+                else:
+                    client.will = PublishMessage.build(connect_message.will_topic, connect_message.will_message, connect_message.flag_will_qos, connect_message.flag_will_retain)
+
+            client.inflight = self.create_inflight(client)
+            client.awaiting_release = AwaitingRelease(logger=self.logger)
+
+            session_present = False
+            if self.session_store is not None:
+                session_present = self.open_session(client, connect_message.flag_clean_session)
+
+                if client.awaiting_release:
+                    self.retry_clients.add(client)
+
+            self.send_connack(client, session_present)
+            self.logger.debug('Client connected: %s', client.settings.client_id)
+
+            if self.metrics is not None:
+                self.metrics.clients_total += 1
+
+            if client.session is not None:
+                # Queued messages are removed from the session once the client acknowledges them
+                for publish_message in self.session_store.resume(client.session):
+                    publish_message.send_to_subscriber(client, publish_message.qos)
+
+        except Exception as e:
+            self.logger.error('Error in handle_connect: %s', e)
+            self.refuse(client, 2) # Connection Refused, identifier rejected
+
+    def create_inflight(self, client: Client) -> InflightWindow:
+        return InflightWindow(self.receive_maximum, retry_clients=self.retry_clients, logger=self.logger)
+
+    def open_session(self, client: Client, clean_session: bool) -> bool:
+        """
+        Discard the stored session of a connecting client, or attach the client to it.
+
+        Returns:
+        - bool: True when an existing session was resumed.
+        """
+        if clean_session:
+            self.session_store.discard(client.settings.client_id, self.topic_manager)
+            return False
+
+        client.session, session_present = self.session_store.attach(client.settings.client_id, client, self.topic_manager)
+
+        if client.session.awaiting_release is not None:
+            client.awaiting_release = client.session.awaiting_release
+
+        return session_present
+
+    def send_connack(self, client: Client, session_present: bool):
+        client.send(encode_connack(1 if session_present else 0, 0))
 
     def handle_publish(self, client: Client, publish_message: PublishMessage):
         try:
             if not publish_message.topic_name:
                 raise ValueError('Topic must not be empty')
 
-            self.logger.receive(f'Received message: {publish_message.payload} on topic: {publish_message.topic_name}')
-            self.topic_manager.publish(publish_message.topic_name, publish_message)
-            self.logger.send(f'{publish_message.payload} published to topic: {publish_message.topic_name}')
+            self.logger.receive('Received message of %d bytes on topic: %s', publish_message.payload_length, publish_message.topic_name)
+
+            if publish_message.qos == 2:
+                if client.awaiting_release is None:
+                    client.awaiting_release = AwaitingRelease(logger=self.logger)
+                self.retry_clients.add(client)
+
+                if not client.awaiting_release.add(publish_message.packet_id):
+                    # Retransmission of a message that was already published, only acknowledge it
+                    client.send(encode_ack(PACKET_TYPE_PUBREC, publish_message.packet_id))
+                    return
+
+            if client.acl is not None and not client.acl.can_publish(publish_message.topic_name):
+                # MQTT 3.1.1 has no negative acknowledgement, the message is acknowledged and dropped
+                self.logger.warning('Client %s may not publish to %s', client.client_name, publish_message.topic_name)
+            else:
+                self.publish(client, publish_message)
 
             if publish_message.qos == 1:  # QoS 1
-                PubAckMessage(publish_message).send_to(client)
+                client.send(encode_ack(PACKET_TYPE_PUBACK, publish_message.packet_id))
             elif publish_message.qos == 2:  # QoS 2
-                raise NotImplementedError('QoS 2 not supported')
+                client.send(encode_ack(PACKET_TYPE_PUBREC, publish_message.packet_id))
 
         except Exception as e:
-            self.logger.error(f'Error in handle_publish: {e}')
+            self.logger.error('Error in handle_publish: %s', e)
+
+    def publish(self, client: Client, publish_message: PublishMessage) -> tuple:
+        """
+        Retain and deliver a message received from a client.
+
+        Returns:
+        - tuple: The subscriptions the message was delivered to.
+        """
+        if publish_message.retain and self.retained_store is not None:
+            self.retained_store.store(publish_message)
+
+        if self.timings.enabled:
+            started = clock_ns()
+            subscriptions = self.topic_manager.match(publish_message.topic_name)
+            matched = clock_ns()
+            self.topic_manager.deliver(subscriptions, publish_message)
+            self.timings.record(PACKET_TYPE_PUBLISH, STAGE_MATCH, matched - started)
+            self.timings.record(PACKET_TYPE_PUBLISH, STAGE_FANOUT, clock_ns() - matched)
+        else:
+            subscriptions = self.topic_manager.publish(publish_message.topic_name, publish_message)
+
+        if self.metrics is not None:
+            self.metrics.publish_received += 1
+
+        if self.flow_controller is not None:
+            self.flow_controller.check(client, subscriptions)
+        self.logger.send('Published to %d subscribers on topic: %s', len(subscriptions), publish_message.topic_name)
+        return subscriptions
+
+    def acknowledge(self, client: Client, packet_id: int) -> bool:
+        """
+        Complete an outbound delivery, removing it from the client's session when it was queued there.
+
+        Returns:
+        - bool: False when no message with this packet id was in flight.
+        """
+        publish_message = client.inflight.acknowledge(client, packet_id) if client.inflight is not None else None
+        if publish_message is None:
+            return False
+
+        if client.session is not None:
+            self.session_store.acknowledge(client.session, publish_message)
+
+        return True
+
+    def handle_puback(self, client: Client, puback_message: PubAckMessage):
+        try:
+            if not self.acknowledge(client, puback_message.packet_id):
+                self.logger.warning('Unexpected PUBACK %s from %s', puback_message.packet_id, client.client_name)
+
+        except Exception as e:
+            self.logger.error('Error in handle_puback: %s', e)
+
+    def handle_pubrec(self, client: Client, pubrec_message: PubRecMessage):
+        try:
+            if client.inflight is None or not client.inflight.release(client, pubrec_message.packet_id):
+                self.logger.warning('Unexpected PUBREC %s from %s', pubrec_message.packet_id, client.client_name)
+                client.send(encode_ack(PACKET_TYPE_PUBREL, pubrec_message.packet_id))
+
+        except Exception as e:
+            self.logger.error('Error in handle_pubrec: %s', e)
+
+    def handle_pubrel(self, client: Client, pubrel_message: PubRelMessage):
+        try:
+            if client.awaiting_release is None or not client.awaiting_release.release(pubrel_message.packet_id):
+                self.logger.warning('Unexpected PUBREL %s from %s', pubrel_message.packet_id, client.client_name)
+
+            # PUBCOMP is sent for unknown packet ids too, the client may be retrying after a lost PUBCOMP
+            client.send(encode_ack(PACKET_TYPE_PUBCOMP, pubrel_message.packet_id))
+
+        except Exception as e:
+            self.logger.error('Error in handle_pubrel: %s', e)
+
+    def handle_pubcomp(self, client: Client, pubcomp_message: PubCompMessage):
+        try:
+            if not self.acknowledge(client, pubcomp_message.packet_id):
+                self.logger.warning('Unexpected PUBCOMP %s from %s', pubcomp_message.packet_id, client.client_name)
+
+        except Exception as e:
+            self.logger.error('Error in handle_pubcomp: %s', e)
 
     def handle_subscribe(self, client: Client, subscribe_message: SubscribeMessage):
         try:
-            self.topic_manager.subscribe(subscribe_message.topic, client)
+            granted = []
+            return_codes = bytearray()
+
+            for topic, qos in subscribe_message.topics:
+                if qos > 2 or not is_valid_filter(topic):
+                    self.logger.warning('Refusing subscription of %s to %s with QoS %d', client.client_name, topic, qos)
+                    return_codes.append(SUBACK_FAILURE)
+                    continue
+
+                if client.acl is not None and not client.acl.can_subscribe(topic):
+                    self.logger.warning('Client %s may not subscribe to %s', client.client_name, topic)
+                    return_codes.append(SUBACK_FAILURE)
+                    continue
 
-            self.logger.info(f"Client subscribed to topics: {subscribe_message.topic}")
+                granted.append((topic, qos))
+                return_codes.append(qos)
 
-            SubAckMessage(subscribe_message).send_to(client)
+            self.topic_manager.subscribe_many(granted, client)
+
+            if client.session is not None:
+                for topic, qos in granted:
+                    self.session_store.subscribe(client.session, topic, qos)
+
+            self.logger.debug('Client subscribed to topics: %s', granted)
+
+            client.send(encode_suback(subscribe_message.packet_id, return_codes))
+
+            if self.retained_store is not None:
+                for topic, qos in granted:
+                    for retained_message in self.retained_store.match(topic):
+                        retained_message.send_to_subscriber(client, qos, True)
 
         except Exception as e:
-            self.logger.error(f'Error in handle_subscribe: {e}')
+            self.logger.error('Error in handle_subscribe: %s', e)
 
     def handle_unsubscribe(self, client: Client, unsubscribe_message: UnsubscribeMessage):
         try:
-            for topic in unsubscribe_message.topics:
-                self.topic_manager.unsubscribe(topic, client)
-                self.logger.info(f"Client unsubscribed from topic: {topic}")
+            self.topic_manager.unsubscribe_many(unsubscribe_message.topics, client)
+
+            if client.session is not None:
+                for topic in unsubscribe_message.topics:
+                    self.session_store.unsubscribe(client.session, topic)
+
+            self.logger.debug('Client unsubscribed from topics: %s', unsubscribe_message.topics)
 
             # Send UnsubAck message back to the client
-            UnSubAckMessage(unsubscribe_message).send_to(client)
+            client.send(encode_ack(PACKET_TYPE_UNSUBACK, unsubscribe_message.packet_id))
 
         except Exception as e:
-            self.logger.error(f'Error in handle_unsubscribe: {e}')
+            self.logger.error('Error in handle_unsubscribe: %s', e)
 
     def handle_pingreq(self, client: Client, pingreq_message: PingReqMessage):
         try:
-            self.logger.info('Received PINGREQ')
-            PingRespMessage(pingreq_message).send_to(client)
+            self.logger.debug('Received PINGREQ')
+            client.send(PINGRESP_PACKET)
 
         except Exception as e:
-            self.logger.error(f'Error sending PINGRESP: {e}')
+            self.logger.error('Error sending PINGRESP: %s', e)
 
     def handle_disconnect(self, client: Client, disconnect_message: DisconnectMessage):
         try:
-            self.logger.info('Client disconnected')
-            self.client_manager.remove_client(client)
+            self.logger.debug('Client disconnected')
+            # A clean disconnect discards the will
+            client.will = None
+            self.handle_connection_lost(client)
             client.close()
         except Exception as e:
-            self.logger.error(f'Error handling disconnect: {e}')
+            self.logger.error('Error handling disconnect: %s', e)
+
+    def disconnect(self, client: Client, reason_code: int):
+        """
+        Close the connection of a client violating the protocol. MQTT 3.1.1 has no
+        DISCONNECT from the server, so the reason is not sent.
+        """
+        client.close()
+
+    def handle_connection_lost(self, client: Client):
+        try:
+            client.pending_packets = None
+
+            if self.metrics is not None and self.client_manager.get_client(client.client_name) is client:
+                self.metrics.client_closed(client)
+
+            self.topic_manager.remove_client(client)
+            self.client_manager.remove_client(client)
+            self.keep_alive_timers.cancel(client)
+            self.retry_clients.discard(client)
+
+            if client.inflight is not None:
+                unacknowledged = client.inflight.drain()
+                client.inflight = None
+
+                # Messages the client did not acknowledge are delivered again when it resumes its session
+                if client.session is not None:
+                    self.session_store.requeue(client.session, unacknowledged)
+
+            if client.session is not None:
+                client.session.awaiting_release = client.awaiting_release if client.awaiting_release else None
+                self.session_store.detach(client.session, self.topic_manager)
+                client.session = None
+
+            client.awaiting_release = None
+
+            if self.flow_controller is not None:
+                self.flow_controller.remove_client(client)
+
+            if client.will is not None:
+                will, client.will = client.will, None
+                self.publish_will(will)
+        except Exception as e:
+            self.logger.error('Error removing client: %s', e)
+
+    def publish_will(self, will: PublishMessage):
+        try:
+            self.logger.info('Publishing will message on topic: %s', will.topic_name)
+
+            if will.retain and self.retained_store is not None:
+                self.retained_store.store(will)
+
+            self.topic_manager.publish(will.topic_name, will)
+        except Exception as e:
+            self.logger.error('Error in publish_will: %s', e)
+
+    def tick(self):
+        """
+        Advance the broker timers by one second. Called periodically by the server.
+        """
+        for client in self.keep_alive_timers.tick():
+            idle = self.keep_alive_timers.now - client.last_activity
+
+            if idle < client.keep_alive_ticks:
+                # Packets arrived since the timer was set, wait for the rest of the timeout
+                self.keep_alive_timers.schedule(client, client.keep_alive_ticks - idle)
+                continue
+
+            try:
+                self.logger.warning('Keep-alive timeout, disconnecting %s', client.client_name)
+                client.abort()
+            except Exception as e:
+                self.logger.error('Error in tick: %s', e)
+
+        self.retransmit()
+
+        if self.metrics is not None:
+            self.metrics.uptime += 1
+
+            if self.metrics.uptime % self.metrics.interval == 0:
+                self.metrics.publish()
+
+    def retransmit(self):
+        """
+        Resend the deliveries that were not acknowledged within the retry interval and forget
+        inbound QoS 2 packet ids whose PUBREL never arrived. Called periodically by the server.
+        """
+        for client in list(self.retry_clients):
+            try:
+                inflight = client.inflight
+                if inflight is not None:
+                    inflight.retransmit(client, self.retry_interval)
+
+                if client.awaiting_release:
+                    client.awaiting_release.expire(DEFAULT_RELEASE_TIMEOUT)
+
+                # Forgotten once everything was acknowledged, added again by the next delivery
+                resending = inflight is not None and inflight.retry_on_timeout and inflight.messages
+                if not resending and not client.awaiting_release:
+                    self.retry_clients.discard(client)
+            except Exception as e:
+                self.logger.error('Error in retransmit: %s', e)
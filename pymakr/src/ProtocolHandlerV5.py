@@ -0,0 +1,313 @@
+import os
+
+from Client import Client
+from Authenticator import Authenticator
+from ClientManager import ClientManager
+from SubscriberManager import SubscriberManager, is_valid_filter
+from FlowController import FlowController
+from RetainedStore import RetainedStore
+from SessionStore import SessionStore
+from Metrics import Metrics
+from TopicAcl import TopicAcl
+from StageTimings import StageTimings
+from InflightWindow import AwaitingRelease, InflightWindow, DEFAULT_RECEIVE_MAXIMUM, DEFAULT_RETRY_INTERVAL
+from Messages import ConnectMessage, DisconnectMessage, MQTTMessage, PubRecMessage, PublishMessage, SubscribeMessage, UnsubscribeMessage, PROTOCOL_VERSION_V311, PROTOCOL_VERSION_V5
+from MessagesV5 import (ConnectionV5, create_message_v5, decode_properties, encode_ack_v5, encode_connack_v5, encode_disconnect_v5, encode_properties, encode_suback_v5, encode_unsuback_v5,
+                        CONNACK_REASON_CODES, DEFAULT_RECEIVE_MAXIMUM as DEFAULT_CLIENT_RECEIVE_MAXIMUM, RETAIN_HANDLING_SEND, RETAIN_HANDLING_SEND_IF_NEW,
+                        PROPERTY_ASSIGNED_CLIENT_IDENTIFIER, PROPERTY_AUTHENTICATION_METHOD, PROPERTY_MAXIMUM_PACKET_SIZE, PROPERTY_RECEIVE_MAXIMUM, PROPERTY_RETAIN_AVAILABLE,
+                        PROPERTY_SHARED_SUBSCRIPTION_AVAILABLE, PROPERTY_SUBSCRIPTION_IDENTIFIER_AVAILABLE, PROPERTY_TOPIC_ALIAS_MAXIMUM,
+                        REASON_BAD_AUTHENTICATION_METHOD, REASON_DISCONNECT_WITH_WILL, REASON_MALFORMED_PACKET, REASON_NO_MATCHING_SUBSCRIBERS, REASON_NO_SUBSCRIPTION_EXISTED,
+                        REASON_NOT_AUTHORIZED, REASON_RECEIVE_MAXIMUM_EXCEEDED, REASON_SHARED_SUBSCRIPTIONS_NOT_SUPPORTED, REASON_SUBSCRIPTION_IDENTIFIERS_NOT_SUPPORTED,
+                        REASON_SUCCESS, REASON_TOPIC_FILTER_INVALID, REASON_UNSPECIFIED_ERROR)
+from ProtocolHandlerV311 import ProtocolHandlerV311, PACKET_TYPE_PUBACK, PACKET_TYPE_PUBREC
+
+# Topic aliases a client may set, and the most the broker assigns to the topics it sends a client
+DEFAULT_TOPIC_ALIAS_MAXIMUM = 64
+
+class ProtocolHandlerV5(ProtocolHandlerV311):
+    """
+    Serves MQTT 5 connections alongside MQTT 3.1.1 ones.
+
+    The protocol version of the CONNECT selects how a connection is served. MQTT 3.1.1
+    clients take the inherited code paths unchanged. MQTT 5 clients get a ConnectionV5
+    with the limits from their CONNECT properties and the topic aliases of the
+    connection, their packets are decoded with the MQTT 5 message types and they are
+    answered with reason codes.
+
+    Flow control follows the Receive Maximum in both directions: deliveries to a client
+    are limited by the smaller of its Receive Maximum and the broker's, and a client
+    with more QoS 2 messages awaiting PUBREL than the broker's is disconnected.
+    Messages larger than a client's Maximum Packet Size are discarded rather than
+    sent, and packets larger than the broker's are refused by the frame decoder
+    before they are buffered.
+
+    Shared subscriptions, subscription identifiers and enhanced authentication are
+    not supported and are announced as such. A Session Expiry Interval other than 0
+    keeps the session in the session store, 0 ends it with the connection.
+
+    Parameters:
+    - max_packet_size (int): Largest packet accepted from clients, announced in CONNACK. 0 for no limit.
+    - topic_alias_maximum (int): Topic aliases accepted from and assigned to each client.
+    """
+    SUPPORTED_VERSIONS = [PROTOCOL_VERSION_V311, PROTOCOL_VERSION_V5]
+
+    def __init__(self, authenticator: Authenticator, topic_manager: SubscriberManager, client_manager: ClientManager, logger=None, flow_controller: FlowController = None, retained_store: RetainedStore = None, session_store: SessionStore = None, receive_maximum: int = DEFAULT_RECEIVE_MAXIMUM, retry_interval: float = DEFAULT_RETRY_INTERVAL, metrics: Metrics = None, timings: StageTimings = None, acl: TopicAcl = None, max_packet_size: int = 0, topic_alias_maximum: int = DEFAULT_TOPIC_ALIAS_MAXIMUM):
+        super().__init__(authenticator, topic_manager, client_manager, logger, flow_controller, retained_store, session_store, receive_maximum, retry_interval, metrics, timings, acl)
+        self.max_packet_size = max_packet_size
+        self.topic_alias_maximum = topic_alias_maximum
+
+        # The CONNACK properties are the same for every client but the assigned client id
+        properties = [
+            (PROPERTY_RECEIVE_MAXIMUM, min(receive_maximum, DEFAULT_CLIENT_RECEIVE_MAXIMUM)),
+            (PROPERTY_SHARED_SUBSCRIPTION_AVAILABLE, 0),
+            (PROPERTY_SUBSCRIPTION_IDENTIFIER_AVAILABLE, 0),
+        ]
+
+        if max_packet_size:
+            properties.append((PROPERTY_MAXIMUM_PACKET_SIZE, max_packet_size))
+
+        if topic_alias_maximum:
+            properties.append((PROPERTY_TOPIC_ALIAS_MAXIMUM, topic_alias_maximum))
+
+        if retained_store is None:
+            properties.append((PROPERTY_RETAIN_AVAILABLE, 0))
+
+        self.connack_properties = properties
+
+    def decode(self, client: Client, msg: bytes) -> MQTTMessage:
+        if client.v5 is None:
+            return MQTTMessage.create(msg)
+
+        return create_message_v5(msg)
+
+    def handle_connect(self, client: Client, connect_message: ConnectMessage):
+        if connect_message.protocol_version == PROTOCOL_VERSION_V5:
+            try:
+                properties = decode_properties(connect_message.properties)
+                client.v5 = ConnectionV5(properties, self.topic_alias_maximum, self.topic_alias_maximum, self.logger)
+            except ValueError as e:
+                self.logger.error('Error in handle_connect: %s', e)
+                client.send(encode_connack_v5(False, REASON_MALFORMED_PACKET))
+                client.close()
+                return
+
+            if PROPERTY_AUTHENTICATION_METHOD in properties:
+                self.logger.warning('Refusing %s, enhanced authentication is not supported', client.client_name)
+                self.refuse(client, REASON_BAD_AUTHENTICATION_METHOD)
+                return
+
+            if not connect_message.client_id:
+                # MQTT 5 lets the broker choose the id of a client that sends none
+                connect_message.client_id = client.v5.assigned_client_id = 'auto-' + ''.join('%02x' % byte for byte in os.urandom(8))
+
+        super().handle_connect(client, connect_message)
+
+    def refuse(self, client: Client, return_code: int):
+        if client.v5 is None:
+            super().refuse(client, return_code)
+            return
+
+        client.send(encode_connack_v5(False, CONNACK_REASON_CODES.get(return_code, return_code)))
+        client.close()
+
+    def create_inflight(self, client: Client) -> InflightWindow:
+        inflight = super().create_inflight(client)
+
+        if client.v5 is not None:
+            inflight.receive_maximum = min(inflight.receive_maximum, client.v5.receive_maximum)
+            # MQTT 5 resends unacknowledged messages only when the session is resumed
+            inflight.retry_on_timeout = False
+
+        return inflight
+
+    def open_session(self, client: Client, clean_session: bool) -> bool:
+        if client.v5 is None:
+            return super().open_session(client, clean_session)
+
+        session_expiry_interval = client.v5.session_expiry_interval
+
+        if clean_session and session_expiry_interval:
+            # Clean Start with a Session Expiry Interval begins a new session that outlives the connection
+            self.session_store.discard(client.settings.client_id, self.topic_manager)
+
+        return super().open_session(client, not session_expiry_interval)
+
+    def send_connack(self, client: Client, session_present: bool):
+        if client.v5 is None:
+            super().send_connack(client, session_present)
+            return
+
+        properties = self.connack_properties
+        if client.v5.assigned_client_id is not None:
+            properties = properties + [(PROPERTY_ASSIGNED_CLIENT_IDENTIFIER, client.v5.assigned_client_id)]
+
+        client.send(encode_connack_v5(session_present, REASON_SUCCESS, encode_properties(properties)))
+
+    def handle_publish(self, client: Client, publish_message: PublishMessage):
+        if client.v5 is None:
+            super().handle_publish(client, publish_message)
+            return
+
+        try:
+            reason_code = client.v5.resolve_topic(publish_message)
+            if reason_code != REASON_SUCCESS:
+                self.logger.warning('Invalid topic alias %s from %s', publish_message.topic_alias, client.client_name)
+                self.disconnect(client, reason_code)
+                return
+
+            self.logger.receive('Received message of %d bytes on topic: %s', publish_message.payload_length, publish_message.topic_name)
+
+            packet_id = publish_message.packet_id
+
+            if publish_message.qos == 2:
+                if client.awaiting_release is None:
+                    client.awaiting_release = AwaitingRelease(logger=self.logger)
+                self.retry_clients.add(client)
+
+                if packet_id in client.awaiting_release.packet_ids:
+                    # Retransmission of a message that was already published, only acknowledge it
+                    client.send(encode_ack_v5(PACKET_TYPE_PUBREC, packet_id))
+                    return
+
+                if len(client.awaiting_release) >= self.receive_maximum:
+                    self.logger.warning('Client %s exceeded the receive maximum of %d', client.client_name, self.receive_maximum)
+                    self.disconnect(client, REASON_RECEIVE_MAXIMUM_EXCEEDED)
+                    return
+
+                client.awaiting_release.add(packet_id)
+
+            if client.acl is not None and not client.acl.can_publish(publish_message.topic_name):
+                self.logger.warning('Client %s may not publish to %s', client.client_name, publish_message.topic_name)
+                reason_code = REASON_NOT_AUTHORIZED
+            elif not self.publish(client, publish_message):
+                reason_code = REASON_NO_MATCHING_SUBSCRIBERS
+
+            if publish_message.qos == 1:
+                client.send(encode_ack_v5(PACKET_TYPE_PUBACK, packet_id, reason_code))
+            elif publish_message.qos == 2:
+                client.send(encode_ack_v5(PACKET_TYPE_PUBREC, packet_id, reason_code))
+
+                if reason_code >= REASON_UNSPECIFIED_ERROR:
+                    # A PUBREC with an error ends the exchange, no PUBREL follows
+                    client.awaiting_release.release(packet_id)
+
+        except Exception as e:
+            self.logger.error('Error in handle_publish: %s', e)
+
+    def handle_pubrec(self, client: Client, pubrec_message: PubRecMessage):
+        if client.v5 is None or pubrec_message.reason_code < REASON_UNSPECIFIED_ERROR:
+            super().handle_pubrec(client, pubrec_message)
+            return
+
+        try:
+            # The client refused the message, the exchange ends without PUBREL
+            if not self.acknowledge(client, pubrec_message.packet_id):
+                self.logger.warning('Unexpected PUBREC %s from %s', pubrec_message.packet_id, client.client_name)
+
+        except Exception as e:
+            self.logger.error('Error in handle_pubrec: %s', e)
+
+    def handle_subscribe(self, client: Client, subscribe_message: SubscribeMessage):
+        if client.v5 is None:
+            super().handle_subscribe(client, subscribe_message)
+            return
+
+        try:
+            if subscribe_message.subscription_identifier is not None:
+                self.disconnect(client, REASON_SUBSCRIPTION_IDENTIFIERS_NOT_SUPPORTED)
+                return
+
+            subscribed = self.topic_manager.client_topics.get(client, ())
+            granted = []
+            # Granted filters whose retained messages are sent, depending on the Retain Handling option
+            send_retained = []
+            reason_codes = bytearray()
+
+            for (topic, qos), options in zip(subscribe_message.topics, subscribe_message.options):
+                if topic.startswith('$share/'):
+                    reason_code = REASON_SHARED_SUBSCRIPTIONS_NOT_SUPPORTED
+                elif not is_valid_filter(topic):
+                    reason_code = REASON_TOPIC_FILTER_INVALID
+                elif client.acl is not None and not client.acl.can_subscribe(topic):
+                    reason_code = REASON_NOT_AUTHORIZED
+                else:
+                    granted.append((topic, qos))
+                    reason_codes.append(qos)
+
+                    retain_handling = (options >> 4) & 0x03
+                    if retain_handling == RETAIN_HANDLING_SEND or (retain_handling == RETAIN_HANDLING_SEND_IF_NEW and topic not in subscribed):
+                        send_retained.append((topic, qos))
+                    continue
+
+                self.logger.warning('Refusing subscription of %s to %s with reason %#04x', client.client_name, topic, reason_code)
+                reason_codes.append(reason_code)
+
+            self.topic_manager.subscribe_many(granted, client)
+
+            if client.session is not None:
+                for topic, qos in granted:
+                    self.session_store.subscribe(client.session, topic, qos)
+
+            self.logger.debug('Client subscribed to topics: %s', granted)
+
+            client.send(encode_suback_v5(subscribe_message.packet_id, reason_codes))
+
+            if self.retained_store is not None:
+                for topic, qos in send_retained:
+                    for retained_message in self.retained_store.match(topic):
+                        retained_message.send_to_subscriber(client, qos, True)
+
+        except Exception as e:
+            self.logger.error('Error in handle_subscribe: %s', e)
+
+    def handle_unsubscribe(self, client: Client, unsubscribe_message: UnsubscribeMessage):
+        if client.v5 is None:
+            super().handle_unsubscribe(client, unsubscribe_message)
+            return
+
+        try:
+            subscribed = self.topic_manager.client_topics.get(client, ())
+            reason_codes = bytes(REASON_SUCCESS if topic in subscribed else REASON_NO_SUBSCRIPTION_EXISTED for topic in unsubscribe_message.topics)
+
+            self.topic_manager.unsubscribe_many(unsubscribe_message.topics, client)
+
+            if client.session is not None:
+                for topic in unsubscribe_message.topics:
+                    self.session_store.unsubscribe(client.session, topic)
+
+            self.logger.debug('Client unsubscribed from topics: %s', unsubscribe_message.topics)
+
+            client.send(encode_unsuback_v5(unsubscribe_message.packet_id, reason_codes))
+
+        except Exception as e:
+            self.logger.error('Error in handle_unsubscribe: %s', e)
+
+    def handle_disconnect(self, client: Client, disconnect_message: DisconnectMessage):
+        if client.v5 is None:
+            super().handle_disconnect(client, disconnect_message)
+            return
+
+        try:
+            self.logger.debug('Client disconnected with reason %#04x', disconnect_message.reason_code)
+
+            if disconnect_message.reason_code != REASON_DISCONNECT_WITH_WILL:
+                client.will = None
+
+            # The client may shorten the Session Expiry Interval to 0 when it leaves, ending its session
+            client_id = client.settings.client_id
+            end_session = disconnect_message.session_expiry_interval == 0 and client.session is not None
+
+            self.handle_connection_lost(client)
+
+            if end_session:
+                self.session_store.discard(client_id, self.topic_manager)
+
+            client.close()
+        except Exception as e:
+            self.logger.error('Error handling disconnect: %s', e)
+
+    def disconnect(self, client: Client, reason_code: int):
+        if client.v5 is not None:
+            client.send(encode_disconnect_v5(reason_code))
+
+        client.close()
@@ -0,0 +1,181 @@
+from collections import OrderedDict
+
+from Logger import Logger
+from Messages import PublishMessage
+
+DEFAULT_MAX_BYTES = 256 * 1024
+ENTRY_OVERHEAD = 64
+
+class RetainedNode:
+    children: dict
+    message: PublishMessage = None
+
+    def __init__(self):
+        self.children = {}
+        self.message = None
+
+class RetainedStore:
+    """
+    Retained messages indexed by topic level.
+
+    A subscription is answered by walking the levels of its filter: a literal level
+    follows one child, `+` follows every child of that level and `#` collects the
+    subtree, so topics outside the filter's branches are never visited. Messages are
+    kept as broker owned PublishMessages, whose topic and payload buffers are shared by
+    every delivery. When the memory cap is exceeded the oldest messages are evicted.
+    """
+    root: RetainedNode
+    messages: OrderedDict
+    listeners: list
+    max_bytes: int
+    size: int = 0
+    evictions: int = 0
+
+    def __init__(self, max_bytes: int = DEFAULT_MAX_BYTES, logger: Logger = None):
+        self.root = RetainedNode()
+        self.messages = OrderedDict()
+        self.listeners = []
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.evictions = 0
+        self.logger = logger or Logger()
+
+    def __len__(self):
+        return len(self.messages)
+
+    def add_listener(self, listener):
+        """
+        Register a listener with an `on_retain(publish_message)` method, called with every
+        retained message passed to store(), including the empty ones clearing a topic.
+        """
+        self.listeners.append(listener)
+
+    def store(self, publish_message: PublishMessage):
+        for listener in self.listeners:
+            listener.on_retain(publish_message)
+
+        topic = publish_message.topic_name
+        payload = publish_message.get_payload_bytes()
+
+        self.remove(topic)
+
+        # A retained message with an empty payload only clears the topic
+        if not payload:
+            return
+
+        size = len(topic) + len(payload) + ENTRY_OVERHEAD
+        if size > self.max_bytes:
+            self.logger.warning('Retained message on %s exceeds the store size', topic)
+            return
+
+        while self.size + size > self.max_bytes:
+            self.remove(next(iter(self.messages)))
+            self.evictions += 1
+
+        message = PublishMessage.build(topic, payload, publish_message.qos, True)
+
+        node = self.root
+        for level in topic.split('/'):
+            child = node.children.get(level)
+            if child is None:
+                child = node.children[level] = RetainedNode()
+            node = child
+
+        node.message = message
+        self.messages[topic] = size
+        self.size += size
+
+    def remove(self, topic) -> bool:
+        size = self.messages.pop(topic, None)
+        if size is None:
+            return False
+
+        self.size -= size
+
+        path = []
+        node = self.root
+        for level in topic.split('/'):
+            path.append((node, level))
+            node = node.children[level]
+
+        node.message = None
+
+        for parent, level in reversed(path):
+            if node.message is not None or node.children:
+                break
+
+            del parent.children[level]
+            node = parent
+
+        return True
+
+    def match(self, topic_filter) -> list:
+        """
+        Find the retained messages matching a topic filter.
+
+        Parameters:
+        - topic_filter (str): The subscription topic, which may contain wildcards.
+
+        Returns:
+        - list: The matching retained PublishMessages.
+        """
+        messages = []
+        nodes = [self.root]
+        is_root = True
+
+        for level in topic_filter.split('/'):
+            if level == '#':
+                for node in nodes:
+                    RetainedStore.__collect_subtree(node, messages, is_root)
+                return messages
+
+            next_nodes = []
+            for node in nodes:
+                if level == '+':
+                    for name, child in node.children.items():
+                        # Wildcards at the first level never match topics starting with $
+                        if not (is_root and name.startswith('$')):
+                            next_nodes.append(child)
+                else:
+                    child = node.children.get(level)
+                    if child is not None:
+                        next_nodes.append(child)
+
+            nodes = next_nodes
+            is_root = False
+
+            if not nodes:
+                return messages
+
+        for node in nodes:
+            if node.message is not None:
+                messages.append(node.message)
+
+        return messages
+
+    @staticmethod
+    def __collect_subtree(node: RetainedNode, messages: list, is_root: bool):
+        # 'a/#' also matches the parent level 'a'
+        if node.message is not None and not is_root:
+            messages.append(node.message)
+
+        stack = []
+        for name, child in node.children.items():
+            if not (is_root and name.startswith('$')):
+                stack.append(child)
+
+        while stack:
+            node = stack.pop()
+
+            if node.message is not None:
+                messages.append(node.message)
+
+            stack.extend(node.children.values())
+
+    def stats(self) -> dict:
+        return {
+            'messages': len(self.messages),
+            'bytes': self.size,
+            'max_bytes': self.max_bytes,
+            'evictions': self.evictions,
+        }
@@ -0,0 +1,512 @@
+import os
+import struct
+from collections import deque
+
+from Client import Client
+from Logger import Logger
+from Messages import PublishMessage, ENCODING_UTF8
+from SubscriberManager import SubscriberManager
+
+RECORD_SUBSCRIBE = ord('S')
+RECORD_UNSUBSCRIBE = ord('U')
+RECORD_ENQUEUE = ord('Q')
+RECORD_DEQUEUE = ord('D')
+RECORD_ACKNOWLEDGE = ord('A')
+RECORD_DISCARD = ord('X')
+
+RECORD_HEADER_SIZE = 5
+
+DEFAULT_MAX_QUEUED_MESSAGES = 1000
+COMPACT_MIN_BYTES = 1024 * 1024
+
+class Session:
+    """
+    The state kept for a client that connected with clean_session=0.
+    """
+    client_id: str
+    subscriptions: dict
+    queue: deque
+    client: Client = None
+    offline_client: 'OfflineSessionClient'
+    # Inbound QoS 2 packet ids waiting for PUBREL, kept in memory while the client is offline
+    awaiting_release = None
+    # publish message -> queue entry, the queued messages sent to the resumed client and not yet acknowledged
+    delivering: dict
+
+    def __init__(self, client_id: str, store: 'SessionStore'):
+        self.client_id = client_id
+        # topic filter -> (qos, record size)
+        self.subscriptions = {}
+        # (topic, payload, qos, record size) of messages waiting for the client
+        self.queue = deque()
+        self.delivering = {}
+        self.client = None
+        self.offline_client = OfflineSessionClient(self, store)
+
+class OfflineSessionClient(Client):
+    """
+    Stands in for a disconnected session in the SubscriberManager and queues the
+    QoS 1 and 2 messages published to its subscriptions.
+    """
+    def __init__(self, session: Session, store: 'SessionStore'):
+        super().__init__(f'session-{session.client_id}', None, store.logger)
+        self.session = session
+        self.store = store
+
+    def deliver(self, publish_message: PublishMessage, qos: int = 0):
+        qos = min(publish_message.qos, qos)
+
+        if qos > 0:
+            self.store.enqueue(self.session, publish_message.topic_name, publish_message.get_payload_bytes(), qos)
+
+    def is_ready(self):
+        return True
+
+    def send(self, msg: bytes):
+        pass
+
+    def close(self):
+        pass
+
+class SessionStore:
+    """
+    Durable sessions keyed by client id.
+
+    Every change is appended as a record to the session file, and the file is
+    replayed through a memory map when the broker starts, so reading thousands of
+    sessions is a single pass over the mapped pages. The file is rewritten from the
+    live sessions once it has grown to more than twice their size.
+
+    Queued messages stay in the session until the resumed client acknowledges them,
+    so a broker that stops before the PUBACK or PUBCOMP delivers them again.
+
+    Records are buffered and written by flush(). With `schedule_flush` set, e.g. to
+    the event loop's call_soon, the records of one loop iteration are written
+    together; without it every record is written at once. Compaction is left to the
+    caller: begin_compaction() takes the snapshot, write_compaction() does the file
+    work and may run on another thread, end_compaction() switches to the new file.
+
+    Without a path the sessions are only kept in memory.
+    """
+    sessions: dict
+    path: str
+    logger: Logger
+    # Called with flush() when the first record is buffered, None to write every record at once
+    schedule_flush = None
+
+    def __init__(self, path: str = None, logger: Logger = None, max_queued_messages: int = DEFAULT_MAX_QUEUED_MESSAGES):
+        self.sessions = {}
+        self.path = path
+        self.logger = logger or Logger()
+        self.max_queued_messages = max_queued_messages
+        self.file_size = 0
+        self.live_bytes = 0
+        self.fd = None
+        # Encoded records waiting for flush()
+        self.buffer = []
+        self.compacting = False
+
+        if path is not None:
+            self.__load()
+            self.fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+
+    def get(self, client_id: str) -> Session:
+        return self.sessions.get(client_id)
+
+    def attach(self, client_id: str, client: Client, topic_manager: SubscriberManager):
+        """
+        Attach a connecting client to its session, creating the session if needed.
+
+        The stored subscriptions and queued messages are checked against the access
+        rules of the client again, the rules may have changed since they were stored.
+
+        Returns:
+        - tuple: The session and whether it already existed.
+        """
+        session = self.sessions.get(client_id)
+        present = session is not None
+
+        if not present:
+            session = self.sessions[client_id] = Session(client_id, self)
+        elif session.client is not None and session.client is not client:
+            # A new connection with the same client id takes the session over
+            self.logger.warning('Session %s taken over by a new connection', client_id)
+            self.__release(session, topic_manager)
+
+        topic_manager.remove_client(session.offline_client)
+        session.client = client
+
+        if client.acl is not None:
+            self.__revoke(session, client.acl)
+
+        topic_manager.subscribe_many([(topic, qos) for topic, (qos, _) in session.subscriptions.items()], client)
+
+        return session, present
+
+    def detach(self, session: Session, topic_manager: SubscriberManager):
+        session.client = None
+
+        topic_manager.subscribe_many([(topic, qos) for topic, (qos, _) in session.subscriptions.items()], session.offline_client)
+
+    def restore(self, topic_manager: SubscriberManager):
+        """
+        Subscribe the sessions loaded from the session file while their clients are offline.
+        """
+        for session in self.sessions.values():
+            if session.client is None:
+                self.detach(session, topic_manager)
+
+    def discard(self, client_id: str, topic_manager: SubscriberManager):
+        session = self.sessions.pop(client_id, None)
+        if session is None:
+            return
+
+        topic_manager.remove_client(session.offline_client)
+        if session.client is not None:
+            self.__release(session, topic_manager)
+
+        self.live_bytes -= sum(size for _, size in session.subscriptions.values())
+        self.live_bytes -= sum(entry[3] for entry in session.queue)
+        self.__append(RECORD_DISCARD, self.__encode_strings(client_id))
+
+    def subscribe(self, session: Session, topic: str, qos: int):
+        record = self.__encode_strings(session.client_id, topic) + bytes((qos,))
+        size = self.__append(RECORD_SUBSCRIBE, record)
+
+        previous = session.subscriptions.get(topic)
+        if previous is not None:
+            self.live_bytes -= previous[1]
+
+        session.subscriptions[topic] = (qos, size)
+        self.live_bytes += size
+
+    def unsubscribe(self, session: Session, topic: str):
+        previous = session.subscriptions.pop(topic, None)
+        if previous is None:
+            return
+
+        self.live_bytes -= previous[1]
+        self.__append(RECORD_UNSUBSCRIBE, self.__encode_strings(session.client_id, topic))
+
+    def enqueue(self, session: Session, topic: str, payload: bytes, qos: int):
+        if len(session.queue) >= self.max_queued_messages:
+            self.logger.warning('Session queue of %s is full, dropping the oldest message', session.client_id)
+            self.dequeue(session, 1)
+
+        record = self.__encode_strings(session.client_id, topic) + bytes((qos,)) + payload
+        size = self.__append(RECORD_ENQUEUE, record)
+
+        session.queue.append((topic, payload, qos, size))
+        self.live_bytes += size
+
+    def dequeue(self, session: Session, count: int = None) -> list:
+        """
+        Remove and return the oldest queued messages of a session as (topic, payload, qos).
+        """
+        if count is None:
+            count = len(session.queue)
+
+        messages = []
+        while session.queue and len(messages) < count:
+            topic, payload, qos, size = session.queue.popleft()
+            self.live_bytes -= size
+            messages.append((topic, payload, qos))
+
+        if messages:
+            self.__append(RECORD_DEQUEUE, self.__encode_strings(session.client_id) + struct.pack('>I', len(messages)))
+
+        return messages
+
+    def resume(self, session: Session) -> list:
+        """
+        Build the messages queued for a resumed session. They stay queued until
+        acknowledge() is called for them, or are delivered again on the next resume.
+
+        Returns:
+        - list: The PublishMessage of every queued message, oldest first.
+        """
+        session.delivering = {}
+        messages = []
+
+        for entry in session.queue:
+            publish_message = PublishMessage.build(entry[0], entry[1], entry[2])
+            session.delivering[publish_message] = entry
+            messages.append(publish_message)
+
+        return messages
+
+    def acknowledge(self, session: Session, publish_message: PublishMessage):
+        """
+        Remove a message sent by resume() once the client acknowledged it.
+        Messages that did not come from the session are ignored.
+        """
+        if not session.delivering:
+            return
+
+        entry = session.delivering.pop(publish_message, None)
+        if entry is not None:
+            self.__remove(session, entry)
+
+    def requeue(self, session: Session, unacknowledged: list):
+        """
+        Queue the deliveries a client did not acknowledge before its connection was lost.
+
+        Parameters:
+        - unacknowledged (list): (publish message, qos) drained from the client's in-flight window.
+        """
+        delivering, session.delivering = session.delivering, {}
+        requeued = []
+
+        for publish_message, qos in unacknowledged:
+            # Messages sent by resume() are still queued
+            if delivering.pop(publish_message, None) is None:
+                requeued.append((publish_message, qos))
+
+        # What is left was released (QoS 2 PUBREL sent), the client has the message
+        for entry in delivering.values():
+            self.__remove(session, entry)
+
+        for publish_message, qos in requeued:
+            self.enqueue(session, publish_message.topic_name, publish_message.get_payload_bytes(), qos)
+
+    def flush(self):
+        """
+        Write the buffered records, held back while the file is being compacted.
+        """
+        if not self.buffer or self.fd is None or self.compacting:
+            return
+
+        records, self.buffer = self.buffer, []
+        os.write(self.fd, b''.join(records))
+
+    def needs_compaction(self) -> bool:
+        return self.fd is not None and not self.compacting and self.file_size > COMPACT_MIN_BYTES and self.file_size > 2 * self.live_bytes
+
+    def compact(self):
+        self.end_compaction(self.write_compaction(self.begin_compaction()))
+
+    def begin_compaction(self) -> list:
+        """
+        Snapshot the live sessions as records. Records appended until end_compaction()
+        are buffered and go to the new file.
+
+        Returns:
+        - list: The encoded records for write_compaction().
+        """
+        # The current file stays complete in case the compaction fails
+        self.flush()
+        self.compacting = True
+
+        records = []
+        live_bytes = 0
+
+        for session in self.sessions.values():
+            client_id = self.__encode_strings(session.client_id)
+
+            for topic, (qos, size) in session.subscriptions.items():
+                body = client_id + self.__encode_strings(topic) + bytes((qos,))
+                records.append(struct.pack('>BI', RECORD_SUBSCRIBE, len(body)) + body)
+                live_bytes += size
+
+            for topic, payload, qos, size in session.queue:
+                body = client_id + self.__encode_strings(topic) + bytes((qos,)) + payload
+                records.append(struct.pack('>BI', RECORD_ENQUEUE, len(body)) + body)
+                live_bytes += size
+
+        self.live_bytes = live_bytes
+        return records
+
+    def write_compaction(self, records: list) -> bool:
+        """
+        Write the snapshot to a new file and move it over the session file. Only touches
+        the file system, so it can run on a worker thread.
+
+        Returns:
+        - bool: False when the file could not be written, the session file is then unchanged.
+        """
+        temp_path = self.path + '.tmp'
+
+        try:
+            with open(temp_path, 'wb') as file:
+                file.writelines(records)
+                file.flush()
+                os.fsync(file.fileno())
+
+            os.replace(temp_path, self.path)
+        except OSError as e:
+            self.logger.error('Error compacting session file %s: %s', self.path, e)
+            return False
+
+        return True
+
+    def end_compaction(self, replaced: bool):
+        self.compacting = False
+
+        if replaced:
+            os.close(self.fd)
+            self.fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+            self.file_size = os.fstat(self.fd).st_size
+            self.logger.info('Compacted session file %s to %d bytes', self.path, self.file_size)
+
+        self.file_size += sum(len(record) for record in self.buffer)
+        self.flush()
+
+    def close(self):
+        if self.fd is not None:
+            self.flush()
+            os.close(self.fd)
+            self.fd = None
+
+    def __release(self, session: Session, topic_manager: SubscriberManager):
+        previous = session.client
+        session.client = None
+
+        # Deliveries in flight on the old connection go to the connection taking over
+        if previous.inflight is not None:
+            self.requeue(session, previous.inflight.drain())
+
+        if previous.awaiting_release:
+            session.awaiting_release = previous.awaiting_release
+        previous.awaiting_release = None
+
+        previous.session = None
+        topic_manager.remove_client(previous)
+        previous.close()
+
+    def __revoke(self, session: Session, acl):
+        for topic in [topic for topic in session.subscriptions if not acl.can_subscribe(topic)]:
+            self.logger.warning('Dropping the subscription of %s to %s, it is no longer allowed', session.client_id, topic)
+            self.unsubscribe(session, topic)
+
+        revoked = [entry for entry in session.queue if not acl.can_subscribe(entry[0])]
+        if revoked:
+            self.logger.warning('Dropping %d queued messages of %s it may no longer read', len(revoked), session.client_id)
+
+        for entry in revoked:
+            self.__remove(session, entry)
+
+    def __remove(self, session: Session, entry: tuple):
+        # Acknowledgements mostly arrive in order, the entry is usually the first
+        for index, queued in enumerate(session.queue):
+            if queued is entry:
+                break
+        else:
+            return
+
+        if index == 0:
+            session.queue.popleft()
+        else:
+            del session.queue[index]
+
+        self.live_bytes -= entry[3]
+        self.__append(RECORD_ACKNOWLEDGE, self.__encode_strings(session.client_id) + struct.pack('>I', index))
+
+    def __append(self, record_type: int, body: bytes) -> int:
+        size = RECORD_HEADER_SIZE + len(body)
+
+        if self.fd is not None:
+            self.buffer.append(struct.pack('>BI', record_type, len(body)) + body)
+
+            if not self.compacting:
+                self.file_size += size
+
+                if len(self.buffer) == 1:
+                    if self.schedule_flush is None:
+                        self.flush()
+                    else:
+                        self.schedule_flush(self.flush)
+
+        return size
+
+    @staticmethod
+    def __encode_strings(*strings) -> bytes:
+        buf = b''
+        for string in strings:
+            str_buf = string.encode(ENCODING_UTF8)
+            buf += struct.pack('>H', len(str_buf)) + str_buf
+
+        return buf
+
+    @staticmethod
+    def __read_string(view: memoryview, offset: int):
+        length = (view[offset] << 8) | view[offset + 1]
+        offset += 2
+        return str(view[offset:offset + length], ENCODING_UTF8), offset + length
+
+    def __load(self):
+        try:
+            import mmap
+        except ImportError:
+            self.logger.warning('mmap is not available, sessions are kept in memory only')
+            self.path = None
+            return
+
+        if not os.path.exists(self.path) or os.path.getsize(self.path) == 0:
+            return
+
+        with open(self.path, 'rb') as file:
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                view = memoryview(mapped)
+                try:
+                    self.__replay(view)
+                finally:
+                    view.release()
+
+        self.file_size = os.path.getsize(self.path)
+        self.logger.info('Loaded %d sessions from %s', len(self.sessions), self.path)
+
+    def __replay(self, view: memoryview):
+        offset = 0
+        end = len(view)
+
+        while offset + RECORD_HEADER_SIZE <= end:
+            record_type = view[offset]
+            length = struct.unpack_from('>I', view, offset + 1)[0]
+            body_start = offset + RECORD_HEADER_SIZE
+            body_end = body_start + length
+
+            if body_end > end:
+                self.logger.warning('Ignoring truncated session record at offset %d', offset)
+                break
+
+            size = RECORD_HEADER_SIZE + length
+            client_id, position = SessionStore.__read_string(view, body_start)
+
+            if record_type == RECORD_DISCARD:
+                session = self.sessions.pop(client_id, None)
+                if session is not None:
+                    self.live_bytes -= sum(entry_size for _, entry_size in session.subscriptions.values())
+                    self.live_bytes -= sum(entry[3] for entry in session.queue)
+            else:
+                session = self.sessions.get(client_id)
+                if session is None:
+                    session = self.sessions[client_id] = Session(client_id, self)
+
+                if record_type == RECORD_SUBSCRIBE:
+                    topic, position = SessionStore.__read_string(view, position)
+                    previous = session.subscriptions.get(topic)
+                    if previous is not None:
+                        self.live_bytes -= previous[1]
+                    session.subscriptions[topic] = (view[position], size)
+                    self.live_bytes += size
+                elif record_type == RECORD_UNSUBSCRIBE:
+                    topic, position = SessionStore.__read_string(view, position)
+                    previous = session.subscriptions.pop(topic, None)
+                    if previous is not None:
+                        self.live_bytes -= previous[1]
+                elif record_type == RECORD_ENQUEUE:
+                    topic, position = SessionStore.__read_string(view, position)
+                    qos = view[position]
+                    session.queue.append((topic, bytes(view[position + 1:body_end]), qos, size))
+                    self.live_bytes += size
+                elif record_type == RECORD_DEQUEUE:
+                    count = struct.unpack_from('>I', view, position)[0]
+                    for _ in range(min(count, len(session.queue))):
+                        self.live_bytes -= session.queue.popleft()[3]
+                elif record_type == RECORD_ACKNOWLEDGE:
+                    index = struct.unpack_from('>I', view, position)[0]
+                    if index < len(session.queue):
+                        self.live_bytes -= session.queue[index][3]
+                        del session.queue[index]
+
+            offset = body_end
@@ -0,0 +1,161 @@
+try:
+    from time import perf_counter_ns as clock_ns
+except ImportError:
+    from time import ticks_us
+
+    def clock_ns():
+        return ticks_us() * 1000
+
+STAGE_DECODE = 'decode'
+STAGE_AUTH = 'auth'
+STAGE_MATCH = 'match'
+STAGE_FANOUT = 'fanout'
+STAGE_WRITE = 'write'
+STAGE_TOTAL = 'total'
+
+PACKET_TYPE_NAMES = {
+    1: 'connect', 2: 'connack', 3: 'publish', 4: 'puback', 5: 'pubrec', 6: 'pubrel', 7: 'pubcomp',
+    8: 'subscribe', 9: 'suback', 10: 'unsubscribe', 11: 'unsuback', 12: 'pingreq', 13: 'pingresp', 14: 'disconnect', 15: 'auth',
+}
+
+# 8 sub-buckets per power of two, values are recorded with at most 12.5% error
+SUB_BUCKET_BITS = 3
+SUB_BUCKETS = 1 << SUB_BUCKET_BITS
+# Buckets up to 2^48 ns, about 78 hours
+BUCKET_COUNT = (48 - SUB_BUCKET_BITS) * SUB_BUCKETS
+
+class LatencyHistogram:
+    """
+    HDR-style histogram with logarithmic buckets.
+
+    Values below 16 ns have a bucket each, above that every power of two is split
+    into 8 linear sub-buckets. Recording is a bit_length and a shift, so the cost
+    does not depend on the number of values recorded.
+    """
+    __slots__ = ('counts', 'count', 'total', 'max')
+
+    def __init__(self):
+        self.counts = [0] * BUCKET_COUNT
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    @staticmethod
+    def bucket_index(value: int) -> int:
+        if value < 2 * SUB_BUCKETS:
+            return value if value > 0 else 0
+
+        shift = value.bit_length() - SUB_BUCKET_BITS - 1
+        index = (shift << SUB_BUCKET_BITS) + (value >> shift)
+        return index if index < BUCKET_COUNT else BUCKET_COUNT - 1
+
+    @staticmethod
+    def bucket_value(index: int) -> int:
+        """
+        The lowest value falling into a bucket.
+        """
+        if index < 2 * SUB_BUCKETS:
+            return index
+
+        shift = (index >> SUB_BUCKET_BITS) - 1
+        return ((index & (SUB_BUCKETS - 1)) + SUB_BUCKETS) << shift
+
+    def record(self, value: int):
+        self.counts[LatencyHistogram.bucket_index(value)] += 1
+        self.count += 1
+        self.total += value
+
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, fraction: float) -> int:
+        if not self.count:
+            return 0
+
+        rank = fraction * self.count
+        seen = 0
+
+        for index, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= rank:
+                return min(LatencyHistogram.bucket_value(index + 1) - 1, self.max)
+
+        return self.max
+
+    def merge(self, other: 'LatencyHistogram'):
+        for index, count in enumerate(other.counts):
+            if count:
+                self.counts[index] += count
+
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def snapshot(self) -> dict:
+        """
+        Returns:
+        - dict: The count and the mean, p50, p90, p99, p999 and max in microseconds.
+        """
+        return {
+            'count': self.count,
+            'mean_us': round(self.total / self.count / 1000, 3) if self.count else 0,
+            'p50_us': round(self.percentile(0.5) / 1000, 3),
+            'p90_us': round(self.percentile(0.9) / 1000, 3),
+            'p99_us': round(self.percentile(0.99) / 1000, 3),
+            'p999_us': round(self.percentile(0.999) / 1000, 3),
+            'max_us': round(self.max / 1000, 3),
+        }
+
+class StageTimings:
+    """
+    Latency histograms of the packet pipeline stages, per packet type.
+
+    Disabled by default; the instrumented code checks `enabled` before reading the
+    clock, so the only cost while disabled is one attribute lookup per stage.
+    """
+    enabled: bool = False
+    histograms: dict
+
+    def __init__(self, enabled: bool = False):
+        self.enabled = enabled
+        # (packet type, stage) -> LatencyHistogram
+        self.histograms = {}
+
+    def enable(self):
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def reset(self):
+        self.histograms = {}
+
+    def record(self, packet_type: int, stage: str, elapsed_ns: int):
+        key = (packet_type, stage)
+        histogram = self.histograms.get(key)
+
+        if histogram is None:
+            histogram = self.histograms[key] = LatencyHistogram()
+
+        histogram.record(elapsed_ns)
+
+    def snapshot(self) -> dict:
+        """
+        Returns:
+        - dict: packet type name -> stage -> histogram summary.
+        """
+        result = {}
+
+        for (packet_type, stage), histogram in sorted(self.histograms.items()):
+            result.setdefault(PACKET_TYPE_NAMES.get(packet_type, str(packet_type)), {})[stage] = histogram.snapshot()
+
+        return result
+
+    def format(self) -> str:
+        lines = [f'{"packet":12} {"stage":8} {"count":>10} {"p50 us":>10} {"p99 us":>10} {"p999 us":>10} {"max us":>10}']
+
+        for packet_name, stages in self.snapshot().items():
+            for stage, summary in stages.items():
+                lines.append(f'{packet_name:12} {stage:8} {summary["count"]:>10} {summary["p50_us"]:>10} {summary["p99_us"]:>10} {summary["p999_us"]:>10} {summary["max_us"]:>10}')
+
+        return '\n'.join(lines)
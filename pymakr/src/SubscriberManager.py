@@ -1,14 +1,20 @@
+from collections import OrderedDict
+
 from Logger import Logger
 from Client import Client
 from Messages import PublishMessage
 
+DEFAULT_MATCH_CACHE_SIZE = 4096
+
 class Subscription:
     topic: str = ''
     client: Client = None
+    qos: int = 0
 
-    def __init__(self, topic, client):
+    def __init__(self, topic, client, qos = 0):
         self.topic = topic
         self.client = client
+        self.qos = qos
 
     @staticmethod
     def __match_subscription(subscription, topic):
@@ -56,26 +62,437 @@ class Subscription:
 # print(match_subscription('home/+/temperature', 'home/+/temperature'))         # False
 # print(match_subscription('home/+/temperature/#', 'home/livingroom/temperature/extra'))  # True
 
+class TopicNode:
+    """
+    A single topic level in the subscription trie.
+
+    Literal levels are kept in `children`, while the `+` and `#` wildcards have
+    dedicated slots so matching never has to look them up by name.
+    """
+    children: dict
+    plus: 'TopicNode' = None
+    hash: 'TopicNode' = None
+    subscriptions: dict
+
+    def __init__(self):
+        self.children = {}
+        self.plus = None
+        self.hash = None
+        self.subscriptions = {}
+
+    def get_child(self, level):
+        if level == '+':
+            return self.plus
+        elif level == '#':
+            return self.hash
+
+        return self.children.get(level)
+
+    def add_child(self, level):
+        child = self.get_child(level)
+
+        if child is None:
+            child = TopicNode()
+
+            if level == '+':
+                self.plus = child
+            elif level == '#':
+                self.hash = child
+            else:
+                self.children[level] = child
+
+        return child
+
+    def remove_child(self, level):
+        if level == '+':
+            self.plus = None
+        elif level == '#':
+            self.hash = None
+        else:
+            self.children.pop(level, None)
+
+    def is_empty(self):
+        return not self.subscriptions and not self.children and self.plus is None and self.hash is None
+
+def is_wildcard(topic) -> bool:
+    return '+' in topic or '#' in topic
+
+def is_valid_filter(topic_filter) -> bool:
+    """
+    Check that the wildcards of a topic filter take up whole levels and that '#' is the last level.
+    """
+    if not topic_filter:
+        return False
+
+    levels = topic_filter.split('/')
+    last = len(levels) - 1
+
+    for i, level in enumerate(levels):
+        if level == '#':
+            if i != last:
+                return False
+        elif level != '+' and ('+' in level or '#' in level):
+            return False
+
+    return True
+
+class CachedTopicNode:
+    """
+    A single topic level in the index of cached topic names.
+    """
+    children: dict
+    topic: str = None
+
+    def __init__(self):
+        self.children = {}
+        self.topic = None
+
+class MatchCache:
+    """
+    Bounded LRU cache from a concrete topic name to its resolved subscriptions.
+
+    Entries are dropped individually when a subscription change affects them, so a
+    new subscription on 'a/b' does not throw away the cached result for 'c/d'. The
+    cached topic names are also indexed level by level, a wildcard filter is walked
+    down that index so invalidation only visits the branches the filter can match.
+    """
+    entries: OrderedDict
+    topics: CachedTopicNode
+    max_size: int
+    hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+    invalidations: int = 0
+
+    def __init__(self, max_size: int = DEFAULT_MATCH_CACHE_SIZE):
+        self.entries = OrderedDict()
+        self.topics = CachedTopicNode()
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, topic):
+        subscriptions = self.entries.pop(topic, None)
+
+        if subscriptions is None:
+            self.misses += 1
+            return None
+
+        # Re-insert to mark the entry as most recently used
+        self.entries[topic] = subscriptions
+        self.hits += 1
+        return subscriptions
+
+    def put(self, topic, subscriptions: tuple):
+        if self.max_size <= 0:
+            return
+
+        while len(self.entries) >= self.max_size:
+            self.__remove(next(iter(self.entries)))
+            self.evictions += 1
+
+        if topic not in self.entries:
+            self.__index(topic)
+
+        self.entries[topic] = subscriptions
+
+    def invalidate(self, topic_filter):
+        """
+        Drop the cached topics that the given topic filter matches.
+        """
+        self.invalidate_many((topic_filter,))
+
+    def invalidate_many(self, topic_filters):
+        """
+        Drop the cached topics that any of the topic filters matches.
+
+        Exact filters are dropped by key, wildcard filters are walked down the
+        index of cached topics.
+        """
+        for topic_filter in topic_filters:
+            if not self.entries:
+                return
+
+            if not is_wildcard(topic_filter):
+                stale = (topic_filter,) if topic_filter in self.entries else ()
+            else:
+                stale = []
+                self.__collect(self.topics, topic_filter.split('/'), 0, stale)
+
+            for topic in stale:
+                self.__remove(topic)
+
+            self.invalidations += len(stale)
+
+    def clear(self):
+        self.invalidations += len(self.entries)
+        self.entries = OrderedDict()
+        self.topics = CachedTopicNode()
+
+    def stats(self) -> dict:
+        return {
+            'size': len(self.entries),
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'invalidations': self.invalidations,
+        }
+
+    def __index(self, topic):
+        node = self.topics
+
+        for level in topic.split('/'):
+            child = node.children.get(level)
+
+            if child is None:
+                child = CachedTopicNode()
+                node.children[level] = child
+
+            node = child
+
+        node.topic = topic
+
+    def __remove(self, topic):
+        del self.entries[topic]
+
+        path = []
+        node = self.topics
+
+        for level in topic.split('/'):
+            path.append((node, level))
+            node = node.children[level]
+
+        node.topic = None
+
+        # Prune the levels no other cached topic goes through
+        for parent, level in reversed(path):
+            child = parent.children[level]
+
+            if child.topic is not None or child.children:
+                break
+
+            del parent.children[level]
+
+    def __collect(self, node: CachedTopicNode, filter_levels: list, index: int, stale: list):
+        if index == len(filter_levels):
+            if node.topic is not None:
+                stale.append(node.topic)
+            return
+
+        level = filter_levels[index]
+
+        if level == '#':
+            # The # wildcard also matches the parent level, 'a/#' matches 'a'
+            nodes = [node]
+
+            while nodes:
+                node = nodes.pop()
+
+                if node.topic is not None:
+                    stale.append(node.topic)
+
+                nodes.extend(node.children.values())
+        elif level == '+':
+            for child in node.children.values():
+                self.__collect(child, filter_levels, index + 1, stale)
+        else:
+            child = node.children.get(level)
+
+            if child is not None:
+                self.__collect(child, filter_levels, index + 1, stale)
+
 class SubscriberManager:
-    def __init__(self, logger = None):
-        self.subscriptions = []
+    root: TopicNode
+    client_topics: dict
+    match_cache: MatchCache
+    listeners: list
+    subscription_count: int = 0
+
+    def __init__(self, logger = None, cache_size: int = DEFAULT_MATCH_CACHE_SIZE):
+        self.root = TopicNode()
+        self.client_topics = {}
+        self.match_cache = MatchCache(cache_size)
+        self.listeners = []
+        self.subscription_count = 0
         self.logger = logger or Logger()
 
-    def subscribe(self, topic, client):
-        subscription = Subscription(topic, client)
-        self.subscriptions.append(subscription)
+    def add_listener(self, listener):
+        """
+        Register a listener with `on_subscribe(topic, client)` and `on_unsubscribe(topic, client)`
+        methods, called when a client gains or loses a subscription.
+        """
+        self.listeners.append(listener)
+
+    def subscribe(self, topic, client, qos = 0):
+        self.subscribe_many(((topic, qos),), client)
+
+    def subscribe_many(self, topics, client):
+        """
+        Add several subscriptions of a client, invalidating the match cache once for all of them.
+
+        Parameters:
+        - topics (list): (topic filter, QoS) tuples.
+        - client (Client): The subscribing client.
+        """
+        added = []
+
+        for topic, qos in topics:
+            if self.__add(topic, client, qos):
+                added.append(topic)
+
+        self.match_cache.invalidate_many([topic for topic, _ in topics])
+
+        for topic in added:
+            for listener in self.listeners:
+                listener.on_subscribe(topic, client)
 
     def unsubscribe(self, topic, client):
-        for subscription in self.subscriptions:
-            if subscription.is_for_topic(topic) and subscription.client == client:
-                self.subscriptions.remove(subscription)
-
-    def publish(self, topic, publish_message: PublishMessage):
-        for subscription in self.subscriptions:
-            if subscription.is_for_topic(topic):
-                client = subscription.client
-                try:
-                    publish_message.send_to(client, True)
-                except OSError as e:
-                    self.logger.error(f'Error forwarding message to subscriber: {e}')
-                    self.unsubscribe(subscription.topic, client)
+        return self.unsubscribe_many((topic,), client) > 0
+
+    def unsubscribe_many(self, topics, client) -> int:
+        """
+        Remove several subscriptions of a client, invalidating the match cache once for all of them.
+
+        Returns:
+        - int: The number of subscriptions that were removed.
+        """
+        removed = [topic for topic in topics if self.__remove(topic, client)]
+
+        self.match_cache.invalidate_many(removed)
+
+        for topic in removed:
+            for listener in self.listeners:
+                listener.on_unsubscribe(topic, client)
+
+        return len(removed)
+
+    def remove_client(self, client):
+        self.unsubscribe_many(list(self.client_topics.get(client, ())), client)
+
+    def __add(self, topic, client, qos) -> bool:
+        node = self.root
+        for level in topic.split('/'):
+            node = node.add_child(level)
+
+        is_new = client not in node.subscriptions
+        if is_new:
+            self.subscription_count += 1
+            self.client_topics.setdefault(client, set()).add(topic)
+
+        node.subscriptions[client] = Subscription(topic, client, qos)
+        return is_new
+
+    def __remove(self, topic, client) -> bool:
+        path = []
+        node = self.root
+        for level in topic.split('/'):
+            child = node.get_child(level)
+            if child is None:
+                return False
+
+            path.append((node, level))
+            node = child
+
+        if node.subscriptions.pop(client, None) is None:
+            return False
+
+        self.subscription_count -= 1
+
+        topics = self.client_topics.get(client)
+        if topics is not None:
+            topics.discard(topic)
+            if not topics:
+                del self.client_topics[client]
+
+        # Prune the branch back up to the first level that is still in use
+        for parent, level in reversed(path):
+            if not node.is_empty():
+                break
+
+            parent.remove_child(level)
+            node = parent
+
+        return True
+
+    def match(self, topic) -> tuple:
+        """
+        Find the subscriptions matching a concrete topic name.
+
+        Only the trie branches that can match are visited, so the cost depends on the
+        topic depth and the number of matches rather than the number of subscriptions.
+        A client with several overlapping subscriptions is returned once, with the
+        subscription granting the highest QoS. Topics starting with $ are not matched
+        by a wildcard at the first level.
+
+        Parameters:
+        - topic (str): The topic name of the published message.
+
+        Returns:
+        - tuple: The matching Subscription objects.
+        """
+        subscriptions = self.match_cache.get(topic)
+        if subscriptions is not None:
+            return subscriptions
+
+        matches = {}
+        levels = topic.split('/')
+
+        if topic.startswith('$'):
+            # Skip the first level so that '#' and '+' at the root are never considered
+            child = self.root.children.get(levels[0])
+            nodes = [child] if child is not None else []
+            levels = levels[1:]
+        else:
+            nodes = [self.root]
+
+        for level in levels:
+            next_nodes = []
+            for node in nodes:
+                if node.hash is not None:
+                    SubscriberManager.__collect(node.hash, matches)
+
+                child = node.children.get(level)
+                if child is not None:
+                    next_nodes.append(child)
+
+                if node.plus is not None:
+                    next_nodes.append(node.plus)
+
+            nodes = next_nodes
+            if not nodes:
+                break
+
+        for node in nodes:
+            SubscriberManager.__collect(node, matches)
+
+            # 'a/#' also matches the parent level 'a'
+            if node.hash is not None:
+                SubscriberManager.__collect(node.hash, matches)
+
+        subscriptions = tuple(matches.values())
+        self.match_cache.put(topic, subscriptions)
+        return subscriptions
+
+    @staticmethod
+    def __collect(node: TopicNode, matches: dict):
+        for client, subscription in node.subscriptions.items():
+            current = matches.get(client)
+            if current is None or subscription.qos > current.qos:
+                matches[client] = subscription
+
+    def publish(self, topic, publish_message: PublishMessage) -> tuple:
+        subscriptions = self.match(topic)
+        self.deliver(subscriptions, publish_message)
+        return subscriptions
+
+    def deliver(self, subscriptions: tuple, publish_message: PublishMessage):
+        for subscription in subscriptions:
+            client = subscription.client
+            try:
+                client.deliver(publish_message, subscription.qos)
+            except OSError as e:
+                self.logger.error('Error forwarding message to subscriber: %s', e)
+                self.unsubscribe(subscription.topic, client)
@@ -0,0 +1,64 @@
+DEFAULT_WHEEL_SIZE = 512
+
+class TimerWheel:
+    """
+    A hashed timer wheel driven by a single periodic tick.
+
+    A timer due in `ticks` ticks lands in slot `(now + ticks) % size` with the number
+    of full rotations left to wait. Scheduling and cancelling are O(1), and a tick
+    only visits the timers hashed to the current slot, no matter how many timers
+    there are in total.
+    """
+    __slots__ = ('slots', 'size', 'now', 'locations')
+
+    def __init__(self, size: int = DEFAULT_WHEEL_SIZE):
+        # key -> rotations left, one dict per slot
+        self.slots = [{} for _ in range(size)]
+        self.size = size
+        self.now = 0
+        # key -> index of the slot holding it
+        self.locations = {}
+
+    def schedule(self, key, ticks: int):
+        """
+        Fire `key` after `ticks` ticks, replacing an earlier schedule of the same key.
+        """
+        self.cancel(key)
+
+        if ticks < 1:
+            ticks = 1
+
+        index = (self.now + ticks) % self.size
+        self.slots[index][key] = (ticks - 1) // self.size
+        self.locations[key] = index
+
+    def cancel(self, key):
+        index = self.locations.pop(key, None)
+        if index is not None:
+            del self.slots[index][key]
+
+    def tick(self) -> list:
+        """
+        Advance the wheel by one tick.
+
+        Returns:
+        - list: The keys whose timers expired.
+        """
+        self.now += 1
+        slot = self.slots[self.now % self.size]
+        expired = []
+
+        for key, rotations in slot.items():
+            if rotations == 0:
+                expired.append(key)
+            else:
+                slot[key] = rotations - 1
+
+        for key in expired:
+            del slot[key]
+            del self.locations[key]
+
+        return expired
+
+    def __len__(self) -> int:
+        return len(self.locations)
@@ -0,0 +1,417 @@
+from Logger import Logger
+
+ACCESS_READ = 1
+ACCESS_WRITE = 2
+ACCESS_READWRITE = ACCESS_READ | ACCESS_WRITE
+
+ACCESS_NAMES = {
+    'read': ACCESS_READ,
+    'write': ACCESS_WRITE,
+    'readwrite': ACCESS_READWRITE,
+    'deny': ACCESS_READWRITE,
+}
+
+# Decisions cached per client before the cache is cleared
+MAX_CLIENT_DECISIONS = 256
+
+class AclNode:
+    """
+    A topic level of a compiled ACL.
+
+    `allow` and `deny` hold the access bits of the rules ending at this level,
+    `subtree_deny` the deny bits of this level and every level below it.
+    """
+    __slots__ = ('children', 'plus', 'hash', 'allow', 'deny', 'subtree_deny')
+
+    def __init__(self):
+        self.children = {}
+        self.plus = None
+        self.hash = None
+        self.allow = 0
+        self.deny = 0
+        self.subtree_deny = 0
+
+class AclTrie:
+    """
+    ACL rules indexed by topic level, checked in O(topic depth) like the subscription trie.
+    """
+    root: AclNode
+    rule_count: int = 0
+
+    def __init__(self):
+        self.root = AclNode()
+        self.rule_count = 0
+
+    def add(self, topic_filter: str, allow: int = 0, deny: int = 0):
+        node = self.root
+        path = [node]
+
+        for level in topic_filter.split('/'):
+            if level == '+':
+                if node.plus is None:
+                    node.plus = AclNode()
+                node = node.plus
+            elif level == '#':
+                if node.hash is None:
+                    node.hash = AclNode()
+                node = node.hash
+            else:
+                child = node.children.get(level)
+                if child is None:
+                    child = node.children[level] = AclNode()
+                node = child
+
+            path.append(node)
+
+        node.allow |= allow
+        node.deny |= deny
+
+        for ancestor in path:
+            ancestor.subtree_deny |= deny
+
+        self.rule_count += 1
+
+    def check_topic(self, topic: str) -> tuple:
+        """
+        Collect the access bits of the rules matching a concrete topic name.
+
+        Returns:
+        - tuple: (allowed bits, denied bits)
+        """
+        allow = deny = 0
+        levels = topic.split('/')
+
+        if topic.startswith('$'):
+            # Wildcards at the first level never match topics starting with $
+            child = self.root.children.get(levels[0])
+            nodes = [child] if child is not None else []
+            levels = levels[1:]
+        else:
+            nodes = [self.root]
+
+        for level in levels:
+            next_nodes = []
+            for node in nodes:
+                if node.hash is not None:
+                    allow |= node.hash.allow
+                    deny |= node.hash.deny
+
+                child = node.children.get(level)
+                if child is not None:
+                    next_nodes.append(child)
+
+                if node.plus is not None:
+                    next_nodes.append(node.plus)
+
+            nodes = next_nodes
+            if not nodes:
+                break
+
+        for node in nodes:
+            allow |= node.allow
+            deny |= node.deny
+
+            # 'a/#' also matches the parent level 'a'
+            if node.hash is not None:
+                allow |= node.hash.allow
+                deny |= node.hash.deny
+
+        return allow, deny
+
+    def check_filter(self, topic_filter: str) -> tuple:
+        """
+        Check a subscription filter against the rules.
+
+        A rule grants the filter only if it matches every topic the filter matches,
+        while a deny rule applies as soon as it shares a single topic with the filter.
+
+        Returns:
+        - tuple: (bits allowed by rules covering the filter, bits denied by rules overlapping it)
+        """
+        return self.__covering(topic_filter.split('/')), self.__overlapping(topic_filter.split('/'))
+
+    def __covering(self, levels: list) -> int:
+        allow = 0
+        nodes = [self.root]
+
+        for i, level in enumerate(levels):
+            next_nodes = []
+            for node in nodes:
+                if i == 0 and level.startswith('$'):
+                    child = node.children.get(level)
+                    if child is not None:
+                        next_nodes.append(child)
+                    continue
+
+                if node.hash is not None:
+                    allow |= node.hash.allow
+
+                if level == '#':
+                    # Every topic has a first level, so '+/#' covers '#' as well
+                    if i == 0 and node.plus is not None and node.plus.hash is not None:
+                        allow |= node.plus.hash.allow
+                    continue
+
+                if level != '+':
+                    child = node.children.get(level)
+                    if child is not None:
+                        next_nodes.append(child)
+
+                if node.plus is not None:
+                    next_nodes.append(node.plus)
+
+            nodes = next_nodes
+            if not nodes:
+                return allow
+
+        for node in nodes:
+            allow |= node.allow
+
+            if node.hash is not None:
+                allow |= node.hash.allow
+
+        return allow
+
+    def __overlapping(self, levels: list) -> int:
+        deny = 0
+        nodes = [self.root]
+
+        for i, level in enumerate(levels):
+            at_root = i == 0
+            next_nodes = []
+
+            for node in nodes:
+                if at_root and level.startswith('$'):
+                    child = node.children.get(level)
+                    if child is not None:
+                        next_nodes.append(child)
+                    continue
+
+                if node.hash is not None:
+                    deny |= node.hash.deny
+
+                if level == '#':
+                    if at_root:
+                        # '#' does not reach the $ topics
+                        deny |= node.deny
+                        for name, child in node.children.items():
+                            if not name.startswith('$'):
+                                deny |= child.subtree_deny
+                        if node.plus is not None:
+                            deny |= node.plus.subtree_deny
+                    else:
+                        deny |= node.subtree_deny
+                    continue
+
+                if level == '+':
+                    for name, child in node.children.items():
+                        if not (at_root and name.startswith('$')):
+                            next_nodes.append(child)
+                else:
+                    child = node.children.get(level)
+                    if child is not None:
+                        next_nodes.append(child)
+
+                if node.plus is not None:
+                    next_nodes.append(node.plus)
+
+            nodes = next_nodes
+            if not nodes:
+                return deny
+
+        for node in nodes:
+            deny |= node.deny
+
+            if node.hash is not None:
+                deny |= node.hash.deny
+
+        return deny
+
+class ClientAcl:
+    """
+    The rules applying to one connected client, with a cache of its recent decisions.
+    """
+    __slots__ = ('tries', 'decisions')
+
+    def __init__(self, tries: list):
+        self.tries = tries
+        # (access, topic) -> bool
+        self.decisions = {}
+
+    def can_publish(self, topic: str) -> bool:
+        key = (ACCESS_WRITE, topic)
+        decision = self.decisions.get(key)
+
+        if decision is None:
+            allow = deny = 0
+            for trie in self.tries:
+                trie_allow, trie_deny = trie.check_topic(topic)
+                allow |= trie_allow
+                deny |= trie_deny
+
+            decision = self.__remember(key, bool(allow & ACCESS_WRITE) and not deny & ACCESS_WRITE)
+
+        return decision
+
+    def can_subscribe(self, topic_filter: str) -> bool:
+        key = (ACCESS_READ, topic_filter)
+        decision = self.decisions.get(key)
+
+        if decision is None:
+            allow = deny = 0
+            for trie in self.tries:
+                trie_allow, trie_deny = trie.check_filter(topic_filter)
+                allow |= trie_allow
+                deny |= trie_deny
+
+            decision = self.__remember(key, bool(allow & ACCESS_READ) and not deny & ACCESS_READ)
+
+        return decision
+
+    def __remember(self, key: tuple, decision: bool) -> bool:
+        if len(self.decisions) >= MAX_CLIENT_DECISIONS:
+            self.decisions = {}
+
+        self.decisions[key] = decision
+        return decision
+
+class TopicAcl:
+    """
+    Publish and subscribe permissions per user and per client id.
+
+    The rule file is line based, '#' at the start of a line is a comment:
+
+        topic read $SYS/#            applies to every client
+        user alice                   the following rules apply to user alice
+        topic readwrite home/#
+        topic deny home/alarm/code
+        client sensor-01             the following rules apply to client id sensor-01
+        topic write sensors/1/#
+        pattern write devices/%c/#   applies to every client, %u is the user name
+        pattern read devices/%u/cmd  and %c the client id
+
+    The access is read, write, readwrite (the default) or deny. Anything not granted
+    is refused and deny wins over any grant. Rules are compiled into one trie per
+    user, per client id and for the global rules when they are loaded; patterns are
+    compiled for each client when it connects.
+    """
+    global_rules: AclTrie
+    user_rules: dict
+    client_rules: dict
+    patterns: list
+
+    def __init__(self, logger: Logger = None):
+        self.global_rules = AclTrie()
+        self.user_rules = {}
+        self.client_rules = {}
+        # (topic filter template, allow bits, deny bits)
+        self.patterns = []
+        self.logger = logger or Logger()
+
+    @staticmethod
+    def load(path: str, logger: Logger = None) -> 'TopicAcl':
+        acl = TopicAcl(logger)
+
+        with open(path) as file:
+            acl.parse(file.read())
+
+        return acl
+
+    def parse(self, text: str):
+        user = client_id = None
+
+        for number, line in enumerate(text.split('\n'), 1):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+
+            keyword, _, rest = line.partition(' ')
+            rest = rest.strip()
+
+            if keyword == 'user':
+                user, client_id = rest, None
+            elif keyword == 'client':
+                user, client_id = None, rest
+            elif keyword == 'topic' or keyword == 'pattern':
+                access, _, topic_filter = rest.partition(' ')
+
+                if access not in ACCESS_NAMES:
+                    # The access may be left out
+                    access, topic_filter = 'readwrite', rest
+
+                topic_filter = topic_filter.strip()
+                if not topic_filter:
+                    raise ValueError(f'ACL line {number}: missing topic')
+
+                if keyword == 'pattern':
+                    self.add_pattern(access, topic_filter)
+                else:
+                    self.add_rule(access, topic_filter, user, client_id)
+            else:
+                raise ValueError(f'ACL line {number}: unknown keyword {keyword}')
+
+    def add_rule(self, access: str, topic_filter: str, user: str = None, client_id: str = None):
+        if user is not None:
+            trie = self.user_rules.get(user)
+            if trie is None:
+                trie = self.user_rules[user] = AclTrie()
+        elif client_id is not None:
+            trie = self.client_rules.get(client_id)
+            if trie is None:
+                trie = self.client_rules[client_id] = AclTrie()
+        else:
+            trie = self.global_rules
+
+        trie.add(topic_filter, *TopicAcl.__access_bits(access))
+
+    def add_pattern(self, access: str, topic_filter: str):
+        allow, deny = TopicAcl.__access_bits(access)
+        self.patterns.append((topic_filter, allow, deny))
+
+    def for_client(self, username: str, client_id: str) -> ClientAcl:
+        tries = []
+
+        if self.global_rules.rule_count:
+            tries.append(self.global_rules)
+
+        if username is not None and username in self.user_rules:
+            tries.append(self.user_rules[username])
+
+        if client_id in self.client_rules:
+            tries.append(self.client_rules[client_id])
+
+        if self.patterns:
+            patterns = AclTrie()
+
+            for topic_filter, allow, deny in self.patterns:
+                if '%u' in topic_filter and username is None:
+                    continue
+
+                substituted = topic_filter.replace('%c', client_id)
+                if username is not None:
+                    substituted = substituted.replace('%u', username)
+
+                # A user name or client id containing wildcards must not widen the rule
+                if not TopicAcl.__is_literal_substitution(topic_filter, substituted):
+                    self.logger.warning('Skipping ACL pattern %s for %s, the substitution contains wildcards', topic_filter, client_id)
+                    continue
+
+                patterns.add(substituted, allow, deny)
+
+            if patterns.rule_count:
+                tries.append(patterns)
+
+        return ClientAcl(tries)
+
+    @staticmethod
+    def __access_bits(access: str) -> tuple:
+        bits = ACCESS_NAMES.get(access)
+        if bits is None:
+            raise ValueError(f'Unknown ACL access: {access}')
+
+        return (0, bits) if access == 'deny' else (bits, 0)
+
+    @staticmethod
+    def __is_literal_substitution(template: str, substituted: str) -> bool:
+        wildcards = template.count('+') + template.count('#')
+        return substituted.count('+') + substituted.count('#') == wildcards and substituted.count('/') == template.count('/')
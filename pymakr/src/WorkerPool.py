@@ -0,0 +1,108 @@
+import asyncio
+import os
+import signal
+import socket
+
+from Logger import Logger
+from PeerLink import PeerLinkProtocol, PeerManager
+
+class WorkerPool:
+    """
+    Runs the broker in several forked processes sharing one port through SO_REUSEPORT.
+
+    Every pair of workers is connected by a Unix socket pair before forking. Each worker
+    announces the topic filters of its own clients over these links, so a message
+    published on one worker is forwarded to exactly the workers with matching subscribers.
+    """
+    workers: int
+    logger: Logger
+
+    def __init__(self, workers: int, server_factory, logger: Logger = None):
+        """
+        Parameters:
+        - workers (int): The number of broker processes to start.
+        - server_factory (callable): Creates the MQTTServer of a worker from its index, called in the worker process.
+        - logger (Logger): The logger of the parent process.
+        """
+        self.workers = workers
+        self.server_factory = server_factory
+        self.logger = logger or Logger()
+
+    def run(self):
+        socket_pairs = {}
+        for i in range(self.workers):
+            for j in range(i + 1, self.workers):
+                socket_pairs[(i, j)] = socket.socketpair()
+
+        pids = []
+        for index in range(self.workers):
+            pid = os.fork()
+
+            if pid == 0:
+                self.__run_child(index, socket_pairs)
+
+            pids.append(pid)
+
+        for left, right in socket_pairs.values():
+            left.close()
+            right.close()
+
+        self.logger.info('Started %s broker workers: %s', self.workers, pids)
+
+        # Termination, profiling and stage timing signals sent to the parent apply to every worker
+        def forward(signum, frame):
+            for pid in pids:
+                try:
+                    os.kill(pid, signum)
+                except OSError:
+                    pass
+
+        signal.signal(signal.SIGTERM, forward)
+        signal.signal(signal.SIGUSR1, forward)
+        signal.signal(signal.SIGUSR2, forward)
+
+        try:
+            for pid in pids:
+                os.waitpid(pid, 0)
+        except KeyboardInterrupt:
+            for pid in pids:
+                try:
+                    os.kill(pid, signal.SIGTERM)
+                except OSError:
+                    pass
+
+    def __run_child(self, index: int, socket_pairs: dict):
+        peer_sockets = {}
+        for (i, j), (left, right) in socket_pairs.items():
+            if i == index:
+                peer_sockets[j] = left
+                right.close()
+            elif j == index:
+                peer_sockets[i] = right
+                left.close()
+            else:
+                left.close()
+                right.close()
+
+        try:
+            asyncio.run(self.run_worker(index, peer_sockets))
+        except (KeyboardInterrupt, asyncio.CancelledError):
+            pass
+        finally:
+            os._exit(0)
+
+    async def run_worker(self, index: int, peer_sockets: dict):
+        loop = asyncio.get_running_loop()
+        loop.add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+
+        server = self.server_factory(index)
+        peer_manager = PeerManager(server.broker.topic_manager, server.logger, retained_store=server.broker.retained_store)
+
+        for peer_index, peer_socket in peer_sockets.items():
+            link_name = f'worker-{peer_index}'
+            await loop.connect_accepted_socket(
+                lambda link_name=link_name: PeerLinkProtocol(peer_manager, link_name, server.logger),
+                peer_socket)
+
+        server.logger.info('Worker %s (pid %s) linked to %s peers', index, os.getpid(), len(peer_sockets))
+        await server.start_server()
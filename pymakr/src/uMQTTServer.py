@@ -1,13 +1,15 @@
 import uasyncio as asyncio
 
 from Broker import Broker
-from Messages import MQTTMessage
+from Messages import MQTTMessage, PACKET_TYPE_PUBLISH
 from Client import Client
+from FrameDecoder import FrameDecoder
 from Logger import Logger
 from Authenticator import Authenticator
 
 DEFAULT_PORT = 1883
 SOCKET_BUFSIZE = 2048
+TICK_INTERVAL = 1
 
 class uMQTTClient(Client):
     def __init__(self, client_name: str, client_reader: asyncio.StreamReader, client_writer: asyncio.StreamWriter, logger = None):
@@ -27,7 +29,18 @@ class uMQTTClient(Client):
         try:
             self.client_writer.write(msg)
         except OSError as e:
-            self.logger.error(f'Error sending message to client: {e}')
+            self.logger.error('Error sending message to client: %s', e)
+
+    def send_parts(self, parts: list, qos: int = 0):
+        try:
+            for part in parts:
+                self.client_writer.write(part)
+        except OSError as e:
+            self.logger.error('Error sending message to client: %s', e)
+            return
+
+        if self.metrics is not None and parts[0][0] >> 4 == PACKET_TYPE_PUBLISH:
+            self.metrics.publish_written(parts)
 
     def close(self):
         self.logger.info('Closing client connection')
@@ -35,7 +48,7 @@ class uMQTTClient(Client):
         try:
             self.client_writer.close()
         except OSError as e:
-            self.logger.error(f'Error closing client connection: {e}')
+            self.logger.error('Error closing client connection: %s', e)
 
 class uMQTTServer:
     def __init__(self, host='0.0.0.0', port=DEFAULT_PORT, broker: Broker=None, logger: Logger=None):
@@ -47,14 +60,17 @@ class uMQTTServer:
     async def handle_client(self, client_reader, client_writer):
         client_name = client_writer.get_extra_info('peername')
 
-        self.logger.info(f'New client connected {client_name}')
+        self.logger.info('New client connected %s', client_name)
 
         client = self.broker.client_manager.get_client(client_name)
 
         if client is None:
             client = uMQTTClient(client_name, client_reader, client_writer, self.broker.logger)
+            client.metrics = self.broker.metrics
             self.broker.client_manager.add_client(client)
 
+        decoder = FrameDecoder(self.broker.max_packet_size)
+
         try:
             while True:
                 data = await client_reader.read(SOCKET_BUFSIZE)
@@ -62,20 +78,29 @@ class uMQTTServer:
                 if not data or len(data) == 0:
                     break
 
-                self.broker.protocol_handler.handle(client, data)
+                self.broker.metrics.bytes_received += len(data)
+
+                for frame in decoder.feed(data):
+                    self.broker.protocol_handler.handle(client, frame)
         except Exception as e:
-            self.logger.error(f'Error handling client: {e}')
+            self.logger.error('Error handling client: %s', e)
             raise e
         finally:
-            self.logger.info(f'Client disconnected {client_name}')
+            self.logger.info('Client disconnected %s', client_name)
             client_writer.close()
             await client_writer.wait_closed()
-            self.broker.client_manager.remove_client(client)
+            self.broker.protocol_handler.handle_connection_lost(client)
 
     async def start_server(self):
         server = await asyncio.start_server(self.handle_client, self.host, self.port, backlog=10)
+        asyncio.create_task(self.tick())
         await server.wait_closed()
 
+    async def tick(self):
+        while True:
+            await asyncio.sleep(TICK_INTERVAL)
+            self.broker.protocol_handler.tick()
+
 def start_local():
     logger = Logger()
     try:
@@ -88,7 +113,7 @@ def start_local():
             "user": "userpass"
         }
 
-        logger.info(f'Starting server listening on {host}:{port}')
+        logger.info('Starting server listening on %s:%s', host, port)
 
         # Initialize the broker
         broker = Broker(authenticator=Authenticator(user_db), logger=logger)
@@ -96,7 +121,7 @@ def start_local():
         server = uMQTTServer(host, port, broker, logger=logger)
         asyncio.run(server.start_server())
     except Exception as e:
-        logger.error(f'Error starting server: {e}')
+        logger.error('Error starting server: %s', e)
         raise e
     finally:
         asyncio.new_event_loop()  # Clear uasyncio stored state
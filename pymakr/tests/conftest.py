@@ -0,0 +1,84 @@
+import os
+import sys
+
+# The broker modules are flat files in src, imported by name as on the device
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from Client import Client
+from Logger import Logger
+from Messages import encode_remaining_length, encode_string
+
+class RecordingClient(Client):
+    """
+    A connection that keeps what the broker does with it instead of writing to a socket.
+
+    `sent` holds every packet sent to the client and `received` the payloads of the
+    messages the subscriber manager delivered to it.
+    """
+    def __init__(self, client_name: str = 'client'):
+        super().__init__(client_name, None, Logger(False))
+        self.sent = []
+        self.received = []
+        self.closed = False
+        self.aborted = False
+        self.paused = False
+
+    def deliver(self, publish_message, qos: int = 0):
+        self.received.append(publish_message.get_payload_bytes())
+        super().deliver(publish_message, qos)
+
+    def send_parts(self, parts: list, qos: int = 0):
+        self.sent.append(b''.join(parts))
+
+    def send(self, msg: bytes):
+        self.sent.append(msg)
+
+    def pause_reading(self):
+        self.paused = True
+
+    def resume_reading(self):
+        self.paused = False
+
+    def abort(self):
+        self.aborted = True
+        self.close()
+
+    def close(self):
+        self.closed = True
+
+    def publishes(self) -> list:
+        """
+        Returns:
+        - list: (payload, packet id) of the MQTT 3.1.1 PUBLISH packets sent, the packet id is None for QoS 0.
+        """
+        publishes = []
+
+        for packet in self.sent:
+            if packet[0] >> 4 != 3:
+                continue
+
+            offset = 1
+            while packet[offset] & 0x80:
+                offset += 1
+            offset += 1
+
+            offset += 2 + int.from_bytes(packet[offset:offset + 2], 'big')
+            packet_id = None
+            if packet[0] & 0x06:
+                packet_id = int.from_bytes(packet[offset:offset + 2], 'big')
+                offset += 2
+
+            publishes.append((bytes(packet[offset:]), packet_id))
+
+        return publishes
+
+def encode_connect(client_id: str, clean_session: bool = True, version: int = 4, properties: bytes = b'\x00') -> bytes:
+    """
+    Encode a CONNECT without credentials, `properties` are only sent for MQTT 5.
+    """
+    body = encode_string('MQTT') + bytes((version, 0x02 if clean_session else 0x00, 0, 60))
+    if version == 5:
+        body += properties
+
+    body += encode_string(client_id)
+    return b'\x10' + encode_remaining_length(len(body)) + body
@@ -0,0 +1,42 @@
+import pytest
+
+from AsyncAuthenticator import AsyncAuthenticator
+from Broker import Broker
+from CredentialStore import DictBackend
+from Logger import Logger
+from Messages import encode_connack
+from MessagesV5 import encode_connack_v5, REASON_NOT_AUTHORIZED
+
+from conftest import RecordingClient, encode_connect
+
+def connect(broker: Broker, version: int = 4) -> RecordingClient:
+    client = RecordingClient()
+    broker.protocol_handler.handle(client, encode_connect('c1', version=version))
+    return client
+
+@pytest.fixture
+def authenticator():
+    return AsyncAuthenticator(DictBackend(), Logger(False))
+
+def test_credential_backend_refuses_anonymous_clients(authenticator):
+    client = connect(Broker(authenticator, Logger(False)))
+
+    assert client.sent == [encode_connack(0, 5)]
+    assert client.closed
+
+def test_credential_backend_refuses_anonymous_mqtt5_clients(authenticator):
+    client = connect(Broker(authenticator, Logger(False)), 5)
+
+    assert client.sent == [encode_connack_v5(False, REASON_NOT_AUTHORIZED)]
+    assert client.closed
+
+def test_allow_anonymous_accepts_clients_without_credentials():
+    client = connect(Broker(AsyncAuthenticator(DictBackend(), Logger(False), allow_anonymous=True), Logger(False)))
+
+    assert client.sent == [encode_connack(0, 0)]
+    assert not client.closed
+
+def test_in_memory_user_database_keeps_accepting_anonymous_clients():
+    client = connect(Broker(logger=Logger(False)))
+
+    assert client.sent == [encode_connack(0, 0)]
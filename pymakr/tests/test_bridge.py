@@ -0,0 +1,160 @@
+import asyncio
+
+from Bridge import Bridge
+from Broker import Broker
+from Logger import Logger
+from Messages import encode_remaining_length, encode_string
+
+from conftest import RecordingClient, encode_connect
+
+async def until(predicate, timeout: float = 2):
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+
+    while not predicate():
+        assert loop.time() < deadline, 'timed out'
+        await asyncio.sleep(0.01)
+
+async def settle():
+    # Give stray copies time to arrive before asserting on counts
+    await asyncio.sleep(0.2)
+
+class Cluster:
+    """
+    Brokers on localhost bridged over real TCP links, `edges` are (connecting node, listening node) pairs.
+    """
+    def __init__(self, names: str, edges: list, max_hops: int = 8):
+        self.names = names
+        self.edges = edges
+        self.brokers = {name: Broker(logger=Logger(False)) for name in names}
+        self.bridges = {name: Bridge(broker, node_id=name, logger=Logger(False), max_hops=max_hops, retry_interval=0.05)
+                        for name, broker in self.brokers.items()}
+        self.servers = []
+
+    async def __aenter__(self):
+        ports = {}
+
+        for name in self.names:
+            server = await self.bridges[name].listen('127.0.0.1', 0)
+            ports[name] = server.sockets[0].getsockname()[1]
+            self.servers.append(server)
+
+        for left, right in self.edges:
+            self.bridges[left].connect('127.0.0.1', ports[right])
+
+        await until(lambda: all(len(self.bridges[name].manager.links) == self.degree(name) for name in self.names))
+        return self
+
+    async def __aexit__(self, *args):
+        for bridge in self.bridges.values():
+            bridge.close()
+
+        for server in self.servers:
+            server.close()
+            await server.wait_closed()
+
+    def degree(self, name: str) -> int:
+        return sum(name in edge for edge in self.edges)
+
+    def manager(self, name: str):
+        return self.bridges[name].manager
+
+    def subscribe(self, name: str, topic: str) -> RecordingClient:
+        subscriber = RecordingClient(f'subscriber-{name}')
+        self.brokers[name].topic_manager.subscribe(topic, subscriber)
+        return subscriber
+
+    def publish(self, name: str, topic: str, payload: bytes):
+        publisher = RecordingClient(f'publisher-{name}')
+        handler = self.brokers[name].protocol_handler
+
+        handler.handle(publisher, encode_connect(publisher.client_name))
+
+        body = encode_string(topic) + payload
+        handler.handle(publisher, b'\x30' + encode_remaining_length(len(body)) + body)
+
+    def count_envelopes(self, name: str) -> list:
+        received = []
+        manager = self.manager(name)
+        handle = manager.handle_bridge_envelope
+
+        def counting(client, envelope):
+            received.append((envelope.origin_node, envelope.sequence))
+            handle(client, envelope)
+
+        manager.handle_bridge_envelope = counting
+        return received
+
+    def wants(self, name: str, topic: str) -> bool:
+        # The node has learned from one of its links that the filter is needed there
+        return topic in self.manager(name).peer_filters
+
+def test_filters_propagate_along_a_chain_and_are_withdrawn():
+    async def run():
+        async with Cluster('ABC', [('A', 'B'), ('B', 'C')]) as cluster:
+            subscriber = cluster.subscribe('C', 'sensors/#')
+            await until(lambda: cluster.wants('A', 'sensors/#'))
+
+            # Split horizon: a filter is never announced back on the link it came from
+            for name in 'AB':
+                manager = cluster.manager(name)
+                for link in manager.peer_filters['sensors/#']:
+                    assert 'sensors/#' not in manager.advertised[link]
+
+            local = cluster.subscribe('B', 'sensors/#')
+            source = cluster.subscribe('A', 'sensors/#')
+            returned = cluster.count_envelopes('A')
+            # B now learns the filter from both of its links
+            await until(lambda: len(cluster.manager('B').peer_filters.get('sensors/#', ())) == 2)
+
+            cluster.publish('A', 'sensors/1', b'21')
+            await until(lambda: subscriber.received == [b'21'])
+            await settle()
+
+            # A subscribes through B too, yet the message is never sent back on the link it came from
+            assert local.received == [b'21']
+            assert source.received == [b'21']
+            assert returned == []
+
+            for name, client in (('A', source), ('B', local), ('C', subscriber)):
+                cluster.brokers[name].topic_manager.unsubscribe('sensors/#', client)
+
+            await until(lambda: not any(cluster.wants(name, 'sensors/#') for name in 'ABC'))
+
+    asyncio.run(run())
+
+def test_messages_are_delivered_once_around_a_loop():
+    async def run():
+        async with Cluster('ABC', [('A', 'B'), ('B', 'C'), ('C', 'A')]) as cluster:
+            subscribers = {name: cluster.subscribe(name, 'loop/#') for name in 'ABC'}
+            await until(lambda: all(len(cluster.manager(name).peer_filters.get('loop/#', ())) == 2 for name in 'ABC'))
+
+            cluster.publish('A', 'loop/1', b'a')
+            cluster.publish('B', 'loop/2', b'b')
+            await until(lambda: all(len(subscriber.received) == 2 for subscriber in subscribers.values()))
+            await settle()
+
+            for subscriber in subscribers.values():
+                assert sorted(subscriber.received) == [b'a', b'b']
+
+            # C got A's message directly and again through B, the second copy was dropped as seen
+            assert ('A', 1) in cluster.manager('C').seen
+            assert ('A', 1) in cluster.manager('B').seen
+
+    asyncio.run(run())
+
+def test_hop_limit_stops_forwarding():
+    async def run():
+        async with Cluster('ABCD', [('A', 'B'), ('B', 'C'), ('C', 'D')], max_hops=2) as cluster:
+            near = cluster.subscribe('C', 'far/#')
+            far = cluster.subscribe('D', 'far/#')
+            await until(lambda: cluster.wants('A', 'far/#'))
+
+            cluster.publish('A', 'far/1', b'x')
+            await until(lambda: near.received == [b'x'])
+            await settle()
+
+            # A -> B -> C takes the two allowed hops, C does not forward to D
+            assert far.received == []
+
+    asyncio.run(run())
@@ -0,0 +1,102 @@
+from Broker import Broker
+from Logger import Logger
+from Messages import encode_ack, encode_remaining_length, encode_string, encode_subscribe
+
+from conftest import RecordingClient, encode_connect
+
+def connect(broker: Broker, client_id: str, subscription: str) -> RecordingClient:
+    client = RecordingClient(client_id)
+    broker.protocol_handler.handle(client, encode_connect(client_id))
+    broker.protocol_handler.handle(client, encode_subscribe(1, subscription, 1))
+
+    # One delivery in flight, congested once two more wait behind it
+    client.inflight.receive_maximum = 1
+    client.inflight.max_pending = 2
+    return client
+
+def publish(broker: Broker, client: RecordingClient, topic: str, count: int):
+    for packet_id in range(1, count + 1):
+        body = encode_string(topic) + packet_id.to_bytes(2, 'big') + b'x'
+        broker.protocol_handler.handle(client, b'\x32' + encode_remaining_length(len(body)) + body)
+
+def acknowledge_all(broker: Broker, client: RecordingClient):
+    while client.inflight.messages:
+        broker.protocol_handler.handle(client, encode_ack(4, next(iter(client.inflight.messages))))
+
+def test_publisher_is_paused_until_the_subscriber_drains():
+    broker = Broker(logger=Logger(False), backpressure=True)
+    publisher = connect(broker, 'publisher', 'unused')
+    subscriber = connect(broker, 'subscriber', 'data')
+
+    publish(broker, publisher, 'data', 2)
+    assert not publisher.paused
+
+    publish(broker, publisher, 'data', 1)
+    assert subscriber.is_congested()
+    assert publisher.paused
+    assert broker.flow_controller.paused_count() == 1
+
+    acknowledge_all(broker, subscriber)
+    assert not publisher.paused
+    assert broker.flow_controller.paused_count() == 0
+
+def test_disconnecting_subscriber_releases_its_publishers():
+    broker = Broker(logger=Logger(False), backpressure=True)
+    publisher = connect(broker, 'publisher', 'unused')
+    subscriber = connect(broker, 'subscriber', 'data')
+
+    publish(broker, publisher, 'data', 3)
+    assert publisher.paused
+
+    broker.protocol_handler.handle_connection_lost(subscriber)
+    assert not publisher.paused
+    assert broker.flow_controller.paused_count() == 0
+    assert subscriber.on_drained is None
+
+def test_disconnecting_publisher_is_forgotten():
+    broker = Broker(logger=Logger(False), backpressure=True)
+    publisher = connect(broker, 'publisher', 'unused')
+    subscriber = connect(broker, 'subscriber', 'data')
+
+    publish(broker, publisher, 'data', 3)
+    broker.protocol_handler.handle_connection_lost(publisher)
+
+    assert broker.flow_controller.paused_count() == 0
+    assert subscriber.on_drained is None
+
+def test_clients_publishing_to_each_other_do_not_pause_each_other():
+    broker = Broker(logger=Logger(False), backpressure=True)
+    a = connect(broker, 'a', 'to/a')
+    b = connect(broker, 'b', 'to/b')
+
+    # a is congested, b is paused and cannot have its own acknowledgements read
+    publish(broker, b, 'to/a', 3)
+    assert b.paused
+
+    # b congests too because it is paused, a must keep being read
+    publish(broker, a, 'to/b', 3)
+    assert b.is_congested()
+    assert not a.paused
+
+    # a acknowledges its deliveries, which releases b, which can then acknowledge its own
+    acknowledge_all(broker, a)
+    assert not b.paused
+    acknowledge_all(broker, b)
+    assert broker.flow_controller.paused_count() == 0
+
+def test_congested_publisher_is_not_paused():
+    broker = Broker(logger=Logger(False), backpressure=True)
+    a = connect(broker, 'a', 'to/a')
+    b = connect(broker, 'b', 'to/b')
+
+    publish(broker, b, 'to/a', 3)
+    publish(broker, a, 'to/b', 3)
+    acknowledge_all(broker, a)
+    acknowledge_all(broker, b)
+    assert not a.paused and not b.paused
+
+    # Both congested, neither waits on the other
+    publish(broker, a, 'to/b', 3)
+    publish(broker, b, 'to/a', 3)
+    assert a.is_congested() and b.is_congested()
+    assert not b.paused
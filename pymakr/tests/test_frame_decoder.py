@@ -0,0 +1,86 @@
+import pytest
+
+from FrameDecoder import FrameDecoder, PacketTooLargeError
+from Messages import encode_remaining_length, encode_string
+
+def packet(payload_length: int, packet_type: int = 3) -> bytes:
+    body = encode_string('t') + bytes(index % 251 for index in range(payload_length))
+    return bytes((packet_type << 4,)) + encode_remaining_length(len(body)) + body
+
+def test_frame_split_at_every_position_is_reassembled():
+    # 200 byte remaining length takes a two byte varint
+    frames = [packet(197), packet(0), b'\xc0\x00']
+    stream = b''.join(frames)
+
+    for split in range(1, len(stream)):
+        decoder = FrameDecoder()
+        decoded = list(decoder.feed(stream[:split])) + list(decoder.feed(stream[split:]))
+        assert [bytes(frame) for frame in decoded] == frames, split
+        assert not decoder.buffer
+
+def test_frame_fed_one_byte_at_a_time():
+    frames = [packet(20000), b'\xc0\x00']
+    stream = b''.join(frames)
+    decoder = FrameDecoder()
+
+    decoded = []
+    for index in range(len(stream)):
+        decoded.extend(decoder.feed(stream[index:index + 1]))
+
+    assert [bytes(frame) for frame in decoded] == frames
+
+def test_frames_within_one_chunk_are_memoryview_slices():
+    frames = [packet(5), b'\xc0\x00', packet(300)]
+    chunk = b''.join(frames)
+
+    decoded = list(FrameDecoder().feed(chunk))
+
+    assert all(isinstance(frame, memoryview) for frame in decoded)
+    assert [frame.obj for frame in decoded] == [chunk] * 3
+    assert [bytes(frame) for frame in decoded] == frames
+
+def test_frames_completed_from_a_carried_over_tail_are_copied():
+    first, second = packet(10), packet(10)
+    decoder = FrameDecoder()
+
+    assert [bytes(frame) for frame in decoder.feed(first + second[:4])] == [first]
+    decoded = list(decoder.feed(second[4:]))
+
+    # The receive buffer is reused, the frame must not be a view of it
+    assert decoded == [second]
+    assert isinstance(decoded[0], bytes)
+
+def test_remaining_length_of_five_bytes_is_rejected():
+    decoder = FrameDecoder()
+
+    # The longest valid remaining length only waits for more data
+    assert list(decoder.feed(b'\x30\xff\xff\xff\x7f')) == []
+
+    with pytest.raises(ValueError):
+        list(FrameDecoder().feed(b'\x30\xff\xff\xff\xff\x01'))
+
+    decoder = FrameDecoder()
+    list(decoder.feed(b'\x30\xff\xff'))
+    with pytest.raises(ValueError):
+        list(decoder.feed(b'\xff\xff\x01'))
+
+def test_packet_larger_than_the_maximum_is_refused():
+    limit = len(packet(100))
+    decoder = FrameDecoder(max_packet_size=limit)
+
+    assert [bytes(frame) for frame in decoder.feed(packet(100))] == [packet(100)]
+
+    with pytest.raises(PacketTooLargeError):
+        list(decoder.feed(packet(101)))
+
+    # Refused from the header alone, before the payload arrives
+    with pytest.raises(PacketTooLargeError):
+        list(FrameDecoder(max_packet_size=limit).feed(packet(5000)[:3]))
+
+def test_reset_drops_the_partial_frame():
+    decoder = FrameDecoder()
+    list(decoder.feed(packet(300)[:10]))
+
+    decoder.reset()
+
+    assert [bytes(frame) for frame in decoder.feed(b'\xc0\x00')] == [b'\xc0\x00']
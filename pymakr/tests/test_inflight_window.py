@@ -0,0 +1,107 @@
+from Broker import Broker
+from InflightWindow import InflightWindow
+from Logger import Logger
+from Messages import PublishMessage, encode_ack, encode_remaining_length, encode_string, encode_subscribe
+
+from conftest import RecordingClient, encode_connect
+
+def sent_packet_ids(client: RecordingClient) -> list:
+    # QoS 1 PUBLISH: fixed header, remaining length, topic, packet id
+    return [int.from_bytes(packet[-4:-2], 'big') for packet in client.sent]
+
+def publish(index: int, qos: int = 1) -> PublishMessage:
+    return PublishMessage.build('sensors/1', index.to_bytes(2, 'big'), qos)
+
+def test_holds_every_message_beyond_the_window():
+    client = RecordingClient()
+    window = client.inflight = InflightWindow(receive_maximum=4, max_pending=8, hard_limit_pending=100)
+
+    for index in range(50):
+        assert window.send(client, publish(index), 1)
+
+    assert len(window.messages) == 4
+    assert len(window.pending) == 46
+    assert window.dropped == 0
+    assert client.is_congested()
+
+    delivered = []
+    while client.sent:
+        packet = client.sent.pop(0)
+        delivered.append(int.from_bytes(packet[-2:], 'big'))
+        window.acknowledge(client, int.from_bytes(packet[-4:-2], 'big'))
+
+    assert delivered == list(range(50))
+    assert not window.messages and not window.pending
+    assert not client.is_congested()
+
+def test_qos2_messages_are_held_too():
+    client = RecordingClient()
+    window = client.inflight = InflightWindow(receive_maximum=1, max_pending=2, hard_limit_pending=10)
+
+    for index in range(5):
+        assert window.send(client, publish(index, 2), 2)
+
+    assert [qos for _, qos, _ in window.pending] == [2, 2, 2, 2]
+    assert [qos for _, qos in window.drain()] == [2] * 5
+
+def test_drained_callback_fires_once_below_the_soft_limit():
+    client = RecordingClient()
+    window = client.inflight = InflightWindow(receive_maximum=1, max_pending=2, hard_limit_pending=10)
+    drained = []
+    client.on_drained = drained.append
+
+    for index in range(4):
+        window.send(client, publish(index), 1)
+
+    assert client.is_congested()
+    window.acknowledge(client, sent_packet_ids(client)[-1])
+    assert drained == []
+
+    window.acknowledge(client, sent_packet_ids(client)[-1])
+    assert drained == [client]
+
+def test_refuses_past_the_hard_limit_and_subscriber_is_disconnected():
+    client = RecordingClient()
+    window = client.inflight = InflightWindow(receive_maximum=2, max_pending=3, hard_limit_pending=5)
+
+    for index in range(7):
+        publish(index).send_to_subscriber(client, 1)
+
+    assert not client.aborted
+    publish(7).send_to_subscriber(client, 1)
+
+    assert client.aborted
+    assert window.dropped == 1
+    # Everything accepted is still there for the session
+    assert len(window.drain()) == 7
+
+def connected(broker: Broker, client_id: str) -> RecordingClient:
+    client = RecordingClient(client_id)
+    broker.protocol_handler.handle(client, encode_connect(client_id))
+    client.sent.clear()
+    return client
+
+def test_retransmission_only_visits_clients_with_unacknowledged_messages():
+    broker = Broker(logger=Logger(False), retry_interval=0)
+    handler = broker.protocol_handler
+    for index in range(100):
+        connected(broker, f'idle-{index}')
+
+    subscriber = connected(broker, 'subscriber')
+    handler.handle(subscriber, encode_subscribe(1, 'data', 1))
+    publisher = connected(broker, 'publisher')
+    assert handler.retry_clients == set()
+
+    body = encode_string('data') + b'\x00\x07' + b'x'
+    handler.handle(publisher, b'\x34' + encode_remaining_length(len(body)) + body)
+    # The delivery waits for PUBACK, the QoS 2 packet id of the publisher for PUBREL
+    assert handler.retry_clients == {subscriber, publisher}
+
+    subscriber.sent.clear()
+    handler.tick()
+    assert len(subscriber.sent) == 1 and subscriber.sent[0][0] & 0x08
+
+    handler.handle(subscriber, encode_ack(4, next(iter(subscriber.inflight.messages))))
+    handler.handle(publisher, encode_ack(6, 7))
+    handler.tick()
+    assert handler.retry_clients == set()
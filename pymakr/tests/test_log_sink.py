@@ -0,0 +1,36 @@
+import threading
+
+from LogSink import ThreadedSink
+
+class BlockingStream:
+    def __init__(self):
+        self.lines = []
+        self.released = threading.Event()
+
+    def write(self, text: str):
+        self.released.wait()
+        self.lines.extend(text.splitlines())
+
+    def flush(self):
+        pass
+
+def test_every_record_is_written_or_counted_as_dropped():
+    sink = ThreadedSink(max_records=10)
+    stream = sink.stream = BlockingStream()
+    total = 2000
+
+    def produce(offset: int):
+        for index in range(total // 4):
+            sink(0, '', 'record %s', (offset + index,))
+
+    threads = [threading.Thread(target=produce, args=(offset,)) for offset in range(0, total, total // 4)]
+    for thread in threads:
+        thread.start()
+    stream.released.set()
+    for thread in threads:
+        thread.join()
+    sink.close()
+
+    dropped = [line for line in stream.lines if line.endswith('log records dropped')]
+    written = len(stream.lines) - len(dropped)
+    assert written + sum(int(line.split()[0]) for line in dropped) == total
@@ -0,0 +1,54 @@
+import random
+
+from SubscriberManager import MatchCache, Subscription
+
+LEVELS = ('a', 'b', 'c', '')
+
+def random_topic(rng: random.Random) -> str:
+    return '/'.join(rng.choice(LEVELS) for _ in range(rng.randint(1, 4)))
+
+def random_filter(rng: random.Random) -> str:
+    levels = [rng.choice(LEVELS + ('+',)) for _ in range(rng.randint(1, 4))]
+    if rng.random() < 0.3:
+        levels.append('#')
+    return '/'.join(levels)
+
+def test_invalidation_drops_exactly_the_matching_topics():
+    rng = random.Random(3)
+
+    for _ in range(300):
+        cache = MatchCache(64)
+        topics = {random_topic(rng) for _ in range(30)}
+        for topic in topics:
+            cache.put(topic, ())
+
+        topic_filters = [random_filter(rng) for _ in range(rng.randint(1, 3))]
+        cache.invalidate_many(topic_filters)
+
+        expected = {topic for topic in topics
+                    if not any(Subscription(topic_filter, None).is_for_topic(topic) for topic_filter in topic_filters)}
+        assert set(cache.entries) == expected
+        assert cache.invalidations == len(topics) - len(expected)
+
+def test_hash_matches_the_parent_level():
+    cache = MatchCache()
+    for topic in ('a', 'a/b', 'a/b/c', 'ab', 'b/a'):
+        cache.put(topic, ())
+
+    cache.invalidate('a/#')
+
+    assert set(cache.entries) == {'ab', 'b/a'}
+
+def test_index_is_pruned_when_entries_go_away():
+    cache = MatchCache(2)
+    cache.put('a/b/c', ())
+    cache.put('a/b', ())
+    cache.put('x/y', ())
+
+    # 'a/b/c' was evicted, 'a/b' keeps its level
+    assert set(cache.topics.children) == {'a', 'x'}
+    assert not cache.topics.children['a'].children['b'].children
+
+    cache.invalidate('+/+')
+    assert cache.topics.children == {}
+    assert not cache.entries
@@ -0,0 +1,206 @@
+import struct
+
+import pytest
+
+from Broker import Broker
+from FrameDecoder import FrameDecoder, PacketTooLargeError
+from Logger import Logger
+from Messages import PublishMessage, encode_remaining_length, encode_string
+from MessagesV5 import (ConnectionV5, PublishMessageV5, create_message_v5, decode_properties, encode_ack_v5, encode_connack_v5, encode_disconnect_v5,
+                        encode_properties, encode_suback_v5, encode_unsuback_v5, scan_properties,
+                        PROPERTY_CONTENT_TYPE, PROPERTY_MAXIMUM_PACKET_SIZE, PROPERTY_PAYLOAD_FORMAT_INDICATOR, PROPERTY_RECEIVE_MAXIMUM,
+                        PROPERTY_SUBSCRIPTION_IDENTIFIER, PROPERTY_TOPIC_ALIAS, PROPERTY_TOPIC_ALIAS_MAXIMUM, PROPERTY_USER_PROPERTY,
+                        REASON_MALFORMED_PACKET, REASON_NO_MATCHING_SUBSCRIBERS, REASON_NO_SUBSCRIPTION_EXISTED, REASON_PACKET_TOO_LARGE,
+                        REASON_PROTOCOL_ERROR, REASON_SUCCESS, REASON_TOPIC_ALIAS_INVALID, REASON_TOPIC_FILTER_INVALID)
+
+from conftest import RecordingClient, encode_connect
+
+def publish_v5(topic: str, payload: bytes, properties: bytes = b'\x00', qos: int = 0, packet_id: int = 1) -> bytes:
+    body = encode_string(topic) + (struct.pack('>H', packet_id) if qos else b'') + properties + payload
+    return bytes((0x30 | (qos << 1),)) + encode_remaining_length(len(body)) + body
+
+
+def test_scan_properties_reports_values_and_offsets():
+    buf = (bytes((PROPERTY_PAYLOAD_FORMAT_INDICATOR, 1))
+           + bytes((PROPERTY_TOPIC_ALIAS, 0x01, 0x02))
+           + bytes((PROPERTY_SUBSCRIPTION_IDENTIFIER, 0x80, 0x01))
+           + bytes((PROPERTY_CONTENT_TYPE,)) + encode_string('text/plain')
+           + bytes((PROPERTY_USER_PROPERTY,)) + encode_string('k') + encode_string('v'))
+
+    scanned = list(scan_properties(buf))
+
+    assert [(identifier, value) for identifier, value, _, _ in scanned] == [
+        (PROPERTY_PAYLOAD_FORMAT_INDICATOR, 1),
+        (PROPERTY_TOPIC_ALIAS, 0x0102),
+        (PROPERTY_SUBSCRIPTION_IDENTIFIER, 128),
+        (PROPERTY_CONTENT_TYPE, 'text/plain'),
+        (PROPERTY_USER_PROPERTY, ('k', 'v')),
+    ]
+    assert [(start, end) for _, _, start, end in scanned] == [(0, 2), (2, 5), (5, 8), (8, 21), (21, 28)]
+
+def test_decode_properties_round_trips_encode_properties():
+    properties = [(PROPERTY_RECEIVE_MAXIMUM, 10), (PROPERTY_MAXIMUM_PACKET_SIZE, 1024), (PROPERTY_USER_PROPERTY, ('a', '1')), (PROPERTY_USER_PROPERTY, ('b', '2'))]
+    encoded = encode_properties(properties)
+
+    assert encoded[0] == len(encoded) - 1
+    assert decode_properties(encoded[1:]) == {
+        PROPERTY_RECEIVE_MAXIMUM: 10,
+        PROPERTY_MAXIMUM_PACKET_SIZE: 1024,
+        PROPERTY_USER_PROPERTY: [('a', '1'), ('b', '2')],
+    }
+
+@pytest.mark.parametrize('buf', [
+    bytes((PROPERTY_RECEIVE_MAXIMUM, 0, 1, PROPERTY_RECEIVE_MAXIMUM, 0, 2)),  # duplicate property
+    bytes((0x7F, 0)),                                                        # unknown property
+    bytes((PROPERTY_MAXIMUM_PACKET_SIZE, 0, 0)),                             # truncated value
+    bytes((PROPERTY_CONTENT_TYPE, 0, 5)) + b'ab',                            # string past the end
+])
+def test_decode_properties_rejects_malformed_blocks(buf):
+    with pytest.raises(ValueError):
+        decode_properties(buf)
+
+def test_ack_encodings():
+    assert encode_connack_v5(True, REASON_SUCCESS) == bytes((0x20, 0x03, 0x01, 0x00, 0x00))
+    assert encode_ack_v5(4, 7) == bytes((0x40, 0x02, 0x00, 0x07))
+    assert encode_ack_v5(4, 7, REASON_NO_MATCHING_SUBSCRIBERS) == bytes((0x40, 0x03, 0x00, 0x07, 0x10))
+    assert encode_suback_v5(10, bytes((1, REASON_TOPIC_FILTER_INVALID))) == bytes((0x90, 0x05, 0x00, 0x0A, 0x00, 0x01, 0x8F))
+    assert encode_unsuback_v5(10, bytes((REASON_SUCCESS, REASON_NO_SUBSCRIPTION_EXISTED))) == bytes((0xB0, 0x05, 0x00, 0x0A, 0x00, 0x00, 0x11))
+    assert encode_disconnect_v5(REASON_PACKET_TOO_LARGE) == bytes((0xE0, 0x01, 0x95))
+
+def test_publish_forwards_properties_but_the_topic_alias():
+    content_type = bytes((PROPERTY_CONTENT_TYPE,)) + encode_string('json')
+    properties = bytes((PROPERTY_TOPIC_ALIAS, 0, 3)) + content_type
+    message = create_message_v5(publish_v5('a/b', b'{}', encode_remaining_length(len(properties)) + properties))
+
+    assert isinstance(message, PublishMessageV5)
+    assert message.topic_name == 'a/b'
+    assert message.topic_alias == 3
+    assert message.properties == content_type
+    assert bytes(message.payload) == b'{}'
+
+def test_publish_with_subscription_identifier_is_malformed():
+    with pytest.raises(ValueError):
+        create_message_v5(publish_v5('a/b', b'', bytes((2, PROPERTY_SUBSCRIPTION_IDENTIFIER, 1))))
+
+def test_alias_only_publish_resolves_a_known_alias():
+    connection = ConnectionV5({}, inbound_alias_maximum=4)
+    alias = bytes((3, PROPERTY_TOPIC_ALIAS, 0, 2))
+
+    alias_only = create_message_v5(publish_v5('', b'x', alias))
+    assert alias_only.topic_name == ''
+    assert connection.resolve_topic(alias_only) == REASON_PROTOCOL_ERROR
+
+    assert connection.resolve_topic(create_message_v5(publish_v5('a/b', b'x', alias))) == REASON_SUCCESS
+    alias_only = create_message_v5(publish_v5('', b'y', alias))
+    assert connection.resolve_topic(alias_only) == REASON_SUCCESS
+    assert alias_only.topic_name == 'a/b'
+    assert bytes(alias_only.get_topic_segment()) == encode_string('a/b')
+
+@pytest.mark.parametrize('alias', [0, 5])
+def test_alias_outside_the_announced_maximum_is_invalid(alias):
+    connection = ConnectionV5({}, inbound_alias_maximum=4)
+    message = create_message_v5(publish_v5('a/b', b'x', bytes((3, PROPERTY_TOPIC_ALIAS, 0, alias))))
+
+    assert connection.resolve_topic(message) == REASON_TOPIC_ALIAS_INVALID
+
+def test_publish_without_topic_or_alias_is_a_protocol_error():
+    connection = ConnectionV5({}, inbound_alias_maximum=4)
+
+    assert connection.resolve_topic(create_message_v5(publish_v5('', b'x'))) == REASON_PROTOCOL_ERROR
+
+def test_outbound_alias_replaces_the_topic_after_the_first_publish():
+    client = RecordingClient()
+    client.v5 = ConnectionV5({PROPERTY_TOPIC_ALIAS_MAXIMUM: 1}, outbound_alias_maximum=8)
+    message = PublishMessage.build('a/b', b'x', 0)
+
+    message.transmit(client, 0)
+    message.transmit(client, 0)
+    PublishMessage.build('c/d', b'x', 0).transmit(client, 0)
+
+    assert client.sent == [
+        bytes((0x30, 0x0A)) + encode_string('a/b') + bytes((3, PROPERTY_TOPIC_ALIAS, 0, 1)) + b'x',
+        bytes((0x30, 0x07, 0x00, 0x00, 3, PROPERTY_TOPIC_ALIAS, 0, 1)) + b'x',
+        # Only one alias allowed, further topics are sent in full
+        bytes((0x30, 0x07)) + encode_string('c/d') + b'\x00' + b'x',
+    ]
+
+@pytest.mark.parametrize('qos', [0, 1])
+def test_fits_is_an_upper_bound_of_the_encoded_size(qos):
+    client = RecordingClient()
+    client.v5 = ConnectionV5({PROPERTY_TOPIC_ALIAS_MAXIMUM: 4}, outbound_alias_maximum=4)
+    message = PublishMessage.build('sensors/temperature', b'21.5' * 10, qos)
+    message.transmit(client, qos, 1 if qos else None)
+    size = len(client.sent[0])
+
+    client.v5.maximum_packet_size = size
+    assert client.v5.fits(message, qos)
+
+    client.v5.maximum_packet_size = size - 1
+    assert not client.v5.fits(message, qos)
+
+    client.v5.maximum_packet_size = 0
+    assert client.v5.fits(message, qos)
+
+def test_oversized_message_is_discarded_not_sent():
+    client = RecordingClient()
+    client.v5 = ConnectionV5({PROPERTY_MAXIMUM_PACKET_SIZE: 16})
+
+    PublishMessage.build('a/b', b'x' * 32, 1).send_to_subscriber(client, 1)
+
+    assert client.sent == []
+    assert client.v5.discarded == 1
+
+def test_connection_refuses_receive_maximum_zero():
+    with pytest.raises(ValueError):
+        ConnectionV5({PROPERTY_RECEIVE_MAXIMUM: 0})
+
+def test_connect_with_receive_maximum_zero_is_refused_as_malformed():
+    broker = Broker(logger=Logger(False))
+    client = RecordingClient()
+
+    broker.protocol_handler.handle(client, encode_connect('c1', version=5, properties=bytes((3, PROPERTY_RECEIVE_MAXIMUM, 0, 0))))
+
+    assert client.sent == [encode_connack_v5(False, REASON_MALFORMED_PACKET)]
+    assert client.closed
+
+def test_connect_announces_limits_in_connack():
+    broker = Broker(logger=Logger(False), max_packet_size=512, topic_alias_maximum=8)
+    client = RecordingClient()
+
+    broker.protocol_handler.handle(client, encode_connect('c1', version=5, properties=bytes((3, PROPERTY_RECEIVE_MAXIMUM, 0, 5))))
+
+    connack = client.sent[0]
+    assert connack[:4] == bytes((0x20, len(connack) - 2, 0x00, REASON_SUCCESS))
+    properties = decode_properties(connack[5:])
+    assert properties[PROPERTY_MAXIMUM_PACKET_SIZE] == 512
+    assert properties[PROPERTY_TOPIC_ALIAS_MAXIMUM] == 8
+    assert client.v5.receive_maximum == 5
+    assert client.inflight.receive_maximum == 5
+
+def test_frame_decoder_refuses_a_packet_larger_than_the_maximum():
+    decoder = FrameDecoder(max_packet_size=16)
+    small = publish_v5('a', b'x')
+    assert list(decoder.feed(small)) == [small]
+
+    # Refused from the fixed header alone, before the payload is buffered
+    header = bytes((0x30,)) + encode_remaining_length(1000)
+    with pytest.raises(PacketTooLargeError):
+        list(decoder.feed(header))
+
+def test_frame_decoder_without_maximum_accepts_large_packets():
+    decoder = FrameDecoder()
+    packet = publish_v5('a', b'x' * 1000)
+
+    assert [bytes(frame) for frame in decoder.feed(packet[:10])] == []
+    assert [bytes(frame) for frame in decoder.feed(packet[10:])] == [packet]
+
+def test_alias_only_publish_with_an_unknown_alias_disconnects():
+    broker = Broker(logger=Logger(False))
+    client = RecordingClient()
+    broker.protocol_handler.handle(client, encode_connect('c1', version=5))
+    client.sent.clear()
+
+    broker.protocol_handler.handle(client, publish_v5('', b'x', bytes((3, PROPERTY_TOPIC_ALIAS, 0, 1)), qos=1))
+
+    assert client.sent == [encode_disconnect_v5(REASON_PROTOCOL_ERROR)]
+    assert client.closed
@@ -0,0 +1,132 @@
+from Broker import Broker
+from Logger import Logger
+from Messages import encode_remaining_length, encode_string, encode_subscribe
+from Metrics import METRICS
+from MQTTServer import MQTTClient
+from OutboundQueue import OutboundQueueLimits
+
+from conftest import RecordingClient, encode_connect
+
+class RecordingTransport:
+    def __init__(self):
+        self.written = []
+        self.aborted = False
+
+    def writelines(self, parts):
+        self.written.append(b''.join(parts))
+
+    def get_write_buffer_size(self):
+        return 0
+
+    def abort(self):
+        self.aborted = True
+
+    def close(self):
+        pass
+
+    def is_closing(self):
+        return self.aborted
+
+def encode_publish(topic: str, payload: bytes, qos: int = 0, packet_id: int = 1, retain: bool = False) -> bytes:
+    body = encode_string(topic) + (packet_id.to_bytes(2, 'big') if qos else b'') + payload
+    return bytes((0x30 | qos << 1 | (0x01 if retain else 0),)) + encode_remaining_length(len(body)) + body
+
+def subscriber(broker: Broker, topic: str, queue_limits: OutboundQueueLimits = None) -> MQTTClient:
+    transport = RecordingTransport()
+    client = MQTTClient('subscriber', None, transport, Logger(False), queue_limits)
+    client.metrics = broker.metrics
+    broker.protocol_handler.handle(client, encode_connect('subscriber'))
+    broker.protocol_handler.handle(client, encode_subscribe(1, topic, 0))
+    return client
+
+def publisher(broker: Broker) -> RecordingClient:
+    client = RecordingClient('publisher')
+    broker.protocol_handler.handle(client, encode_connect('publisher'))
+    return client
+
+def test_publishes_are_counted_when_written_to_the_connection():
+    broker = Broker(logger=Logger(False))
+    client = subscriber(broker, 'a/#')
+    source = publisher(broker)
+
+    # CONNACK and SUBACK are not publishes
+    assert len(client.transport.written) == 2
+    assert broker.metrics.publish_sent == broker.metrics.bytes_sent == 0
+
+    broker.protocol_handler.handle(source, encode_publish('a/b', b'hello'))
+    broker.protocol_handler.handle(source, encode_publish('elsewhere', b'hello'))
+
+    assert broker.metrics.publish_received == 2
+    assert broker.metrics.publish_sent == 1
+    assert broker.metrics.bytes_sent == len(client.transport.written[-1])
+
+def test_publishes_dropped_by_the_outbound_queue_are_not_counted():
+    broker = Broker(logger=Logger(False))
+    client = subscriber(broker, 'a/#', OutboundQueueLimits(max_messages=2))
+    broker.client_manager.add_client(client)
+    source = publisher(broker)
+    written = len(client.transport.written)
+
+    client.pause_writing()
+    for index in range(5):
+        broker.protocol_handler.handle(source, encode_publish('a/b', bytes((index,))))
+
+    assert broker.metrics.publish_sent == 0
+    assert broker.metrics.snapshot()['queue/messages'] == 2
+    assert broker.metrics.snapshot()['messages/dropped'] == 3
+
+    client.resume_writing()
+
+    sent = client.transport.written[written:]
+    assert broker.metrics.publish_sent == len(sent) == 2
+    assert broker.metrics.bytes_sent == sum(len(packet) for packet in sent)
+
+def test_snapshot_reports_every_metric():
+    broker = Broker(logger=Logger(False))
+    client = RecordingClient('subscriber')
+    broker.client_manager.add_client(client)
+    broker.protocol_handler.handle(client, encode_connect('subscriber'))
+    broker.protocol_handler.handle(client, encode_subscribe(1, 'a/#', 1))
+    client.inflight.receive_maximum = 1
+    source = publisher(broker)
+    broker.client_manager.add_client(source)
+
+    for packet_id in range(1, 4):
+        broker.protocol_handler.handle(source, encode_publish('a/b', b'x', 1, packet_id))
+    broker.protocol_handler.handle(source, encode_publish('status', b'on', retain=True))
+
+    snapshot = broker.metrics.snapshot()
+
+    assert list(snapshot) == list(METRICS)
+    assert snapshot['clients/connected'] == 2
+    assert snapshot['clients/total'] == 2
+    assert snapshot['messages/received'] == 7
+    assert snapshot['publish/received'] == 4
+    assert snapshot['subscriptions/count'] == 1
+    assert snapshot['retained/count'] == 1
+    assert snapshot['inflight/messages'] == 1
+    assert snapshot['inflight/pending'] == 2
+
+def test_prometheus_exposition():
+    broker = Broker(logger=Logger(False))
+    broker.metrics.publish_received = 3
+    broker.metrics.bytes_received = 120
+
+    lines = broker.metrics.prometheus().splitlines()
+
+    assert len(lines) == 3 * len(METRICS)
+    assert lines[:3] == [
+        '# HELP mqtt_clients_connected Connected clients',
+        '# TYPE mqtt_clients_connected gauge',
+        'mqtt_clients_connected 0',
+    ]
+    # Counters get the _total suffix, once
+    assert '# TYPE mqtt_publish_received_total counter' in lines
+    assert 'mqtt_publish_received_total 3' in lines
+    assert 'mqtt_clients_total 0' in lines
+    assert 'mqtt_bytes_received_total 120' in lines
+
+    labelled = broker.metrics.prometheus({'worker': 2}).splitlines()
+
+    assert 'mqtt_publish_received_total{worker="2"} 3' in labelled
+    assert all(line.startswith('#') or '{worker="2"} ' in line for line in labelled)
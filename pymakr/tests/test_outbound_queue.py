@@ -0,0 +1,80 @@
+from Client import ClientSettings
+from Logger import Logger
+from MQTTServer import MQTTClient
+from OutboundQueue import OutboundQueue, OutboundQueueLimits, POLICY_DROP_NEW
+
+def packet(index: int) -> list:
+    return [index.to_bytes(4, 'big')]
+
+def drain(queue: OutboundQueue) -> list:
+    popped = []
+    while len(queue):
+        popped.append(int.from_bytes(queue.pop()[0], 'big'))
+    return popped
+
+def test_oldest_qos0_packets_are_dropped_behind_held_qos1_packets():
+    queue = OutboundQueue(OutboundQueueLimits(max_messages=4))
+
+    for index in range(3):
+        assert queue.push(packet(index), 1)
+    for index in range(3, 10):
+        assert queue.push(packet(index), 0)
+
+    assert len(queue) == 4
+    assert queue.dropped == 6
+    assert drain(queue) == [0, 1, 2, 9]
+    assert queue.queued_bytes == 0
+
+def test_qos1_packets_are_held_up_to_the_hard_limit():
+    queue = OutboundQueue(OutboundQueueLimits(max_messages=2, hard_limit_messages=5))
+
+    for index in range(5):
+        assert queue.push(packet(index), 1)
+
+    assert not queue.push(packet(5), 1)
+    assert drain(queue) == [0, 1, 2, 3, 4]
+
+def test_drop_new_policy_keeps_the_queued_packets():
+    queue = OutboundQueue(OutboundQueueLimits(max_messages=2, qos0_policy=POLICY_DROP_NEW))
+
+    for index in range(4):
+        assert queue.push(packet(index), 0)
+
+    assert drain(queue) == [0, 1]
+    assert queue.dropped == 2
+
+def test_dropped_entries_do_not_accumulate_under_a_stalled_client():
+    queue = OutboundQueue(OutboundQueueLimits(max_messages=100))
+    queue.push(packet(0), 1)
+
+    for index in range(1, 100000):
+        queue.push(packet(index), 0)
+
+    assert len(queue) == queue.stats()['messages'] == 100
+    assert len(queue.entries) <= 2 * len(queue) + 1
+    popped = drain(queue)
+    assert popped[0] == 0 and popped[1:] == list(range(99901, 100000))
+
+class FailingTransport:
+    def __init__(self):
+        self.aborted = False
+
+    def writelines(self, parts):
+        raise OSError('broken pipe')
+
+    def abort(self):
+        self.aborted = True
+
+    def is_closing(self):
+        return self.aborted
+
+def test_write_error_while_draining_aborts_the_client():
+    transport = FailingTransport()
+    client = MQTTClient('client', ClientSettings('c1', 'MQTT', 4, 0, 0), transport, Logger(False))
+    client.pause_writing()
+    client.send_parts(packet(1), 1)
+
+    client.resume_writing()
+
+    assert transport.aborted
+    assert len(client.queue) == 0
@@ -0,0 +1,86 @@
+from Broker import Broker
+from Client import Client
+from FrameDecoder import FrameDecoder
+from Logger import Logger
+from Messages import PublishMessage, encode_remaining_length, encode_string
+from PeerLink import PeerManager
+
+from conftest import RecordingClient, encode_connect
+
+class LoopbackLink(Client):
+    """
+    One end of an in-process link, frames sent on it are handled by the manager at the other end.
+    """
+    is_peer = True
+
+    def __init__(self, client_name: str, manager: PeerManager):
+        super().__init__(client_name, None, Logger(False))
+        self.manager = manager
+        self.remote = None
+        self.decoder = FrameDecoder()
+        self.published = 0
+
+    def deliver(self, publish_message: PublishMessage, qos: int = 0):
+        self.manager.forward(self, publish_message)
+
+    def send_parts(self, parts: list, qos: int = 0):
+        data = b''.join(parts)
+        self.published += data[0] >> 4 == 3
+
+        manager, link = self.remote
+        for frame in self.decoder.feed(data):
+            manager.handle(link, frame)
+
+    def send(self, msg: bytes):
+        self.send_parts([msg])
+
+    def close(self):
+        pass
+
+def linked_workers(count: int) -> tuple:
+    """
+    Returns:
+    - tuple: The brokers and the links, (worker, peer) -> link of the worker to the peer.
+    """
+    brokers = [Broker(logger=Logger(False)) for _ in range(count)]
+    managers = [PeerManager(broker.topic_manager, Logger(False), retained_store=broker.retained_store) for broker in brokers]
+    links = {}
+
+    for i in range(count):
+        for j in range(i + 1, count):
+            left, right = links[(i, j)], links[(j, i)] = LoopbackLink(f'worker-{j}', managers[i]), LoopbackLink(f'worker-{i}', managers[j])
+            left.remote, right.remote = (managers[j], right), (managers[i], left)
+            managers[i].add_link(left)
+            managers[j].add_link(right)
+
+    return brokers, links
+
+def publish_retained(broker: Broker, topic: str, payload: bytes):
+    publisher = RecordingClient('publisher')
+    broker.protocol_handler.handle(publisher, encode_connect('publisher'))
+
+    body = encode_string(topic) + payload
+    broker.protocol_handler.handle(publisher, b'\x31' + encode_remaining_length(len(body)) + body)
+
+def test_retained_message_reaches_workers_without_subscribers():
+    brokers, _ = linked_workers(3)
+
+    publish_retained(brokers[0], 'state/lamp', b'on')
+
+    for broker in brokers:
+        assert [message.get_payload_bytes() for message in broker.retained_store.match('state/+')] == [b'on']
+
+    publish_retained(brokers[1], 'state/lamp', b'')
+
+    for broker in brokers:
+        assert broker.retained_store.match('state/+') == []
+
+def test_retained_message_is_sent_once_to_subscribed_workers():
+    brokers, links = linked_workers(2)
+    subscriber = RecordingClient('subscriber')
+    brokers[1].topic_manager.subscribe('state/#', subscriber)
+
+    publish_retained(brokers[0], 'state/lamp', b'on')
+
+    assert links[(0, 1)].published == 1
+    assert subscriber.received == [b'on']
@@ -0,0 +1,203 @@
+import pytest
+
+from Broker import Broker
+from Logger import Logger
+from Messages import PublishMessage, encode_ack, encode_remaining_length, encode_string, encode_subscribe
+from SessionStore import SessionStore
+from SubscriberManager import SubscriberManager
+from TopicAcl import TopicAcl
+
+from conftest import RecordingClient, encode_connect
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / 'sessions.bin')
+
+def queued(store: SessionStore, client_id: str) -> list:
+    return [payload for _, payload, _, _ in store.get(client_id).queue]
+
+def offline_session(path: str, *payloads) -> SessionStore:
+    store = SessionStore(path, Logger(False))
+    topics = SubscriberManager()
+    session, _ = store.attach('dev', RecordingClient(), topics)
+    store.subscribe(session, 'dev/cmd', 1)
+    store.detach(session, topics)
+
+    for payload in payloads:
+        store.enqueue(session, 'dev/cmd', payload, 1)
+
+    return store
+
+def test_resumed_messages_stay_queued_until_acknowledged(path):
+    store = offline_session(path, b'a', b'b', b'c')
+    session = store.get('dev')
+
+    messages = store.resume(session)
+    assert [bytes(message.payload) for message in messages] == [b'a', b'b', b'c']
+
+    store.acknowledge(session, messages[0])
+    store.close()
+
+    # The broker stopped before b and c were acknowledged, they are delivered again
+    assert queued(SessionStore(path, Logger(False)), 'dev') == [b'b', b'c']
+
+def test_out_of_order_acknowledgement_removes_the_right_message(path):
+    store = offline_session(path, b'a', b'b', b'c')
+    session = store.get('dev')
+    messages = store.resume(session)
+
+    store.acknowledge(session, messages[1])
+    assert queued(store, 'dev') == [b'a', b'c']
+    store.close()
+
+    assert queued(SessionStore(path, Logger(False)), 'dev') == [b'a', b'c']
+
+def test_messages_not_from_the_session_are_ignored(path):
+    store = offline_session(path, b'a')
+    session = store.get('dev')
+    store.resume(session)
+
+    store.acknowledge(session, PublishMessage.build('dev/cmd', b'a', 1))
+
+    assert queued(store, 'dev') == [b'a']
+
+def test_requeue_keeps_resumed_messages_once_and_drops_released_ones(path):
+    store = offline_session(path, b'a', b'b')
+    session = store.get('dev')
+    resumed = store.resume(session)
+    live = PublishMessage.build('dev/cmd', b'c', 1)
+
+    # b was released (QoS 2 PUBREL sent), so the in-flight window only returns a and c
+    store.requeue(session, [(resumed[0], 1), (live, 1)])
+    store.close()
+
+    assert queued(SessionStore(path, Logger(False)), 'dev') == [b'a', b'c']
+
+def test_broker_removes_queued_messages_on_puback_only(path):
+    store = offline_session(path, b'a', b'b')
+    store.close()
+    broker = Broker(logger=Logger(False), session_store=SessionStore(path, Logger(False)))
+    client = RecordingClient()
+
+    broker.protocol_handler.handle(client, encode_connect('dev', clean_session=False))
+    sent = client.publishes()
+    assert [payload for payload, _ in sent] == [b'a', b'b']
+    assert queued(broker.session_store, 'dev') == [b'a', b'b']
+
+    broker.protocol_handler.handle(client, encode_ack(4, sent[0][1]))
+    assert queued(broker.session_store, 'dev') == [b'b']
+
+    # The connection is lost before b was acknowledged, it stays queued exactly once
+    broker.protocol_handler.handle_connection_lost(client)
+    broker.session_store.close()
+    assert queued(SessionStore(path, Logger(False)), 'dev') == [b'b']
+
+def publish(topic: str, payload: bytes, qos: int, packet_id: int = 1, dup: bool = False) -> bytes:
+    body = encode_string(topic) + packet_id.to_bytes(2, 'big') + payload
+    return bytes((0x30 | dup << 3 | qos << 1,)) + encode_remaining_length(len(body)) + body
+
+def test_takeover_moves_in_flight_deliveries_to_the_new_connection(path):
+    broker = Broker(logger=Logger(False), session_store=SessionStore(path, Logger(False)))
+    handler = broker.protocol_handler
+    watcher = RecordingClient('watcher')
+    broker.topic_manager.subscribe('events/#', watcher)
+
+    old = RecordingClient('old')
+    handler.handle(old, encode_connect('dev', clean_session=False))
+    handler.handle(old, encode_subscribe(1, 'dev/cmd', 1))
+    publisher = RecordingClient('publisher')
+    handler.handle(publisher, encode_connect('publisher'))
+    handler.handle(publisher, publish('dev/cmd', b'a', 1, 1))
+    handler.handle(publisher, publish('dev/cmd', b'b', 1, 2))
+    # A QoS 2 message from the device, PUBREL not yet received
+    handler.handle(old, publish('events/boot', b'x', 2, 7))
+    assert [payload for payload, _ in old.publishes()] == [b'a', b'b']
+    assert len(watcher.sent) == 1
+
+    # The device reconnects before its half-open socket is noticed
+    new = RecordingClient('new')
+    handler.handle(new, encode_connect('dev', clean_session=False))
+    handler.handle_connection_lost(old)
+
+    sent = new.publishes()
+    assert [payload for payload, _ in sent] == [b'a', b'b']
+
+    # The retried QoS 2 PUBLISH is recognised as a duplicate
+    handler.handle(new, publish('events/boot', b'x', 2, 7, dup=True))
+    assert len(watcher.sent) == 1
+
+    for _, packet_id in sent:
+        handler.handle(new, encode_ack(4, packet_id))
+    assert queued(broker.session_store, 'dev') == []
+
+def test_reconnect_drops_subscriptions_and_messages_the_rules_no_longer_allow(path):
+    store = SessionStore(path, Logger(False))
+    topics = SubscriberManager()
+    session, _ = store.attach('dev', RecordingClient(), topics)
+    store.subscribe(session, 'dev/cmd', 1)
+    store.subscribe(session, 'admin/#', 1)
+    store.detach(session, topics)
+    store.enqueue(session, 'admin/reset', b'x', 1)
+    store.enqueue(session, 'dev/cmd', b'a', 1)
+    store.close()
+
+    acl = TopicAcl(Logger(False))
+    acl.parse('topic read dev/#')
+    broker = Broker(logger=Logger(False), session_store=SessionStore(path, Logger(False)), acl=acl)
+    broker.session_store.restore(broker.topic_manager)
+    client = RecordingClient()
+
+    broker.protocol_handler.handle(client, encode_connect('dev', clean_session=False))
+
+    assert [payload for payload, _ in client.publishes()] == [b'a']
+    assert list(broker.topic_manager.client_topics.get(client, ())) == ['dev/cmd']
+    broker.session_store.close()
+
+    reloaded = SessionStore(path, Logger(False))
+    assert list(reloaded.get('dev').subscriptions) == ['dev/cmd']
+    assert queued(reloaded, 'dev') == [b'a']
+
+def test_scheduled_flush_writes_the_records_of_one_iteration_together(path):
+    store = SessionStore(path, Logger(False))
+    scheduled = []
+    store.schedule_flush = scheduled.append
+    session, _ = store.attach('dev', RecordingClient(), SubscriberManager())
+
+    store.subscribe(session, 'a', 1)
+    store.subscribe(session, 'b', 1)
+
+    assert scheduled == [store.flush]
+    assert len(store.buffer) == 2
+    assert SessionStore(path, Logger(False)).get('dev') is None
+
+    scheduled.pop()()
+    assert store.buffer == []
+    assert set(SessionStore(path, Logger(False)).get('dev').subscriptions) == {'a', 'b'}
+
+def test_records_appended_during_compaction_go_to_the_new_file(path):
+    store = offline_session(path, *(bytes((index,)) for index in range(10)))
+    session = store.get('dev')
+    store.dequeue(session, 8)
+
+    records = store.begin_compaction()
+    store.enqueue(session, 'dev/cmd', b'x', 1)
+    assert store.write_compaction(records)
+    store.end_compaction(True)
+
+    reloaded = SessionStore(path, Logger(False))
+    assert queued(reloaded, 'dev') == [b'\x08', b'\x09', b'x']
+    assert store.file_size == reloaded.file_size
+    assert store.live_bytes == reloaded.live_bytes
+
+def test_failed_compaction_keeps_the_session_file(path, tmp_path):
+    store = offline_session(path, b'a')
+    session = store.get('dev')
+
+    records = store.begin_compaction()
+    store.enqueue(session, 'dev/cmd', b'b', 1)
+    store.path = str(tmp_path / 'missing' / 'sessions.bin')
+    assert not store.write_compaction(records)
+    store.path = path
+    store.end_compaction(False)
+
+    assert queued(SessionStore(path, Logger(False)), 'dev') == [b'a', b'b']
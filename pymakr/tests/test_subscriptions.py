@@ -0,0 +1,123 @@
+import struct
+
+import pytest
+
+from Broker import Broker
+from Logger import Logger
+from Messages import (SubscribeMessage, UnsubscribeMessage, encode_ack, encode_remaining_length, encode_string, encode_suback,
+                      PACKET_TYPE_UNSUBACK, SUBACK_FAILURE)
+from SubscriberManager import SubscriberManager
+
+from conftest import RecordingClient, encode_connect
+
+def encode_subscribe_many(packet_id: int, topics: list) -> bytes:
+    body = struct.pack('>H', packet_id) + b''.join(encode_string(topic) + bytes((qos,)) for topic, qos in topics)
+    return b'\x82' + encode_remaining_length(len(body)) + body
+
+def encode_unsubscribe_many(packet_id: int, topics: list) -> bytes:
+    body = struct.pack('>H', packet_id) + b''.join(encode_string(topic) for topic in topics)
+    return b'\xa2' + encode_remaining_length(len(body)) + body
+
+class CountingListener:
+    def __init__(self):
+        self.subscribed = []
+        self.unsubscribed = []
+
+    def on_subscribe(self, topic, client):
+        self.subscribed.append(topic)
+
+    def on_unsubscribe(self, topic, client):
+        self.unsubscribed.append(topic)
+
+def count_invalidations(topic_manager: SubscriberManager) -> list:
+    calls = []
+    invalidate_many = topic_manager.match_cache.invalidate_many
+
+    def counting(topic_filters):
+        calls.append(list(topic_filters))
+        invalidate_many(topic_filters)
+
+    topic_manager.match_cache.invalidate_many = counting
+    return calls
+
+def connected(broker: Broker) -> RecordingClient:
+    client = RecordingClient('client')
+    broker.protocol_handler.handle(client, encode_connect('client'))
+    client.sent.clear()
+    return client
+
+def test_subscribe_packet_keeps_every_filter_in_order():
+    message = SubscribeMessage(encode_subscribe_many(9, [('a/b', 0), ('c/+', 1), ('#', 2)]))
+
+    assert message.packet_id == 9
+    assert message.topics == [('a/b', 0), ('c/+', 1), ('#', 2)]
+
+    with pytest.raises(ValueError):
+        SubscribeMessage(encode_subscribe_many(9, []))
+
+def test_unsubscribe_packet_keeps_every_filter_in_order():
+    message = UnsubscribeMessage(encode_unsubscribe_many(4, ['a/b', 'c/+']))
+
+    assert message.packet_id == 4
+    assert message.topics == ['a/b', 'c/+']
+
+def test_suback_has_one_return_code_per_filter():
+    broker = Broker(logger=Logger(False))
+    client = connected(broker)
+    topics = [('a/b', 0), ('bad/#/x', 1), ('c/+', 1), ('d', 3), ('e/#', 2), ('f+/g', 0)]
+
+    broker.protocol_handler.handle(client, encode_subscribe_many(7, topics))
+
+    assert client.sent == [encode_suback(7, bytes((0, SUBACK_FAILURE, 1, SUBACK_FAILURE, 2, SUBACK_FAILURE)))]
+    assert broker.topic_manager.client_topics[client] == {'a/b', 'c/+', 'e/#'}
+
+def test_subscribe_batch_invalidates_the_match_cache_once():
+    broker = Broker(logger=Logger(False))
+    topic_manager = broker.topic_manager
+    listener = CountingListener()
+    topic_manager.add_listener(listener)
+    client = connected(broker)
+
+    for topic in ('a/b', 'c/d', 'x/y'):
+        topic_manager.match(topic)
+    calls = count_invalidations(topic_manager)
+
+    broker.protocol_handler.handle(client, encode_subscribe_many(1, [('a/b', 1), ('c/+', 0), ('bad/#/x', 0)]))
+
+    assert calls == [['a/b', 'c/+']]
+    assert set(topic_manager.match_cache.entries) == {'x/y'}
+    assert listener.subscribed == ['a/b', 'c/+']
+    assert [subscription.client for subscription in topic_manager.match('c/d')] == [client]
+
+def test_unsubscribe_batch_removes_every_filter_with_one_invalidation():
+    broker = Broker(logger=Logger(False))
+    topic_manager = broker.topic_manager
+    listener = CountingListener()
+    topic_manager.add_listener(listener)
+    client = connected(broker)
+    broker.protocol_handler.handle(client, encode_subscribe_many(1, [('a/b', 1), ('c/+', 0), ('e/#', 0)]))
+    client.sent.clear()
+
+    for topic in ('a/b', 'c/d', 'e/f'):
+        topic_manager.match(topic)
+    calls = count_invalidations(topic_manager)
+
+    broker.protocol_handler.handle(client, encode_unsubscribe_many(2, ['a/b', 'c/+', 'never/subscribed']))
+
+    assert client.sent == [encode_ack(PACKET_TYPE_UNSUBACK, 2)]
+    assert calls == [['a/b', 'c/+']]
+    assert set(topic_manager.match_cache.entries) == {'e/f'}
+    assert listener.unsubscribed == ['a/b', 'c/+']
+    assert topic_manager.client_topics[client] == {'e/#'}
+    assert topic_manager.match('a/b') == ()
+
+def test_resubscribing_with_a_new_qos_refreshes_cached_matches():
+    topic_manager = SubscriberManager(Logger(False))
+    client = RecordingClient()
+    topic_manager.subscribe_many([('a/+', 0), ('b', 0)], client)
+    assert topic_manager.match('a/x')[0].qos == 0
+
+    topic_manager.subscribe_many([('a/+', 2), ('b', 1)], client)
+
+    assert topic_manager.subscription_count == 2
+    assert topic_manager.match('a/x')[0].qos == 2
@@ -0,0 +1,97 @@
+from Broker import Broker
+from Logger import Logger
+from ProtocolHandlerV311 import KEEP_ALIVE_GRACE
+from TimerWheel import TimerWheel
+
+from conftest import RecordingClient, encode_connect
+
+PINGREQ = b'\xc0\x00'
+
+def fired_at(wheel: TimerWheel, ticks: int) -> dict:
+    """
+    Returns:
+    - dict: key -> the tick it fired on, over the next `ticks` ticks.
+    """
+    fired = {}
+    for _ in range(ticks):
+        for key in wheel.tick():
+            assert key not in fired
+            fired[key] = wheel.now
+    return fired
+
+def test_timers_longer_than_the_wheel_wait_for_their_rotations():
+    wheel = TimerWheel(8)
+
+    for ticks in (1, 7, 8, 9, 16, 17, 100):
+        wheel.schedule(ticks, ticks)
+
+    assert fired_at(wheel, 120) == {ticks: ticks for ticks in (1, 7, 8, 9, 16, 17, 100)}
+    assert len(wheel) == 0
+
+def test_timers_scheduled_later_count_from_now():
+    wheel = TimerWheel(4)
+    fired_at(wheel, 3)
+
+    wheel.schedule('a', 10)
+    assert fired_at(wheel, 20) == {'a': 13}
+
+def test_rescheduling_replaces_the_timer():
+    wheel = TimerWheel(8)
+    wheel.schedule('a', 5)
+    wheel.schedule('a', 20)
+    wheel.schedule('b', 3)
+    wheel.schedule('b', 2)
+
+    assert len(wheel) == 2
+    assert fired_at(wheel, 30) == {'a': 20, 'b': 2}
+
+def test_cancelled_timers_never_fire():
+    wheel = TimerWheel(8)
+    wheel.schedule('a', 12)
+    wheel.schedule('b', 12)
+    fired_at(wheel, 5)
+
+    wheel.cancel('a')
+    wheel.cancel('missing')
+
+    assert len(wheel) == 1
+    assert fired_at(wheel, 20) == {'b': 12}
+
+def test_timers_fire_on_the_next_tick_at_the_earliest():
+    wheel = TimerWheel(8)
+    wheel.schedule('a', 0)
+
+    assert wheel.tick() == ['a']
+
+def test_keep_alive_timer_is_rearmed_after_activity():
+    broker = Broker(logger=Logger(False))
+    handler = broker.protocol_handler
+    client = RecordingClient('sensor')
+    handler.handle(client, encode_connect('sensor'))
+    timeout = int(60 * KEEP_ALIVE_GRACE + 0.5)
+
+    for _ in range(timeout // 2):
+        handler.tick()
+    handler.handle(client, PINGREQ)
+    active_at = handler.keep_alive_timers.now
+
+    # The timer set at CONNECT fires, sees the ping and waits for the rest of the timeout
+    while handler.keep_alive_timers.now < active_at + timeout - 1:
+        handler.tick()
+        assert not client.aborted
+
+    handler.tick()
+    assert client.aborted
+
+def test_idle_client_is_disconnected_after_the_keep_alive_grace():
+    broker = Broker(logger=Logger(False))
+    handler = broker.protocol_handler
+    client = RecordingClient('sensor')
+    handler.handle(client, encode_connect('sensor'))
+
+    for _ in range(int(60 * KEEP_ALIVE_GRACE + 0.5) - 1):
+        handler.tick()
+    assert not client.aborted
+
+    handler.tick()
+    assert client.aborted
@@ -0,0 +1,146 @@
+import pytest
+
+from Logger import Logger
+from TopicAcl import ACCESS_WRITE, MAX_CLIENT_DECISIONS, TopicAcl
+
+def acl_for(rules: str, username: str = None, client_id: str = 'client'):
+    acl = TopicAcl(Logger(False))
+    acl.parse(rules)
+    return acl.for_client(username, client_id)
+
+def test_deny_inside_a_granted_subtree():
+    client = acl_for('''
+        user alice
+        topic readwrite home/#
+        topic deny home/alarm/code
+    ''', 'alice')
+
+    assert client.can_publish('home/kitchen/light')
+    assert client.can_publish('home/alarm/armed')
+    assert not client.can_publish('home/alarm/code')
+
+    assert client.can_subscribe('home/kitchen/#')
+    assert client.can_subscribe('home/+/temperature')
+    # Each of these filters also matches home/alarm/code
+    assert not client.can_subscribe('home/#')
+    assert not client.can_subscribe('home/+/code')
+    assert not client.can_subscribe('home/alarm/+')
+    assert not client.can_subscribe('home/alarm/code')
+
+def test_deny_with_wildcards_overlaps_filters():
+    client = acl_for('''
+        topic read #
+        topic deny +/secret
+    ''')
+
+    assert client.can_subscribe('a/public')
+    assert not client.can_subscribe('a/secret')
+    assert not client.can_subscribe('a/+')
+    assert not client.can_subscribe('a/#')
+    assert not client.can_subscribe('#')
+
+def test_filter_must_be_covered_by_a_grant():
+    client = acl_for('topic read sensors/+/temperature')
+
+    assert client.can_subscribe('sensors/1/temperature')
+    assert client.can_subscribe('sensors/+/temperature')
+    assert not client.can_subscribe('sensors/#')
+    assert not client.can_subscribe('sensors/+/+')
+    assert not client.can_publish('sensors/1/temperature')
+
+def test_hash_does_not_reach_dollar_topics():
+    client = acl_for('topic readwrite #')
+
+    assert client.can_publish('a/b')
+    assert client.can_subscribe('#')
+    assert not client.can_publish('$SYS/broker/uptime')
+    assert not client.can_subscribe('$SYS/#')
+
+    client = acl_for('''
+        topic read #
+        topic read $SYS/#
+        topic deny $SYS/broker/secret
+    ''')
+
+    # The deny below $SYS does not overlap '#', which never matches $ topics
+    assert client.can_subscribe('#')
+    assert client.can_subscribe('$SYS/broker/uptime')
+    assert not client.can_subscribe('$SYS/#')
+
+def test_patterns_substitute_the_client_id_and_user_name():
+    rules = '''
+        pattern readwrite devices/%c/#
+        pattern read users/%u/inbox
+    '''
+
+    client = acl_for(rules, 'alice', 'dev1')
+    assert client.can_publish('devices/dev1/state')
+    assert not client.can_publish('devices/dev2/state')
+    assert client.can_subscribe('users/alice/inbox')
+    assert not client.can_subscribe('users/bob/inbox')
+
+    # Without a user name the %u pattern does not apply
+    anonymous = acl_for(rules, None, 'dev1')
+    assert not anonymous.can_subscribe('users/+/inbox')
+
+@pytest.mark.parametrize('client_id', ['+', '#', 'dev/+', 'a/b'])
+def test_wildcard_client_id_is_refused_as_a_substitution(client_id):
+    client = acl_for('pattern readwrite devices/%c/#', None, client_id)
+
+    assert not client.can_subscribe('devices/#')
+    assert not client.can_subscribe('devices/+/state')
+    assert not client.can_publish(f'devices/{client_id}/state')
+    assert not client.can_publish('devices/other/state')
+
+def test_global_user_and_client_rules_combine():
+    acl = TopicAcl(Logger(False))
+    acl.parse('''
+        topic read public/#
+        user alice
+        topic write home/#
+        client sensor-01
+        topic deny home/secret
+        topic write sensors/1/#
+    ''')
+
+    both = acl.for_client('alice', 'sensor-01')
+    assert both.can_subscribe('public/#')
+    assert not both.can_publish('public/news')
+    assert both.can_publish('home/kitchen')
+    assert both.can_publish('sensors/1/temperature')
+    # A deny from the client rules wins over the grant of the user rules
+    assert not both.can_publish('home/secret')
+
+    user_only = acl.for_client('alice', 'laptop')
+    assert user_only.can_publish('home/secret')
+    assert not user_only.can_publish('sensors/1/temperature')
+
+    client_only = acl.for_client('bob', 'sensor-01')
+    assert not client_only.can_publish('home/kitchen')
+    assert client_only.can_publish('sensors/1/temperature')
+
+    nobody = acl.for_client(None, 'other')
+    assert nobody.can_subscribe('public/news')
+    assert not nobody.can_publish('home/kitchen')
+
+def test_decisions_are_cached_and_bounded():
+    client = acl_for('topic readwrite a/#')
+
+    assert client.can_publish('a/1')
+    assert client.decisions == {(ACCESS_WRITE, 'a/1'): True}
+
+    for index in range(MAX_CLIENT_DECISIONS * 2):
+        client.can_subscribe(f'a/{index}')
+        client.can_publish(f'b/{index}')
+
+    assert len(client.decisions) <= MAX_CLIENT_DECISIONS
+    assert client.can_publish('a/1') and not client.can_publish('b/1')
+
+def test_rule_file_errors():
+    acl = TopicAcl(Logger(False))
+
+    with pytest.raises(ValueError):
+        acl.parse('topics read a')
+
+    with pytest.raises(ValueError):
+        acl.parse('topic read')